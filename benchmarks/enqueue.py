@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013, Roberto Riggio
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the CREATE-NET nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY CREATE-NET ''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL CREATE-NET BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Enqueue-stall benchmark: time DispatcherProcedure.enqueue() calls made
+while the dispatcher is building feed documents out of a backlog of
+increasing size. The reader should stall for the same (short) time no
+matter how large the backlog is.
+"""
+
+import logging
+import optparse
+import threading
+import time
+
+from energino.feed import FORMAT_JSON
+from energino.httppool import Response
+from energino.xively_client import DispatcherProcedure
+
+STREAMS = ["power", "voltage", "current", "switch"]
+
+
+class NullPool(object):
+    """ Reject every upload without touching the network. """
+
+    def request(self, method, url, body=None, headers=None):
+        """ Refuse the request, so that the backlog is kept. """
+
+        return Response(503, "Service Unavailable", [], "")
+
+
+class NullDispatcher(object):
+    """ The bits of XivelyDispatcher used by DispatcherProcedure. """
+
+    def __init__(self, backlog):
+        self.config = {'feed' : 'bench',
+                       'key' : '',
+                       'spool' : '',
+                       'buffer' : 2 * backlog,
+                       'overflow' : 'drop_oldest',
+                       'period' : 0,
+                       'flush_samples' : 0,
+                       'flush_bytes' : 0,
+                       'put_samples' : backlog,
+                       'format' : FORMAT_JSON,
+                       'chunked' : True}
+        self.pool = NullPool()
+
+    def get_feed(self):
+        """ Return an empty feed. """
+
+        return {}
+
+    def discover(self):
+        """ Nothing to discover. """
+
+        pass
+
+
+def percentile(samples, fraction):
+    """ Return the given percentile of a list of samples. """
+
+    samples = sorted(samples)
+
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def run(backlog, enqueues):
+    """ Return build time and enqueue stalls (in s) for a backlog. """
+
+    procedure = NullDispatcher(backlog)
+    dispatcher = DispatcherProcedure(procedure)
+
+    for stream in STREAMS:
+        dispatcher.add_stream(stream, "derivedSI", stream, stream)
+
+    dispatcher.open_queues()
+    queue = dispatcher.queues[None]
+
+    readings = dict((stream, 1.0) for stream in STREAMS)
+    readings['ts'] = 0
+    readings['port'] = None
+
+    for _ in range(backlog):
+        dispatcher.enqueue(readings)
+
+    done = threading.Event()
+    builds = []
+
+    def upload():
+        """ Build and send the whole backlog, which is never consumed. """
+
+        while not done.isSet():
+            started = time.time()
+            queue.drain()
+            dispatcher.upload(queue, backlog)
+            builds.append(time.time() - started)
+
+    thread = threading.Thread(target=upload)
+    thread.start()
+
+    stalls = []
+
+    for _ in range(enqueues):
+        started = time.time()
+        dispatcher.enqueue(readings)
+        stalls.append(time.time() - started)
+        # a reader enqueues once per serial line
+        time.sleep(0.0005)
+
+    done.set()
+    thread.join()
+
+    return sum(builds) / max(len(builds), 1), stalls
+
+
+def main():
+    """ Launcher method. """
+
+    parser = optparse.OptionParser()
+
+    parser.add_option('--backlogs', '-n',
+                      dest="backlogs",
+                      default="100,1000,10000,50000")
+
+    parser.add_option('--enqueues', '-e',
+                      dest="enqueues",
+                      type="int",
+                      default=2000)
+
+    options, _ = parser.parse_args()
+
+    # every upload fails on purpose
+    logging.disable(logging.CRITICAL)
+
+    print("%8s %10s %10s %10s %10s" % ("backlog", "build", "p50", "p99",
+                                       "max"))
+
+    for backlog in [int(value) for value in options.backlogs.split(',')]:
+        build, stalls = run(backlog, options.enqueues)
+        print("%8u %9.1fms %8.1fus %8.1fus %8.1fus" %
+              (backlog,
+               build * 1e3,
+               percentile(stalls, 0.5) * 1e6,
+               percentile(stalls, 0.99) * 1e6,
+               max(stalls) * 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013, Roberto Riggio
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the CREATE-NET nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY CREATE-NET ''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL CREATE-NET BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Feed serializer benchmark: encode a backlog through the dispatcher's
+upload path, with the streaming encoders, and with the feed dictionary
+plus json.dumps() code of the process() they replace. Check that the
+JSON documents are identical byte for byte, and compare time per sample
+and the size of the largest string held in memory.
+"""
+
+import json
+import optparse
+import os
+import shutil
+import tempfile
+import time
+
+from collections import deque
+
+from energino.clock import format_ns
+from energino.clock import now_ns
+from energino.energino import ENERGINO_V1
+from energino.feed import chunks
+from energino.feed import encode_csv
+from energino.httppool import Response
+from energino.ringbuffer import RingBuffer
+from energino.xively_client import DispatcherProcedure
+from energino.xively_client import XivelyDispatcher
+
+STREAMS = ["power", "voltage", "current", "switch"]
+
+FEED = {"version" : "1.0.0",
+        "title" : "Energino",
+        "website" : "http://www.energino-project.org/",
+        "tags" : ["energino"],
+        "location" : {"disposition" : "fixed",
+                      "lat" : 46.0,
+                      "exposure" : "indoor",
+                      "lon" : 11.0,
+                      "name" : "bench",
+                      "domain" : "physical"}}
+
+CONFIG = """[General]
+key = bench
+feed = bench
+
+[Location]
+website = http://www.energino-project.org/
+tags = energino
+name = bench
+lat = 46.0
+lon = 11.0
+
+[Statistics]
+accounting = false
+"""
+
+LINE = "#Energino,1,%.3f,%.3f,%.3f,%u,100,200,0,0\n"
+
+
+def make_streams():
+    """ Return the datastream dictionaries used by the dispatcher. """
+
+    return dict((stream, {"id" : stream,
+                          "datapoints" : [],
+                          "unit": {"type": "derivedSI",
+                                   "label": stream,
+                                   "symbol": stream[0].upper()}})
+                for stream in STREAMS)
+
+
+class CapturePool(object):
+    """ Accept every upload, keeping the chunks of the last one. """
+
+    def __init__(self):
+        self.chunks = []
+
+    def request(self, method, url, body=None, headers=None):
+        """ Consume the body, as HTTPPool does. """
+
+        if callable(body):
+            self.chunks = list(body())
+        else:
+            self.chunks = [body]
+
+        return Response(200, "OK", [], "")
+
+    def close(self):
+        """ Nothing to close. """
+
+        pass
+
+
+def make_readings(samples, now):
+    """ Return samples readings as the parser returns them. """
+
+    outgoing = deque()
+
+    for index in range(samples):
+        readings, _, _ = ENERGINO_V1.unpack(LINE % (12.0 + index * 0.001,
+                                                    0.5,
+                                                    index * 0.25,
+                                                    index % 2))
+        readings['port'] = None
+        readings['ts'] = now + index * 100000000
+        outgoing.append(readings)
+
+    return outgoing
+
+
+def add_streams(dispatcher):
+    """ Register the datastreams, as XivelyDispatcher.start() does. """
+
+    integers = set(field for field, kind in ENERGINO_V1.types
+                   if kind is int)
+
+    for stream in STREAMS:
+        dispatcher.add_stream(stream, "derivedSI", stream,
+                              stream[0].upper(), None, stream in integers)
+
+
+def legacy(xively, streams, outgoing):
+    """ Build the feed document as the dispatcher's process() used to.
+
+    This is the code of the original process(), without the lock and
+    the upload.
+    """
+
+    feed = xively.get_feed()
+    feed['datastreams'] = []
+    for stream in streams.values():
+        stream['datapoints'] = []
+    pending = deque()
+    while outgoing:
+        readings = outgoing.popleft()
+        pending.append(readings)
+        for stream in streams.values():
+            stream['current_value'] = readings[stream['id']]
+            sample = {"at" : readings['at'],
+                      "value" :  "%.3f" % readings[stream['id']]}
+            stream['datapoints'].append(sample)
+    for stream in streams.values():
+        feed['datastreams'].append(stream)
+
+    return json.dumps(feed)
+
+
+def main():
+    """ Launcher method. """
+
+    parser = optparse.OptionParser()
+
+    parser.add_option('--samples', '-n',
+                      dest="samples",
+                      type="int",
+                      default=20000)
+
+    options, _ = parser.parse_args()
+
+    samples = options.samples
+    workdir = tempfile.mkdtemp()
+    config = os.path.join(workdir, "xively.conf")
+
+    with open(config, "w") as conf:
+        conf.write(CONFIG)
+
+    try:
+        xively = XivelyDispatcher("Energino", config, None)
+    finally:
+        shutil.rmtree(workdir)
+
+    xively.pool = CapturePool()
+    now = now_ns()
+
+    old = DispatcherProcedure(xively)
+    add_streams(old)
+
+    outgoing = make_readings(samples, now)
+
+    started = time.time()
+    expected = legacy(xively, old.streams, outgoing)
+    legacy_time = time.time() - started
+
+    dispatcher = xively.dispatcher
+    add_streams(dispatcher)
+    dispatcher.open_queues()
+    queue = dispatcher.queues[None]
+    queue.outgoing = RingBuffer(queue.names, samples)
+
+    for readings in make_readings(samples, now):
+        dispatcher.enqueue(readings)
+
+    queue.drain()
+
+    started = time.time()
+    dispatcher.upload(queue, samples)
+    json_time = time.time() - started
+    encoded = xively.pool.chunks
+
+    view = queue.outgoing.view()
+
+    started = time.time()
+    ats = [format_ns(ts) for ts in view.iter_ts()]
+    csv = list(chunks(encode_csv(queue.names, ats, view)))
+    csv_time = time.time() - started
+
+    if ''.join(encoded) != expected:
+        raise SystemExit("streaming JSON differs from process()")
+
+    print("samples:   %u, JSON output identical" % samples)
+    print("%-10s %10s %12s %12s" % ("encoder", "us/sample", "bytes",
+                                    "max string"))
+    print("%-10s %10.2f %12u %12u" % ("legacy", legacy_time * 1e6 / samples,
+                                      len(expected), len(expected)))
+    print("%-10s %10.2f %12u %12u" % ("json", json_time * 1e6 / samples,
+                                      len(expected),
+                                      max(len(chunk) for chunk in encoded)))
+    print("%-10s %10.2f %12u %12u" % ("csv", csv_time * 1e6 / samples,
+                                      sum(len(chunk) for chunk in csv),
+                                      max(len(chunk) for chunk in csv)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013, Roberto Riggio
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the CREATE-NET nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY CREATE-NET ''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL CREATE-NET BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Startup-time benchmark: attach to a fleet of simulated energinos and run
+the --reset --offset --sensitivity initialization sequence.
+
+With --legacy the same devices are then attached one after the other
+the way the original daemon did, with its fixed sleeps, and that time
+is reported too.
+"""
+
+import optparse
+import os
+import serial
+import threading
+import time
+
+from energino.energino import DEFAULT_DEVICE_SPEED_BPS
+from energino.energino import find_devices
+from energino.energino import probe
+from energino.simulator import spawn
+
+CMDS = ["#R", "#P200", "#C2500", "#D185"]
+
+
+def legacy(dev):
+    """ Attach to dev and send CMDS as the original PyEnergino did. """
+
+    ser = serial.Serial(baudrate=DEFAULT_DEVICE_SPEED_BPS,
+                        parity=serial.PARITY_NONE,
+                        stopbits=serial.STOPBITS_ONE,
+                        bytesize=serial.EIGHTBITS)
+    ser.port = dev
+    ser.open()
+
+    try:
+        time.sleep(2)
+
+        for _ in range(0, 5):
+            line = ser.readline()
+            if len(line) > 0 and line[0:1] == "#" and line[-1:] == '\n':
+                break
+        else:
+            raise RuntimeError("unable to identify model: %s" % line)
+
+        for cmd in CMDS:
+            ser.flushOutput()
+            ser.write(cmd + '\n')
+            time.sleep(2)
+
+    finally:
+        ser.close()
+
+
+def main():
+    """ Launcher method. """
+
+    parser = optparse.OptionParser()
+
+    parser.add_option('--devices', '-n',
+                      dest="devices",
+                      type="int",
+                      default=8)
+
+    parser.add_option('--models', '-m',
+                      dest="models",
+                      default="Energino")
+
+    parser.add_option('--period', '-i',
+                      dest="period",
+                      type="int",
+                      default=200)
+
+    parser.add_option('--boot', '-b',
+                      dest="boot",
+                      type="float",
+                      default=0.0)
+
+    parser.add_option('--legacy', '-l',
+                      action="store_true",
+                      dest="legacy",
+                      default=False)
+
+    options, _ = parser.parse_args()
+
+    prefix = "/tmp/ttyEnerginoBench%u_" % os.getpid()
+    devices = spawn(prefix,
+                    options.devices,
+                    options.models.split(","),
+                    options.period,
+                    boot=options.boot)
+
+    try:
+        started = time.time()
+        energinos = probe(prefix)
+        attached = time.time()
+
+        threads = [threading.Thread(target=energino.send_cmds, args=(CMDS,))
+                   for energino in energinos]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        done = time.time()
+
+        for energino in energinos:
+            energino.ser.close()
+
+        if options.legacy:
+            for dev in find_devices(prefix):
+                legacy(dev)
+            legacy_done = time.time()
+
+    finally:
+        for device in devices:
+            device.stop()
+
+    print("devices:   %u/%u" % (len(energinos), options.devices))
+    print("probe:     %.3fs" % (attached - started))
+    print("handshake: %.3fs" % (done - attached))
+    print("total:     %.3fs" % (done - started))
+
+    if options.legacy:
+        print("legacy:    %.3fs" % (legacy_done - done))
+
+
+if __name__ == "__main__":
+    main()
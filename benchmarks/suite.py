@@ -0,0 +1,669 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013, Roberto Riggio
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the CREATE-NET nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY CREATE-NET ''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL CREATE-NET BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Benchmark suite for the hot path: parsing, acquisition, buffering,
+serialization and upload.
+
+    parse       unpack_* and unpack_many, lines (or frames) per second
+    fetch       PyEnergino.fetch() and fetch_many() on a simulated device
+    dispatcher  DispatcherProcedure.enqueue/process with a large backlog
+    serialize   JSON and CSV feed size and encoding time
+    upload      sample to upload latency, through a stand-in Xively server
+
+Results can be saved as a JSON baseline with --save. With --compare the
+metrics are checked against a baseline and the run fails if any of them
+got worse by more than --threshold. Baselines only make sense on the
+machine that took them.
+"""
+
+import BaseHTTPServer
+import SocketServer
+import json
+import logging
+import optparse
+import os
+import platform
+import select
+import shutil
+import tempfile
+import threading
+import time
+
+from enqueue import NullDispatcher
+from enqueue import percentile
+from enqueue import run as enqueue_stalls
+from serializer import FEED
+from serializer import STREAMS
+from serializer import make_streams
+
+from energino.clock import format_ns
+from energino.clock import now_ns
+from energino.energino import ENERGINO_V1
+from energino.energino import FRAME_MAGIC
+from energino.energino import MODELS
+from energino.energino import PyEnergino
+from energino.feed import chunks
+from energino.feed import encode_csv
+from energino.feed import encode_json
+from energino.httppool import Response
+from energino.ringbuffer import RingBuffer
+from energino.simulator import Faults
+from energino.simulator import SimulatedEnergino
+from energino.simulator import spawn
+from energino.xively_client import DispatcherProcedure
+from energino.xively_client import XivelyDispatcher
+from energino.xively_client import DEFAULT_PUT_SAMPLES
+
+GROUPS = ["parse", "fetch", "dispatcher", "serialize", "upload"]
+
+HIGHER = "higher"
+LOWER = "lower"
+
+# distinct status lines generated per model, repeated as needed
+DISTINCT = 1000
+
+# frames are numbered modulo 2^16, a full round repeats without gaps
+FRAMES = 0x10000
+
+CONFIG = """[General]
+key = bench
+host = 127.0.0.1
+port = %u
+feed = bench
+period = %u
+flush_samples = 0
+flush_bytes = 0
+
+[Statistics]
+accounting = false
+"""
+
+
+class Results(object):
+    """ Named metrics, printed as they are added. """
+
+    def __init__(self):
+        self.metrics = {}
+
+    def add(self, name, value, unit, better):
+        """ Record a metric, better is HIGHER or LOWER. """
+
+        self.metrics[name] = {'value' : value,
+                              'unit' : unit,
+                              'better' : better}
+
+        print("%-36s %14.2f %s" % (name, value, unit))
+
+
+def best_time(func, repeat):
+    """ Return the shortest of repeat runs of func, in s. """
+
+    elapsed = []
+
+    for _ in range(repeat):
+        started = time.time()
+        func()
+        elapsed.append(time.time() - started)
+
+    return max(min(elapsed), 1e-9)
+
+
+def sample_data(model, count, binary=False):
+    """ Return count status lines (or frames) sent by a simulated model. """
+
+    workdir = tempfile.mkdtemp()
+    device = SimulatedEnergino(os.path.join(workdir, "tty"), model,
+                               faults=Faults(noise=0.01, seed=0))
+    device.binary = binary
+
+    try:
+        return [device.status() for _ in range(count)]
+    finally:
+        device.stop()
+        shutil.rmtree(workdir)
+
+
+def repeat_lines(lines, count):
+    """ Return count lines, cycling through lines. """
+
+    return [lines[index % len(lines)] for index in range(count)]
+
+
+def bench_parse(results, options):
+    """ Line and frame decoding rates. """
+
+    for model, schema in [("Energino", "energino_v1"),
+                          ("EnerginoAbs", "energino_abs_v1"),
+                          ("EnerginoEthernet", "energino_ethernet_v1")]:
+
+        lines = repeat_lines(sample_data(model, DISTINCT), options.lines)
+        unpack = MODELS[model][1].unpack
+
+        def unpack_all():
+            """ Unpack every line. """
+            for line in lines:
+                unpack(line)
+
+        elapsed = best_time(unpack_all, options.repeat)
+        results.add("parse.unpack_%s" % schema, len(lines) / elapsed,
+                    "lines/s", HIGHER)
+
+    decoder = MODELS["Energino"][1]
+    data = "".join(repeat_lines(sample_data("Energino", DISTINCT),
+                                options.lines))
+
+    def unpack_text():
+        """ Split and unpack every line in blocks. """
+        framer = decoder.framer()
+        batch = decoder.batch()
+        for start in range(0, len(data), 4096):
+            decoder.unpack_many(framer.split(data[start:start + 4096]), batch)
+
+    elapsed = best_time(unpack_text, options.repeat)
+    results.add("parse.unpack_many_energino_v1", options.lines / elapsed,
+                "lines/s", HIGHER)
+
+    decoder = MODELS[FRAME_MAGIC][1]
+    data = "".join(sample_data("Energino", FRAMES, True))
+
+    def unpack_frames():
+        """ Split and unpack every frame in blocks. """
+        framer = decoder.framer()
+        batch = decoder.batch()
+        for start in range(0, len(data), 4096):
+            decoder.unpack_many(framer.split(data[start:start + 4096]), batch)
+
+    elapsed = best_time(unpack_frames, options.repeat)
+    results.add("parse.unpack_many_frames", FRAMES / elapsed, "frames/s",
+                HIGHER)
+
+
+class Feeder(threading.Thread):
+    """ Write data to a simulated device as fast as it is read. """
+
+    def __init__(self, device, data):
+        super(Feeder, self).__init__()
+        self.daemon = True
+        self.device = device
+        self.data = data
+        self.stop = threading.Event()
+
+    def run(self):
+        offset = 0
+        while not self.stop.isSet():
+            _, ready, _ = select.select([], [self.device.master], [], 0.1)
+            if ready:
+                data = self.data
+                offset = offset % len(data)
+                offset = offset + os.write(self.device.master,
+                                           data[offset:offset + 4096])
+
+
+def bench_fetch(results, options):
+    """ Acquisition rates from a simulated device. """
+
+    count = options.lines // 10
+    workdir = tempfile.mkdtemp()
+    device = SimulatedEnergino(os.path.join(workdir, "tty"))
+    feeder = Feeder(device, "".join(sample_data("Energino", DISTINCT)))
+    feeder.start()
+
+    try:
+        energino = PyEnergino(device.link)
+
+        def fetch():
+            """ Read count lines. """
+            for _ in range(count):
+                energino.fetch()
+
+        elapsed = best_time(fetch, options.repeat)
+        results.add("fetch.text", count / elapsed, "lines/s", HIGHER)
+
+        def fetch_many():
+            """ Read at least count lines. """
+            total = 0
+            while total < count:
+                total = total + len(energino.fetch_many())
+
+        energino.use(energino.schema)
+        elapsed = best_time(fetch_many, options.repeat)
+        results.add("fetch.text_many", count / elapsed, "lines/s", HIGHER)
+
+        feeder.data = "".join(sample_data("Energino", FRAMES, True))
+        energino.use(MODELS[FRAME_MAGIC][1])
+        elapsed = best_time(fetch, options.repeat)
+        results.add("fetch.frames", count / elapsed, "frames/s", HIGHER)
+
+        energino.ser.close()
+
+    finally:
+        feeder.stop.set()
+        feeder.join()
+        device.stop()
+        shutil.rmtree(workdir)
+
+
+class SinkPool(object):
+    """ Accept every upload, reading the whole body. """
+
+    def __init__(self):
+        self.bytes = 0
+
+    def request(self, method, url, body=None, headers=None):
+        """ Consume the body and succeed. """
+
+        if callable(body):
+            body = "".join(body())
+
+        self.bytes = self.bytes + len(body)
+
+        return Response(200, "OK", [], "")
+
+
+class SinkDispatcher(NullDispatcher):
+    """ A dispatcher whose uploads always succeed. """
+
+    def __init__(self, backlog):
+        super(SinkDispatcher, self).__init__(backlog)
+        self.config['put_samples'] = int(DEFAULT_PUT_SAMPLES)
+        self.pool = SinkPool()
+
+    def discover(self):
+        """ The feed is always there. """
+
+        return True
+
+
+def make_procedure(backlog):
+    """ Return a DispatcherProcedure uploading to a SinkPool. """
+
+    procedure = DispatcherProcedure(SinkDispatcher(backlog))
+
+    for stream in STREAMS:
+        procedure.add_stream(stream, "derivedSI", stream, stream)
+
+    procedure.open_queues()
+
+    return procedure
+
+
+def bench_dispatcher(results, options):
+    """ Enqueue and upload rates with a large backlog. """
+
+    backlog = options.backlog
+    readings = dict((stream, 1.0) for stream in STREAMS)
+    readings['ts'] = now_ns()
+    readings['port'] = None
+
+    def enqueue():
+        """ Queue the backlog one reading at a time. """
+        procedure = make_procedure(backlog)
+        for _ in range(backlog):
+            procedure.enqueue(readings)
+        procedure.queues[None].drain()
+
+    elapsed = best_time(enqueue, options.repeat)
+    results.add("dispatcher.enqueue", backlog / elapsed, "rows/s", HIGHER)
+
+    batch = ENERGINO_V1.batch()
+    lines = sample_data("Energino", 100)
+    ENERGINO_V1.unpack_many(ENERGINO_V1.framer().split("".join(lines)), batch)
+    batch.ts.extend(readings['ts'] + index for index in range(len(lines)))
+
+    def enqueue_many():
+        """ Queue the backlog one batch at a time. """
+        procedure = make_procedure(backlog)
+        for _ in range(backlog // len(batch)):
+            procedure.enqueue_many(batch)
+        procedure.queues[None].drain()
+
+    elapsed = best_time(enqueue_many, options.repeat)
+    results.add("dispatcher.enqueue_many", backlog / elapsed, "rows/s",
+                HIGHER)
+
+    elapsed = []
+    for _ in range(options.repeat):
+        procedure = make_procedure(backlog)
+        for _ in range(backlog):
+            readings['ts'] = readings['ts'] + 100000000
+            procedure.enqueue(readings)
+        started = time.time()
+        procedure.process()
+        elapsed.append(time.time() - started)
+
+    results.add("dispatcher.process", backlog / min(elapsed), "samples/s",
+                HIGHER)
+    results.add("dispatcher.process_bytes",
+                float(procedure.dispatcher.pool.bytes) / backlog,
+                "bytes/sample", LOWER)
+
+    build, stalls = enqueue_stalls(backlog, 2000)
+    results.add("dispatcher.build", build * 1e3, "ms", LOWER)
+    results.add("dispatcher.enqueue_stall_p99",
+                percentile(stalls, 0.99) * 1e6, "us", LOWER)
+
+
+def bench_serialize(results, options):
+    """ Feed document size and encoding time. """
+
+    samples = options.backlog
+    ring = RingBuffer(sorted(STREAMS), samples)
+    now = now_ns()
+
+    for index in range(samples):
+        ring.append(now + index * 100000000,
+                    [index * 0.25, index % 2, 12.0 + index * 0.001, 0.5])
+
+    view = ring.view()
+    sizes = {}
+
+    def encode_json_feed():
+        """ Encode the whole ring as a JSON feed. """
+        ats = [format_ns(ts) for ts in view.iter_ts()]
+        streams = list(make_streams().values())
+        feed = dict(FEED)
+        sizes['json'] = sum(len(chunk) for chunk
+                            in chunks(encode_json(feed, streams, ats, view)))
+
+    def encode_csv_feed():
+        """ Encode the whole ring as CSV. """
+        ats = [format_ns(ts) for ts in view.iter_ts()]
+        sizes['csv'] = sum(len(chunk) for chunk
+                           in chunks(encode_csv(sorted(STREAMS), ats, view)))
+
+    for name, func in [("json", encode_json_feed), ("csv", encode_csv_feed)]:
+        elapsed = best_time(func, options.repeat)
+        results.add("serialize.%s_time" % name, elapsed * 1e6 / samples,
+                    "us/sample", LOWER)
+        results.add("serialize.%s_size" % name,
+                    float(sizes[name]) / samples, "bytes/sample", LOWER)
+
+
+def parse_at(at):
+    """ Return the time of an 'at' field, as formatted by format_ns. """
+
+    seconds = time.mktime(time.strptime(at[:19], "%Y-%m-%dT%H:%M:%S"))
+
+    return seconds + int(at[20:26]) / 1e6
+
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Just enough of the Xively API for the dispatcher. """
+
+    protocol_version = "HTTP/1.1"
+
+    # one write per response, flushed by handle_one_request()
+    wbufsize = -1
+
+    def do_GET(self):
+        """ Every feed exists. """
+
+        self.reply(json.dumps(FEED))
+
+    def do_PUT(self):
+        """ Record the delay of every datapoint. """
+
+        body = self.read_body()
+        received = time.time()
+
+        for stream in json.loads(body)['datastreams']:
+            if stream['id'] == "power":
+                self.server.delays.extend(received - parse_at(point['at'])
+                                          for point in stream['datapoints'])
+
+        self.server.bytes = self.server.bytes + len(body)
+        self.reply("")
+
+    def read_body(self):
+        """ Read the request body, chunked or not. """
+
+        if self.headers.get('Transfer-Encoding') != 'chunked':
+            return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+        body = []
+
+        while True:
+            size = int(self.rfile.readline().split(';')[0], 16)
+            if not size:
+                self.rfile.readline()
+                return "".join(body)
+            body.append(self.rfile.read(size))
+            self.rfile.readline()
+
+    def reply(self, body):
+        """ Send a 200 response. """
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ A stand-in Xively server, recording delays and upload size. """
+
+    daemon_threads = True
+
+    def __init__(self, address):
+        BaseHTTPServer.HTTPServer.__init__(self, address, StandInHandler)
+        self.delays = []
+        self.bytes = 0
+
+
+def bench_upload(results, options):
+    """ Sample to upload latency through a local stand-in for Xively. """
+
+    server = StandInServer(("127.0.0.1", 0))
+
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    workdir = tempfile.mkdtemp()
+    config = os.path.join(workdir, "xively.conf")
+
+    with open(config, "w") as conf:
+        conf.write(CONFIG % (server.server_address[1], options.upload_period))
+
+    devices = spawn(os.path.join(workdir, "tty"), 1,
+                    period=options.device_period)
+
+    try:
+        backend = PyEnergino(devices[0].link, interval=options.device_period)
+        xively = XivelyDispatcher("bench", config, backend)
+
+        for stream in STREAMS:
+            xively.add_stream(stream, "derivedSI", stream, stream)
+
+        client = threading.Thread(target=xively.start)
+        client.daemon = True
+        client.start()
+
+        time.sleep(options.duration)
+
+        xively.shutdown()
+        client.join(1)
+        xively.dispatcher.join(1)
+        # let the server threads see the connections close
+        xively.pool.close()
+
+    finally:
+        server.shutdown()
+        for device in devices:
+            device.stop()
+        shutil.rmtree(workdir)
+
+    delays = server.delays
+
+    if not delays:
+        raise SystemExit("nothing uploaded in %us" % options.duration)
+
+    results.add("upload.latency_p50", percentile(delays, 0.5) * 1e3, "ms",
+                LOWER)
+    results.add("upload.latency_p99", percentile(delays, 0.99) * 1e3, "ms",
+                LOWER)
+    results.add("upload.latency_max", max(delays) * 1e3, "ms", LOWER)
+    results.add("upload.bytes", float(server.bytes) / len(delays),
+                "bytes/sample", LOWER)
+
+
+BENCHMARKS = {"parse" : bench_parse,
+              "fetch" : bench_fetch,
+              "dispatcher" : bench_dispatcher,
+              "serialize" : bench_serialize,
+              "upload" : bench_upload}
+
+
+def save(path, results, options):
+    """ Write the results as a JSON baseline. """
+
+    baseline = {"created" : format_ns(now_ns()),
+                "python" : platform.python_version(),
+                "platform" : platform.platform(),
+                "options" : vars(options),
+                "metrics" : results.metrics}
+
+    with open(path, "w") as output:
+        json.dump(baseline, output, indent=1, sort_keys=True)
+
+
+def compare(path, results, threshold):
+    """ Print the change of every metric, return the regressions. """
+
+    with open(path) as baseline_file:
+        baseline = json.load(baseline_file)
+
+    if baseline['python'] != platform.python_version() or \
+       baseline['platform'] != platform.platform():
+        print("baseline taken on %s, python %s" % (baseline['platform'],
+                                                   baseline['python']))
+
+    print("%-36s %14s %14s %8s" % ("metric", "baseline", "current",
+                                   "change"))
+
+    regressions = []
+
+    for name in sorted(results.metrics):
+
+        if name not in baseline['metrics']:
+            continue
+
+        old = baseline['metrics'][name]['value']
+        new = results.metrics[name]['value']
+        change = (new - old) / old if old else 0.0
+
+        if results.metrics[name]['better'] == HIGHER:
+            worse = change < -threshold
+        else:
+            worse = change > threshold
+
+        if worse:
+            regressions.append(name)
+
+        print("%-36s %14.2f %14.2f %+7.1f%% %s" %
+              (name, old, new, change * 100, "REGRESSION" if worse else ""))
+
+    return regressions
+
+
+def main():
+    """ Launcher method. """
+
+    parser = optparse.OptionParser()
+
+    parser.add_option('--groups', '-g',
+                      dest="groups",
+                      default=",".join(GROUPS))
+
+    parser.add_option('--lines', '-n',
+                      dest="lines",
+                      type="int",
+                      default=100000)
+
+    parser.add_option('--backlog', '-b',
+                      dest="backlog",
+                      type="int",
+                      default=50000)
+
+    parser.add_option('--repeat', '-r',
+                      dest="repeat",
+                      type="int",
+                      default=3)
+
+    parser.add_option('--duration', '-d',
+                      dest="duration",
+                      type="int",
+                      default=10)
+
+    parser.add_option('--device-period', '-i',
+                      dest="device_period",
+                      type="int",
+                      default=20)
+
+    parser.add_option('--upload-period', '-u',
+                      dest="upload_period",
+                      type="int",
+                      default=1)
+
+    parser.add_option('--save', '-s', dest="save")
+
+    parser.add_option('--compare', '-c', dest="compare")
+
+    parser.add_option('--threshold', '-t',
+                      dest="threshold",
+                      type="float",
+                      default=0.25)
+
+    options, _ = parser.parse_args()
+
+    # corrupted lines, lost frames and failed uploads are expected
+    logging.disable(logging.CRITICAL)
+
+    results = Results()
+
+    for group in options.groups.split(","):
+        if group not in BENCHMARKS:
+            raise SystemExit("unknown benchmark %s" % group)
+        BENCHMARKS[group](results, options)
+
+    if options.save:
+        save(options.save, results, options)
+
+    if options.compare:
+        regressions = compare(options.compare, results, options.threshold)
+        if regressions:
+            raise SystemExit("%u regressions: %s" %
+                             (len(regressions), ", ".join(regressions)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,480 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013, Roberto Riggio
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the CREATE-NET nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY CREATE-NET ''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL CREATE-NET BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Offline analysis of recordings (see energino.recording).
+
+Recordings are memory-mapped and split in chunks of consecutive blocks,
+which are analyzed by a pool of processes with NumPy, so that memory
+use is bounded by the chunk size and not by the size of the capture.
+Each chunk yields partial results (sums, extrema, per-interval stats,
+histograms, energy, switch on-time) together with its first and last
+sample; partials of the same device are merged in time order, and the
+samples at the edges of chunks and files are accounted when merging.
+
+Energy is the trapezoidal integral of power, in Wh, as in the store:
+gaps longer than MAX_GAP are not integrated.
+"""
+
+from __future__ import absolute_import
+
+import sys
+import json
+import mmap
+import zlib
+import optparse
+import multiprocessing
+
+from energino.clock import format_ns
+from energino.clock import NS_PER_S
+from energino.recording import Recording
+from energino.recording import TEXT
+from energino.store import MAX_GAP
+from energino.store import NS_PER_HOUR
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+DEFAULT_CHUNK_ROWS = 1 << 20
+DEFAULT_INTERVAL = 3600
+DEFAULT_STREAM = 'power'
+
+
+def tasks(paths, chunk_rows=DEFAULT_CHUNK_ROWS):
+    """ Return (path, port, blocks) chunks of at most ~chunk_rows rows. """
+
+    chunks = []
+
+    for path in paths:
+        recording = Recording(path)
+        blocks = []
+        rows = 0
+        for block in recording.blocks:
+            blocks.append(block)
+            rows = rows + block.rows
+            if rows >= chunk_rows:
+                chunks.append((path, recording.port, blocks))
+                blocks = []
+                rows = 0
+        if blocks:
+            chunks.append((path, recording.port, blocks))
+        recording.close()
+
+    return chunks
+
+
+def load(recording, mapped, blocks, names):
+    """ Return ts and the named columns of consecutive blocks. """
+
+    kinds = dict(recording.columns)
+    ts = []
+    columns = dict((name, []) for name in names)
+
+    for block in blocks:
+        if block.compressed:
+            data = zlib.decompress(mapped[block.payload:
+                                          block.payload + block.size])
+            base = 0
+            layout = recording.layout(block, data)
+        else:
+            # uncompressed columns are read in place
+            data = mapped
+            base = block.payload
+            layout = recording.layout(block)
+        ts.append(numpy.frombuffer(data, '<i8', block.rows,
+                                   base + layout[0][0]))
+        for (name, kind), (offset, _) in zip(recording.columns, layout[1:]):
+            if name in columns:
+                columns[name].append(numpy.frombuffer(data, kinds[name],
+                                                      block.rows,
+                                                      base + offset))
+
+    ts = numpy.concatenate(ts)
+
+    for name in names:
+        columns[name] = numpy.concatenate(columns[name])
+
+    return ts, columns
+
+
+def edge(ts, columns, index):
+    """ Return the (ts, values) of a row, in plain Python types. """
+
+    return (int(ts[index]),
+            dict((name, column[index].item())
+                 for name, column in columns.items()))
+
+
+def analyze(task, stream=DEFAULT_STREAM, interval=DEFAULT_INTERVAL,
+            bins=0, ranges=None):
+    """ Return the partial results of a chunk. """
+
+    path, port, blocks = task
+
+    recording = Recording(path, blocks)
+    names = [name for name, kind in recording.columns if kind != TEXT]
+
+    with open(path, 'rb') as mapped_file:
+        mapped = mmap.mmap(mapped_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            ts, columns = load(recording, mapped, blocks, names)
+            partial = summarize(ts, columns, stream, interval, bins, ranges)
+            # the arrays still point into the mapping
+            del ts, columns
+        finally:
+            mapped.close()
+
+    recording.close()
+
+    partial['port'] = port
+
+    return partial
+
+
+def summarize(ts, columns, stream, interval, bins, ranges):
+    """ Return the partial results of a chunk, with NumPy. """
+
+    partial = {'rows' : len(ts),
+               'first' : edge(ts, columns, 0),
+               'last' : edge(ts, columns, -1),
+               'stats' : {},
+               'histograms' : {},
+               'buckets' : {},
+               'energy' : 0.0,
+               'time' : 0,
+               'on' : 0,
+               'transitions' : 0}
+
+    for name, column in columns.items():
+        values = column.astype('f8')
+        partial['stats'][name] = [len(values),
+                                  float(values.sum()),
+                                  float(numpy.dot(values, values)),
+                                  float(values.min()),
+                                  float(values.max())]
+        if bins and (ranges is None or name in ranges):
+            counts, _ = numpy.histogram(values, bins,
+                                        ranges[name] if ranges else None)
+            partial['histograms'][name] = counts.tolist()
+
+    delta = numpy.diff(ts)
+    valid = (delta > 0) & (delta <= MAX_GAP)
+    gaps = numpy.where(valid, delta, 0)
+
+    partial['time'] = int(gaps.sum())
+
+    segments = numpy.zeros(len(delta))
+
+    if 'power' in columns:
+        power = columns['power']
+        segments = (power[:-1] + power[1:]) / 2.0 * gaps / NS_PER_HOUR
+        partial['energy'] = float(segments.sum())
+
+    if 'switch' in columns:
+        switch = columns['switch']
+        partial['on'] = int(gaps[switch[:-1] != 0].sum())
+        partial['transitions'] = int(numpy.count_nonzero(switch[1:] !=
+                                                         switch[:-1]))
+
+    if stream in columns and interval:
+        values = columns[stream].astype('f8')
+        keys = ts // (interval * NS_PER_S)
+        # timestamps grow, so every bucket is a contiguous run
+        starts = numpy.flatnonzero(numpy.r_[True, keys[1:] != keys[:-1]])
+        counts = numpy.diff(numpy.r_[starts, len(keys)])
+        sums = numpy.add.reduceat(values, starts)
+        mins = numpy.minimum.reduceat(values, starts)
+        maxs = numpy.maximum.reduceat(values, starts)
+        index = numpy.repeat(numpy.arange(len(starts)), counts)
+        energy = numpy.bincount(index[:-1], segments, len(starts))
+        for bucket in range(len(starts)):
+            partial['buckets'][int(keys[starts[bucket]])] = \
+                [int(counts[bucket]), float(sums[bucket]),
+                 float(mins[bucket]), float(maxs[bucket]),
+                 float(energy[bucket])]
+
+    return partial
+
+
+def merge_bucket(buckets, key, bucket):
+    """ Merge per-interval stats. """
+
+    if key not in buckets:
+        buckets[key] = list(bucket)
+        return
+
+    merged = buckets[key]
+    merged[0] = merged[0] + bucket[0]
+    merged[1] = merged[1] + bucket[1]
+    merged[2] = min(merged[2], bucket[2])
+    merged[3] = max(merged[3], bucket[3])
+    merged[4] = merged[4] + bucket[4]
+
+
+def merge(partials, interval=DEFAULT_INTERVAL):
+    """ Merge partial results, return the results per port. """
+
+    ports = {}
+
+    for partial in sorted(partials, key=lambda partial: partial['first'][0]):
+        result = ports.get(partial['port'])
+
+        if result is None:
+            ports[partial['port']] = partial
+            continue
+
+        # the edge between the previous chunk and this one
+        last_ts, last = result['last']
+        first_ts, first = partial['first']
+        delta = first_ts - last_ts
+
+        if 0 < delta <= MAX_GAP:
+            result['time'] = result['time'] + delta
+            energy = 0.0
+            if 'power' in last:
+                energy = (last['power'] + first['power']) / 2.0 * delta / \
+                    NS_PER_HOUR
+                result['energy'] = result['energy'] + energy
+            if last.get('switch'):
+                result['on'] = result['on'] + delta
+            if interval:
+                key = last_ts // (interval * NS_PER_S)
+                if key in result['buckets']:
+                    result['buckets'][key][4] = \
+                        result['buckets'][key][4] + energy
+
+        if 'switch' in last and last['switch'] != first['switch']:
+            result['transitions'] = result['transitions'] + 1
+
+        for name, stats in partial['stats'].items():
+            merged = result['stats'].setdefault(name, [0, 0.0, 0.0,
+                                                       stats[3], stats[4]])
+            merged[0] = merged[0] + stats[0]
+            merged[1] = merged[1] + stats[1]
+            merged[2] = merged[2] + stats[2]
+            merged[3] = min(merged[3], stats[3])
+            merged[4] = max(merged[4], stats[4])
+
+        for name, counts in partial['histograms'].items():
+            merged = result['histograms'].setdefault(name, [0] * len(counts))
+            result['histograms'][name] = [a + b for a, b in zip(merged,
+                                                                counts)]
+
+        for key, bucket in partial['buckets'].items():
+            merge_bucket(result['buckets'], key, bucket)
+
+        for key in ('rows', 'energy', 'time', 'on', 'transitions'):
+            result[key] = result[key] + partial[key]
+
+        result['last'] = partial['last']
+
+    return ports
+
+
+def run(paths, stream=DEFAULT_STREAM, interval=DEFAULT_INTERVAL, bins=0,
+        ranges=None, jobs=None, chunk_rows=DEFAULT_CHUNK_ROWS):
+    """ Analyze recordings, return the results per port. """
+
+    chunks = tasks(paths, chunk_rows)
+
+    if not chunks:
+        return {}
+
+    if jobs == 1:
+        mapper = map
+        pool = None
+    else:
+        pool = multiprocessing.Pool(jobs)
+        mapper = pool.map
+
+    try:
+        # histograms need the range of the values, from a first pass
+        if bins and ranges is None:
+            first = merge(mapper(Worker(stream, interval), chunks), interval)
+            ranges = {}
+            for result in first.values():
+                for name, stats in result['stats'].items():
+                    low, high = ranges.get(name, (stats[3], stats[4]))
+                    ranges[name] = (min(low, stats[3]), max(high, stats[4]))
+            ranges = dict((name, (low, high if high > low else low + 1))
+                          for name, (low, high) in ranges.items())
+
+        partials = mapper(Worker(stream, interval, bins, ranges), chunks)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    results = merge(partials, interval)
+
+    for result in results.values():
+        result['ranges'] = ranges or {}
+
+    return results
+
+
+class Worker(object):
+    """ Picklable analyze() with fixed options, for the pool. """
+
+    def __init__(self, stream, interval, bins=0, ranges=None):
+        self.stream = stream
+        self.interval = interval
+        self.bins = bins
+        self.ranges = ranges
+
+    def __call__(self, task):
+        return analyze(task, self.stream, self.interval, self.bins,
+                       self.ranges)
+
+
+def report(port, result, stream, interval, bins):
+    """ Print the results of a port. """
+
+    print("%s: %u samples, %s - %s, %.1fs" % (port,
+                                             result['rows'],
+                                             format_ns(result['first'][0]),
+                                             format_ns(result['last'][0]),
+                                             float(result['time']) /
+                                             NS_PER_S))
+
+    if 'power' in result['stats']:
+        print("  energy: %.6f Wh" % result['energy'])
+
+    if 'switch' in result['stats'] and result['time']:
+        print("  switch: on %.2f%% of the time, %u transitions" %
+              (100.0 * result['on'] / result['time'],
+               result['transitions']))
+
+    for name in sorted(result['stats']):
+        count, total, squares, low, high = result['stats'][name]
+        mean = total / count
+        stddev = max(0.0, squares / count - mean * mean) ** 0.5
+        print("  %s: mean %.4f stddev %.4f min %.4f max %.4f" %
+              (name, mean, stddev, low, high))
+
+    if result['buckets']:
+        print("  %s every %us: start,count,mean,min,max,energy" %
+              (stream, interval))
+        for key in sorted(result['buckets']):
+            count, total, low, high, energy = result['buckets'][key]
+            print("  %s,%u,%.4f,%.4f,%.4f,%.6f" %
+                  (format_ns(key * interval * NS_PER_S), count,
+                   total / count, low, high, energy))
+
+    if bins:
+        for name in sorted(result['histograms']):
+            low, high = result['ranges'][name]
+            width = (high - low) / float(bins)
+            print("  %s histogram:" % name)
+            for index, count in enumerate(result['histograms'][name]):
+                print("  %.4f,%.4f,%u" % (low + index * width,
+                                          low + (index + 1) * width, count))
+
+
+def parse_ranges(value):
+    """ Parse name=low:high,... into a dictionary. """
+
+    ranges = {}
+
+    for spec in value.split(','):
+        name, bounds = spec.split('=')
+        low, high = bounds.split(':')
+        ranges[name] = (float(low), float(high))
+
+    return ranges
+
+
+def main():
+    """ Analyze recordings. """
+
+    parser = optparse.OptionParser(usage="%prog [options] file.enr ...")
+
+    parser.add_option('--stream', '-s',
+                      dest="stream",
+                      default=DEFAULT_STREAM,
+                      help="stream of the per-interval stats")
+
+    parser.add_option('--interval', '-i',
+                      dest="interval",
+                      type="int",
+                      default=DEFAULT_INTERVAL,
+                      help="per-interval stats every so many s, 0 for none")
+
+    parser.add_option('--bins', '-n',
+                      dest="bins",
+                      type="int",
+                      default=0,
+                      help="histogram bins, 0 for none")
+
+    parser.add_option('--range', '-r',
+                      dest="ranges",
+                      help="histogram ranges, e.g. power=0:20,voltage=0:15")
+
+    parser.add_option('--jobs', '-j',
+                      dest="jobs",
+                      type="int",
+                      default=None,
+                      help="worker processes (default: one per CPU)")
+
+    parser.add_option('--chunk', '-c',
+                      dest="chunk",
+                      type="int",
+                      default=DEFAULT_CHUNK_ROWS,
+                      help="rows per chunk of work")
+
+    parser.add_option('--json', '-J',
+                      dest="json",
+                      action="store_true",
+                      default=False)
+
+    options, args = parser.parse_args()
+
+    if not args:
+        parser.error("recording missing")
+
+    if numpy is None:
+        parser.error("numpy is required")
+
+    ranges = parse_ranges(options.ranges) if options.ranges else None
+
+    results = run(args, options.stream, options.interval, options.bins,
+                  ranges, options.jobs, options.chunk)
+
+    if options.json:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print("")
+        return
+
+    for port in sorted(results):
+        report(port, results[port], options.stream, options.interval,
+               options.bins)
+
+
+if __name__ == "__main__":
+    main()
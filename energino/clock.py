@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013, Roberto Riggio
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the CREATE-NET nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY CREATE-NET ''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL CREATE-NET BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Timestamps as integer nanoseconds.
+
+Readings are stamped with a monotonic clock anchored to wall time once
+at import, so taking a timestamp is a single clock read and timestamps
+never jump with wall clock adjustments. They are formatted only at
+output boundaries with format_ns().
+
+DeviceClock rebuilds sample times from the device-reported window, so
+samples are evenly spaced even when USB delivers them in bursts.
+"""
+
+import ctypes
+import ctypes.util
+import time
+
+from array import array
+from datetime import datetime
+
+AT_FORMAT = "%Y-%m-%dT%H:%M:%S.%fZ"
+
+NS_PER_MS = 1000000
+NS_PER_S = 1000000000
+
+# device time after which the clock follows the least delayed arrival
+DEFAULT_EPOCH = 10 * NS_PER_S
+
+# beyond this lag (in ns or windows, whichever is larger) a device clock
+# is resynchronized to the host clock
+DEFAULT_TOLERANCE = 2 * NS_PER_S
+DEFAULT_TOLERANCE_WINDOWS = 10
+
+
+class _Timespec(ctypes.Structure):
+    """ struct timespec. """
+
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+def _clock_gettime():
+    """ Return a monotonic_ns() based on clock_gettime(), if available. """
+
+    try:
+        librt = ctypes.CDLL(ctypes.util.find_library('rt') or
+                            ctypes.util.find_library('c'), use_errno=True)
+        clock_gettime = librt.clock_gettime
+    except (OSError, AttributeError, TypeError):
+        return None
+
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_Timespec)]
+    timespec = _Timespec()
+
+    def monotonic_ns():
+        """ Return CLOCK_MONOTONIC in nanoseconds. """
+        clock_gettime(1, ctypes.byref(timespec))
+        return timespec.tv_sec * NS_PER_S + timespec.tv_nsec
+
+    return monotonic_ns
+
+
+if hasattr(time, 'monotonic_ns'):
+    monotonic_ns = time.monotonic_ns
+else:
+    monotonic_ns = _clock_gettime() or \
+        (lambda: int(time.time() * NS_PER_S))
+
+ANCHOR = int(time.time() * NS_PER_S) - monotonic_ns()
+
+
+def now_ns():
+    """ Return the wall time in nanoseconds, read from the monotonic clock. """
+
+    return ANCHOR + monotonic_ns()
+
+
+def ns_array(initial=()):
+    """ Return an array able to hold nanosecond timestamps. """
+
+    for typecode in ('q', 'l'):
+        try:
+            if array(typecode).itemsize >= 8:
+                return array(typecode, initial)
+        except ValueError:
+            continue
+
+    return array('d', initial)
+
+
+_CACHE = (None, None)
+
+
+def format_ns(timestamp):
+    """ Format a timestamp as used in the readings 'at' field. """
+
+    global _CACHE
+
+    seconds, nanoseconds = divmod(int(timestamp), NS_PER_S)
+    cached, prefix = _CACHE
+
+    if cached != seconds:
+        prefix = datetime.fromtimestamp(seconds).strftime(AT_FORMAT[:-4])
+        _CACHE = (seconds, prefix)
+
+    return "%s.%06uZ" % (prefix, nanoseconds // 1000)
+
+
+class DeviceClock(object):
+    """ Rebuild sample times from the device window.
+
+    The device time is the sum of the windows, sequence numbers (when
+    available) account for the windows of lost samples. Samples are
+    stamped at their device time plus an offset: the lowest host minus
+    device time seen so far, i.e. the arrival with the least delay. So
+    samples are exactly one window apart, and never stamped after they
+    were received.
+
+    Delayed arrivals do not move the offset. To follow drift, at the end
+    of every epoch of device time the offset moves to the least delayed
+    arrival of that epoch. If the device falls behind the host by more
+    than the tolerance (e.g. after a stall) the clock is resynchronized.
+    """
+
+    def __init__(self, tolerance=DEFAULT_TOLERANCE, epoch=DEFAULT_EPOCH):
+        self.tolerance = tolerance
+        self.epoch = epoch
+        self.device = None
+        self.offset = None
+        self.lowest = None
+        self.started = None
+        self.last = None
+        self.seq = None
+        self.resyncs = 0
+
+    def advance(self, window, seq=None):
+        """ Move the device time past a sample, return the step (ns). """
+
+        step = int(window) * NS_PER_MS
+
+        if self.device is None:
+            self.device = 0
+        else:
+            if seq is not None and self.seq is not None:
+                step = step * (((seq - self.seq - 1) & 0xFFFF) + 1)
+            self.device = self.device + step
+
+        self.seq = seq
+
+        return step
+
+    def sync(self, host, step):
+        """ Update the offset with a sample received at host (ns). """
+
+        delta = host - self.device
+
+        if self.offset is None:
+            self.resync(delta)
+        elif delta < self.offset:
+            # the least delayed arrival so far
+            self.offset = delta
+        elif delta - self.offset > max(self.tolerance,
+                                       DEFAULT_TOLERANCE_WINDOWS * step):
+            self.resyncs = self.resyncs + 1
+            self.resync(delta)
+
+        self.lowest = min(self.lowest, delta)
+
+        if self.device - self.started >= self.epoch:
+            self.offset = self.lowest
+            self.lowest = delta
+            self.started = self.device
+
+    def resync(self, delta):
+        """ Start again from an offset of delta. """
+
+        self.offset = delta
+        self.lowest = delta
+        self.started = self.device
+
+    def place(self, device):
+        """ Return the stamp of device time, never before the last one. """
+
+        stamp = device + self.offset
+
+        if self.last is not None and stamp < self.last:
+            stamp = self.last
+
+        self.last = stamp
+
+        return stamp
+
+    def stamp(self, host, window, seq=None):
+        """ Return the time of a sample received at host (ns). """
+
+        self.sync(host, self.advance(window, seq))
+
+        return self.place(self.device)
+
+    def stamp_many(self, host, windows, seqs=None):
+        """ Return the times of samples received together at host (ns).
+
+        Only the last sample tells anything about the delay, the others
+        were held back by the transport.
+        """
+
+        devices = []
+        step = 0
+
+        for index, window in enumerate(windows):
+            step = self.advance(window, seqs[index] if seqs else None)
+            devices.append(self.device)
+
+        if devices:
+            self.sync(host, step)
+
+        return [self.place(device) for device in devices]
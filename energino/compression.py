@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013, Roberto Riggio
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the CREATE-NET nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY CREATE-NET ''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL CREATE-NET BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Lossy compression of sample streams within an error bound.
+
+Deadband keeps a point when it differs from the last kept one by more
+than the tolerance: holding the last kept value rebuilds the signal
+within the tolerance. Swinging door keeps the points needed to rebuild
+the signal by linear interpolation within the tolerance.
+
+Both filters decide about a point when the next one arrives, so rows go
+through the Compressor with a delay of one sample. Values that are not
+kept are replaced by NaN, rows where nothing is kept are dropped. A
+heartbeat keeps at least a point per stream every so often, so that a
+constant signal still shows up.
+"""
+
+from __future__ import absolute_import
+
+from energino.clock import NS_PER_S
+
+NONE = 'none'
+DEADBAND = 'deadband'
+SWINGING_DOOR = 'swinging_door'
+
+METHODS = (NONE, DEADBAND, SWINGING_DOOR)
+
+DEFAULT_HEARTBEAT = 300
+
+NAN = float('nan')
+INF = float('inf')
+
+
+class Deadband(object):
+    """ Keep a point if it moved more than tolerance from the last kept. """
+
+    def __init__(self, tolerance, heartbeat=DEFAULT_HEARTBEAT):
+        self.tolerance = tolerance
+        self.heartbeat = heartbeat * NS_PER_S
+        self.kept = None
+        self.held = None
+
+    def offer(self, ts, value):
+        """ Offer a point, return True if the previous one must be kept. """
+
+        held = self.held
+        self.held = (ts, value)
+
+        # NaN are gaps, there is nothing to keep
+        if held is None or held[1] != held[1]:
+            return False
+
+        if self.kept is None or self.expired(held[0]) or \
+           self.moved(held, self.held):
+            self.keep(held, self.held)
+            return True
+
+        return False
+
+    def expired(self, ts):
+        """ Return True if the heartbeat calls for a point. """
+
+        return self.heartbeat and ts - self.kept[0] >= self.heartbeat
+
+    def moved(self, held, point):
+        """ Return True if held must be kept. """
+
+        return abs(held[1] - self.kept[1]) > self.tolerance
+
+    def keep(self, held, point):
+        """ Make held the last kept point. """
+
+        self.kept = held
+
+    def flush(self):
+        """ Return the held point, which is always kept. """
+
+        held = self.held
+        self.held = None
+
+        if held is not None and held[1] == held[1]:
+            self.keep(held, None)
+
+        return held
+
+
+class SwingingDoor(Deadband):
+    """ Keep a point if no line within tolerance reaches the next one. """
+
+    def __init__(self, tolerance, heartbeat=DEFAULT_HEARTBEAT):
+        super(SwingingDoor, self).__init__(tolerance, heartbeat)
+        # interpolating between kept points can be off by twice the door
+        # width, so the door is half the tolerance wide
+        self.width = tolerance / 2.0
+        self.upper = -INF
+        self.lower = INF
+
+    def moved(self, held, point):
+        """ Return True if the door closes on point. """
+
+        return self.swing(point)
+
+    def swing(self, point):
+        """ Narrow the door to include point, return True if it closed. """
+
+        elapsed = point[0] - self.kept[0]
+
+        if elapsed <= 0:
+            return False
+
+        self.upper = max(self.upper,
+                         (point[1] - self.kept[1] - self.width) / elapsed)
+        self.lower = min(self.lower,
+                         (point[1] - self.kept[1] + self.width) / elapsed)
+
+        return self.upper > self.lower
+
+    def keep(self, held, point):
+        """ Make held the pivot of a new door, opened towards point. """
+
+        self.kept = held
+        self.upper = -INF
+        self.lower = INF
+
+        if point is not None:
+            self.swing(point)
+
+
+def make_filter(method, tolerance, heartbeat=DEFAULT_HEARTBEAT):
+    """ Return a filter for method, None if nothing is to be dropped. """
+
+    if method == DEADBAND:
+        return Deadband(tolerance, heartbeat)
+
+    if method == SWINGING_DOOR:
+        return SwingingDoor(tolerance, heartbeat)
+
+    if method == NONE:
+        return None
+
+    raise ValueError("invalid compression method: %s" % method)
+
+
+class Compressor(object):
+    """ Apply a filter per column to rows of (ts, values). """
+
+    def __init__(self, filters):
+        self.filters = list(filters)
+        self.enabled = any(flt is not None for flt in self.filters)
+        self.held = None
+        self.rows = 0
+        self.kept = 0
+
+    def offer(self, ts, values):
+        """ Offer a row, return the previous one masked, or None. """
+
+        self.rows = self.rows + 1
+
+        if not self.enabled:
+            self.kept = self.kept + 1
+            return ts, values
+
+        held = self.held
+        self.held = (ts, values)
+
+        masked = []
+        keep = False
+
+        for flt, value, old in zip(self.filters, values,
+                                   held[1] if held else values):
+            if flt is None:
+                masked.append(old)
+                # NaN are gaps already, they do not keep a row by themselves
+                keep = keep or old == old
+            elif flt.offer(ts, value):
+                masked.append(old)
+                keep = True
+            else:
+                masked.append(NAN)
+
+        if held is None or not keep:
+            return None
+
+        self.kept = self.kept + 1
+
+        return held[0], masked
+
+    def flush(self):
+        """ Return the held row with every column kept, or None. """
+
+        held = self.held
+        self.held = None
+
+        if held is None:
+            return None
+
+        for flt in self.filters:
+            if flt is not None:
+                flt.flush()
+
+        self.kept = self.kept + 1
+
+        return held
+
+    @property
+    def ratio(self):
+        """ Return the compression ratio so far. """
+
+        return float(self.rows) / max(self.kept, 1)
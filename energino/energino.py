@@ -30,145 +30,204 @@ A command line utility for interfacing with the energino power
 consumption monitor.
 """
 
+from __future__ import absolute_import
+
 import optparse
 import logging
-import sys
 import serial
 import glob
 import math
+import os
 import time
-
-from datetime import datetime
+import threading
+
+from collections import deque
+
+from energino.parser import Schema
+from energino.frames import FrameDecoder
+from energino.monitor import StreamMonitor
+from energino.store import Store
+from energino.compression import METHODS
+from energino.recording import Recorder
+from energino.recording import DEFAULT_LEVEL
+from energino.recording import DEFAULT_ROTATE_BYTES
+from energino.recording import DEFAULT_ROTATE_SECONDS
+from energino.clock import DeviceClock
+from energino.clock import now_ns
 
 DEFAULT_DEVICE = '/dev/ttyACM'
 DEFAULT_DEVICE_SPEED_BPS = 115200
 DEFAULT_INTERVAL = 200
+DEFAULT_PROBE_TIMEOUT = 5
+DEFAULT_ACK_TIMEOUT = 2
 LOG_FORMAT = '%(asctime)-15s %(message)s'
 
 
-def unpack_energino_v1(line):
-    """ Unpack Energino status line. """
-
-    logging.debug("line: %s", line.replace('\n', ''))
-
-    if type(line) is str and len(line) > 0 and \
-       line[0] == "#" and line[-1] == '\n':
-
-        readings = line[1:-1].split(",")
-
-        if len(readings) == 10:
-
-            readings = {'voltage': float(readings[2]),
-                        'current': float(readings[3]),
-                        'power': float(readings[4]),
-                        'switch': int(readings[5]),
-                        'window': int(readings[6]),
-                        'samples': int(readings[7]),
-                        'v_error': int(readings[8]),
-                        'i_error': int(readings[9])}
-
-            line = (readings['voltage'],
-                    readings['current'],
-                    readings['power'],
-                    readings['samples'],
-                    readings['window'],
-                    readings['v_error'],
-                    readings['i_error'])
-
-            log = "%s [V] %s [A] %s [W] %s [samples] %s [window] %s [mV] " \
-                  "%s [mA]" % line
-
-            return readings, line, log
-
-    raise ValueError("invalid line: %s" % line[0:-1])
-
-
-def unpack_energino_abs_v1(line):
-    """ Unpack Energino status line. """
+ENERGINO_V1 = Schema("EnerginoV1",
+                     [('voltage', float),
+                      ('current', float),
+                      ('power', float),
+                      ('switch', int),
+                      ('window', int),
+                      ('samples', int),
+                      ('v_error', int),
+                      ('i_error', int)],
+                     [('voltage', 'V'),
+                      ('current', 'A'),
+                      ('power', 'W'),
+                      ('samples', 'samples'),
+                      ('window', 'window'),
+                      ('v_error', 'mV'),
+                      ('i_error', 'mA')])
+
+ENERGINO_ABS_V1 = Schema("EnerginoAbsV1",
+                         [('voltage', float),
+                          ('current', float),
+                          ('power', float),
+                          ('switch', int),
+                          ('window', int),
+                          ('samples', int),
+                          ('v_error', int),
+                          ('i_error', int),
+                          ('battery', float),
+                          ('fitted', int)],
+                         [('voltage', 'V'),
+                          ('current', 'A'),
+                          ('power', 'W'),
+                          ('samples', 'samples'),
+                          ('window', 'window'),
+                          ('v_error', 'mV'),
+                          ('i_error', 'mA'),
+                          ('battery', '%'),
+                          ('fitted', 'm')])
+
+ENERGINO_ETHERNET_V1 = Schema("EnerginoEthernetV1",
+                              [('voltage', float),
+                               ('current', float),
+                               ('power', float),
+                               ('switch', int),
+                               ('window', int),
+                               ('samples', int),
+                               ('ip', str),
+                               ('server_port', str),
+                               ('host', str),
+                               ('host_port', str),
+                               ('feed', str),
+                               ('key', str)],
+                              [('voltage', 'V'),
+                               ('current', 'A'),
+                               ('power', 'W'),
+                               ('samples', 'samples'),
+                               ('window', 'window')])
+
+ENERGINO_FRAME_V1 = FrameDecoder(Schema("EnerginoFrameV1",
+                                        [('seq', int),
+                                         ('voltage', float),
+                                         ('current', float),
+                                         ('power', float),
+                                         ('switch', int),
+                                         ('window', int),
+                                         ('samples', int),
+                                         ('v_error', int),
+                                         ('i_error', int)],
+                                        [('voltage', 'V'),
+                                         ('current', 'A'),
+                                         ('power', 'W'),
+                                         ('samples', 'samples'),
+                                         ('window', 'window'),
+                                         ('v_error', 'mV'),
+                                         ('i_error', 'mA')]))
+
+unpack_energino_v1 = ENERGINO_V1.unpack
+unpack_energino_abs_v1 = ENERGINO_ABS_V1.unpack
+unpack_energino_ethernet_v1 = ENERGINO_ETHERNET_V1.unpack
+
+
+# echo printed by the sketch for each command, older firmwares use the
+# unprefixed form
+ACKS = {'R': ('@reset',),
+        'H': ('@Factory check',),
+        'Z': ('@feedurl:',),
+        'T': ('@offset:',),
+        'F': ('@feedid:',),
+        'K': ('@apikey:',),
+        'U': ('@feedurl:',),
+        'P': ('@period:',),
+        'A': ('@r1:', 'R1:'),
+        'B': ('@r2:', 'R2:'),
+        'C': ('@offset:', 'Offeset:'),
+        'D': ('@sensitivity:', 'Sensitivity:'),
+        'M': ('@mode:',),
+        'S': ('@switch:',)}
+
+# frames sent by any model after #M1
+FRAME_MAGIC = "EnerginoFrame"
+
+MODELS = {"Energino": {1: ENERGINO_V1},
+          "EnerginoAbs": {1: ENERGINO_ABS_V1},
+          "EnerginoEthernet": {1: ENERGINO_ETHERNET_V1},
+          "EnerginoPOE": {1: ENERGINO_V1},
+          "EnerginoYun": {1: ENERGINO_V1},
+          FRAME_MAGIC: {1: ENERGINO_FRAME_V1}}
+
+
+def identify(line):
+    """ Return the schema of the model sending line, if any. """
 
     logging.debug("line: %s", line.replace('\n', ''))
 
-    if type(line) is str and len(line) > 0 and \
-       line[0] == "#" and line[-1] == '\n':
+    if type(line) is str and \
+       len(line) > 0 and \
+       line[0] == "#" and \
+       line[-1] == '\n':
 
         readings = line[1:-1].split(",")
 
-        if len(readings) == 12:
+        if len(readings) > 1 and \
+           readings[0] in MODELS.keys() and \
+           readings[1].isdigit() and \
+           int(readings[1]) in MODELS[readings[0]]:
 
-            readings = {'voltage': float(readings[2]),
-                        'current': float(readings[3]),
-                        'power': float(readings[4]),
-                        'switch': int(readings[5]),
-                        'window': int(readings[6]),
-                        'samples': int(readings[7]),
-                        'v_error': int(readings[8]),
-                        'i_error': int(readings[9]),
-                        'battery': float(readings[10]),
-                        'fitted': int(readings[11])}
+            logging.debug("found %s version %s", readings[0], readings[1])
 
-            line = (readings['voltage'],
-                    readings['current'],
-                    readings['power'],
-                    readings['samples'],
-                    readings['window'],
-                    readings['v_error'],
-                    readings['i_error'],
-                    readings['battery'],
-                    readings['fitted'])
+            return MODELS[readings[0]][int(readings[1])]
 
-            log = "%s [V] %s [A] %s [W] %s [samples] %s [window] %s [mV] " \
-                  "%s [mA] %s [%%] %s [m]" % line
+    return None
 
-            return readings, line, log
 
-    raise ValueError("invalid line: %s" % line[0:-1])
+def annotate(readings, port, interval, clock):
+    """ Tag readings with port and timestamp, check polling interval. """
 
+    host = now_ns()
+    readings['port'] = port
+    readings['received'] = host
+    readings['ts'] = clock.stamp(host, readings['window'],
+                                 readings.get('seq'))
+    check_interval(interval, readings['window'])
 
-def unpack_energino_ethernet_v1(line):
-    """ Unpack Energino status line. """
 
-    logging.debug("line: %s", line.replace('\n', ''))
+def drift(interval, window):
+    """ Return how far the device window is from the polling interval. """
 
-    if type(line) is str and \
-       len(line) > 0 and \
-       line[0] == "#" and \
-       line[-1] == '\n':
-
-        readings = line[1:-1].split(",")
+    return math.fabs(interval - window)
 
-        if len(readings) == 14:
 
-            readings = {'voltage': float(readings[2]),
-                        'current': float(readings[3]),
-                        'power': float(readings[4]),
-                        'switch': int(readings[5]),
-                        'window': int(readings[6]),
-                        'samples': int(readings[7]),
-                        'ip': readings[8],
-                        'server_port': readings[9],
-                        'host': readings[10],
-                        'host_port': readings[11],
-                        'feed': readings[12],
-                        'key': readings[13]}
+def check_interval(interval, window):
+    """ Check the device window against the target polling interval. """
 
-            line = (readings['voltage'],
-                    readings['current'],
-                    readings['power'],
-                    readings['samples'],
-                    readings['window'])
+    delta = drift(interval, window)
 
-            log = "%s [V] %s [A] %s [W] %s [samples] %s [window]" % line
+    if delta / interval > 0.1:
+        logging.debug("Target polling %u actual %u", interval, window)
 
-            return readings, line, log
 
-    raise ValueError("invalid line: %s" % line[0:-1])
+def find_devices(port=DEFAULT_DEVICE):
+    """ Return the serial devices matching port. """
 
+    if os.path.exists(port):
+        return [port]
 
-MODELS = {"Energino": {1: unpack_energino_v1},
-          "EnerginoAbs": {1: unpack_energino_abs_v1},
-          "EnerginoEthernet": {1: unpack_energino_ethernet_v1},
-          "EnerginoPOE": {1: unpack_energino_v1},
-          "EnerginoYun": {1: unpack_energino_v1}}
+    return sorted(glob.glob(port + "*"))
 
 
 class PyEnergino(object):
@@ -177,34 +236,70 @@ class PyEnergino(object):
     def __init__(self,
                  port=DEFAULT_DEVICE,
                  bps=DEFAULT_DEVICE_SPEED_BPS,
-                 interval=DEFAULT_INTERVAL):
+                 interval=DEFAULT_INTERVAL,
+                 timeout=DEFAULT_PROBE_TIMEOUT):
 
+        self.schema = None
         self.unpack = None
+        self.unpack_many = None
+        self.decoder = None
         self.interval = interval
+        self.framer = None
+        # decoded frames, waiting to be returned by fetch()
+        self.frames = deque()
+        self.clock = DeviceClock()
+        self.parsed = 0
+        self.errors = 0
+        self.lost = 0
+
+        devs = find_devices(port)
+
+        if len(devs) > 1:
+            # probe every candidate at once and keep the first one found
+            energinos = probe(port, bps, interval, timeout)
+            if not energinos:
+                raise RuntimeError("unable to configure serial port")
+            for energino in energinos[1:]:
+                energino.ser.close()
+            self.ser = energinos[0].ser
+            self.schema = energinos[0].schema
+            self.use(self.schema)
+            return
+
         self.ser = serial.Serial(baudrate=bps,
                                  parity=serial.PARITY_NONE,
                                  stopbits=serial.STOPBITS_ONE,
-                                 bytesize=serial.EIGHTBITS)
-
-        devs = glob.glob(port + "*")
+                                 bytesize=serial.EIGHTBITS,
+                                 timeout=timeout)
 
         for dev in devs:
             logging.debug("scanning %s", dev)
             self.ser.port = dev
             self.ser.open()
-            time.sleep(2)
-            self.configure()
+            try:
+                self.configure()
+            except RuntimeError as ex:
+                logging.debug(ex)
+                self.ser.close()
+                continue
+            # the first status line proves the sketch is up, from now on
+            # block until a full line is received
+            self.ser.timeout = None
             logging.debug("attaching to port %s!", dev)
             return
 
         raise RuntimeError("unable to configure serial port")
 
-    def send_cmd(self, cmd):
-        """ Send command to serial port. """
+    def send_cmd(self, cmd, timeout=DEFAULT_ACK_TIMEOUT):
+        """ Send command to serial port and wait for its echo. """
 
         logging.debug("sending initialization sequence %s", cmd)
         self.write(cmd + '\n')
-        time.sleep(2)
+
+        if cmd[1:2] not in ACKS:
+            return True
+
+        return self.wait_ack(ACKS[cmd[1:2]], timeout)
 
     def send_cmds(self, cmds):
         """ Send command list serial port. """
@@ -212,32 +307,77 @@ class PyEnergino(object):
         for cmd in cmds:
             self.send_cmd(cmd)
 
+    def wait_ack(self, acks, timeout=DEFAULT_ACK_TIMEOUT):
+        """ Read lines until one starts with any of acks or timeout. """
+
+        deadline = time.time() + timeout
+        saved = self.ser.timeout
+        line = ''
+
+        try:
+            while True:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    logging.warning("no reply from %s", self.ser.port)
+                    return False
+                self.ser.timeout = remaining
+                line = line + self.ser.readline()
+                if not line.endswith('\n'):
+                    continue
+                if line.startswith(acks):
+                    logging.debug("reply: %s", line.strip())
+                    return True
+                line = ''
+        finally:
+            self.ser.timeout = saved
+
     def configure(self):
         """ Attempt to configure Energino. """
 
         for _ in range(0, 5):
             line = self.ser.readline()
-            logging.debug("line: %s", line.replace('\n', ''))
+            self.schema = identify(line)
+            if self.schema:
+                self.use(self.schema)
+                return
 
-            if type(line) is str and \
-               len(line) > 0 and \
-               line[0] == "#" and \
-               line[-1] == '\n':
+        raise RuntimeError("unable to identify model: %s" % line)
 
-                readings = line[1:-1].split(",")
+    def use(self, decoder):
+        """ Decode incoming data with decoder (a schema or frame decoder). """
 
-                if readings[0] in MODELS.keys() and \
-                   readings[1].isdigit() and \
-                   int(readings[1]) in MODELS[readings[0]]:
+        self.unpack = decoder.unpack
+        self.unpack_many = decoder.unpack_many
+        self.framer = decoder.framer()
+        self.frames.clear()
+        self.decoder = decoder
 
-                    logging.debug("found %s version %s",
-                                  readings[0],
-                                  readings[1])
+    def set_binary(self, binary=True, timeout=DEFAULT_ACK_TIMEOUT):
+        """ Switch the device to binary frames, or back to text lines. """
 
-                    self.unpack = MODELS[readings[0]][int(readings[1])]
-                    return
+        if not self.send_cmd("#M%u" % binary, timeout):
+            raise RuntimeError("%s does not support binary frames" %
+                               self.ser.port)
 
-        raise RuntimeError("unable to identify model: %s" % line)
+        if binary:
+            self.use(MODELS[FRAME_MAGIC][1])
+        else:
+            self.use(self.schema)
+
+    def split(self, data):
+        """ Split data into frames, counting corrupted and missing ones. """
+
+        framer = self.framer
+        crc_errors = framer.crc_errors
+        lost = framer.lost
+
+        frames = framer.split(data)
+
+        # a corrupted frame also shows up as a gap in the sequence
+        self.errors = self.errors + framer.crc_errors - crc_errors
+        self.lost = self.lost + framer.lost - lost
+
+        return frames
 
     def write(self, value):
         """ Write to serial port and flush. """
@@ -248,19 +388,145 @@ class PyEnergino(object):
     def fetch(self):
         """ Read from serial port. """
 
-        readings, line, log = self.unpack(self.ser.readline())
+        if self.decoder.binary:
+            while not self.frames:
+                data = self.ser.read(self.ser.inWaiting() or 1)
+                self.frames.extend(self.decode(self.split(data), now_ns()))
+            self.parsed = self.parsed + 1
+            return self.frames.popleft()
 
-        readings['port'] = self.ser.port
-        readings['at'] = datetime.now().strftime("%Y-%m-%dT%H:%M:%S.%fZ")
-        delta = math.fabs(self.interval - readings['window'])
+        line = self.ser.readline()
 
-        if delta / self.interval > 0.1:
-            logging.debug("Target polling %u actual %u",
-                          self.interval,
-                          readings['window'])
+        # command echoes (e.g. @S1) are not samples, nothing is lost
+        while line and line[:1] != '#':
+            logging.debug("skipping %s", line.rstrip())
+            line = self.ser.readline()
+
+        try:
+            readings, line, log = self.unpack(line)
+        except ValueError:
+            self.errors = self.errors + 1
+            self.lost = self.lost + 1
+            raise
+
+        self.parsed = self.parsed + 1
+
+        annotate(readings, self.ser.port, self.interval, self.clock)
 
         return readings, line, log
 
+    def decode(self, frames, host):
+        """ Unpack and stamp frames read together at host (ns). """
+
+        decoded = []
+
+        for frame in frames:
+            try:
+                decoded.append(self.unpack(frame))
+            except ValueError as ex:
+                logging.warning("invalid frame on %s: %s", self.ser.port, ex)
+                self.errors = self.errors + 1
+                self.lost = self.lost + 1
+
+        # a read returns frames held back by the transport, only the
+        # last one tells when they were received
+        stamps = self.clock.stamp_many(host,
+                                       [item[0]['window'] for item in decoded],
+                                       [item[0].get('seq') for item in decoded])
+
+        for (readings, _, _), stamp in zip(decoded, stamps):
+            readings['port'] = self.ser.port
+            readings['received'] = host
+            readings['ts'] = stamp
+            check_interval(self.interval, readings['window'])
+
+        return decoded
+
+    def fetch_many(self, batch=None):
+        """ Read every complete line available from serial port.
+
+        Blocks until at least one byte is received, the readings are
+        appended to batch, a new batch is returned if none is given. The
+        partial line at the end is kept for the next call, so fetch()
+        and fetch_many() should not be mixed on the same device.
+        """
+
+        data = self.ser.read(self.ser.inWaiting() or 1)
+        now = now_ns()
+
+        if batch is None:
+            batch = self.decoder.batch()
+
+        batch.port = self.ser.port
+        batch.received = now
+        start = len(batch.window)
+        lost = self.unpack_many(self.split(data), batch)
+
+        if lost:
+            logging.warning("%u samples lost on %s", lost, self.ser.port)
+            batch.lost = batch.lost + lost
+            self.errors = self.errors + lost
+            self.lost = self.lost + lost
+
+        self.parsed = self.parsed + len(batch.window) - start
+
+        first = len(batch.ts)
+        seqs = batch.columns.get('seq')
+
+        if seqs is not None:
+            seqs = seqs[first:]
+
+        batch.ts.extend(self.clock.stamp_many(now, batch.window[first:], seqs))
+
+        if len(batch):
+            check_interval(self.interval, batch.window[-1])
+
+        return batch
+
+    def iter_batches(self):
+        """ Yield non-empty batches of readings as they are received. """
+
+        lost = 0
+
+        while True:
+            batch = self.fetch_many()
+            if len(batch):
+                # lines that could not be parsed are reported with the
+                # next readings
+                batch.lost = batch.lost + lost
+                lost = 0
+                yield batch
+            else:
+                lost = lost + batch.lost
+
+
+def probe(port=DEFAULT_DEVICE,
+          bps=DEFAULT_DEVICE_SPEED_BPS,
+          interval=DEFAULT_INTERVAL,
+          timeout=DEFAULT_PROBE_TIMEOUT):
+    """ Attach to every energino matching port, probing in parallel. """
+
+    devs = find_devices(port)
+    energinos = [None] * len(devs)
+
+    def attach(index):
+        """ Attach to a single device. """
+        try:
+            energinos[index] = PyEnergino(devs[index], bps, interval, timeout)
+        except Exception as ex:
+            logging.debug("unable to attach to %s: %s", devs[index], ex)
+
+    threads = [threading.Thread(target=attach, args=(index,))
+               for index in range(len(devs))]
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    return [energino for energino in energinos if energino]
+
 
 def main():
     """ Launcher method. """
@@ -303,12 +569,77 @@ def main():
                       dest="verbose",
                       default=False)
 
+    parser.add_option('--all', '-a',
+                      dest="all",
+                      action="store_true",
+                      default=False)
+
     parser.add_option('--log', '-l', dest="log")
 
     parser.add_option('--csv', '-c', dest="csv")
 
+    parser.add_option('--store', '-d', dest="store")
+
+    parser.add_option('--store-compression',
+                      dest="store_compression",
+                      action="append",
+                      default=[],
+                      metavar="STREAM:METHOD:TOLERANCE",
+                      help="lossy compression of the raw samples of the "
+                           "store, rollups and recordings keep every sample")
+
+    parser.add_option('--record', '-w',
+                      dest="record",
+                      help="record to PREFIX-<port>-<time>.enr files")
+
+    parser.add_option('--rotate-bytes',
+                      dest="rotate_bytes",
+                      type="int",
+                      default=DEFAULT_ROTATE_BYTES)
+
+    parser.add_option('--rotate-seconds',
+                      dest="rotate_seconds",
+                      type="int",
+                      default=DEFAULT_ROTATE_SECONDS)
+
+    parser.add_option('--compress', '-z',
+                      dest="compress",
+                      type="int",
+                      default=DEFAULT_LEVEL,
+                      help="zlib level of recordings, 0 to disable")
+
+    parser.add_option('--batch', '-B',
+                      dest="batch",
+                      action="store_true",
+                      default=False)
+
+    parser.add_option('--binary', '-x',
+                      dest="binary",
+                      action="store_true",
+                      default=False)
+
+    parser.add_option('--stream', '-S',
+                      dest="stream",
+                      action="store_true",
+                      default=False)
+
+    parser.add_option('--report', '-R',
+                      dest="report",
+                      type="int",
+                      default=10)
+
     options, _ = parser.parse_args()
     init = []
+    compression = {}
+
+    for spec in options.store_compression:
+        fields = spec.split(":")
+        if len(fields) != 3 or fields[1] not in METHODS:
+            parser.error("invalid store compression: %s" % spec)
+        try:
+            compression[fields[0]] = (fields[1], float(fields[2]))
+        except ValueError:
+            parser.error("invalid store compression: %s" % spec)
 
     if options.reset:
         init.append("#R")
@@ -331,29 +662,99 @@ def main():
                         filename=options.log,
                         filemode='w')
 
-    energino = PyEnergino(options.port, options.bps, options.interval)
+    if options.all:
+        from energino.fleet import PyEnerginoFleet
+        energino = PyEnerginoFleet(options.port,
+                                   options.bps,
+                                   options.interval,
+                                   options.batch)
+    else:
+        energino = PyEnergino(options.port, options.bps, options.interval)
+
     energino.send_cmds(init)
 
+    if options.binary:
+        energino.set_binary()
+
+    if options.stream:
+        monitor = StreamMonitor(options.report)
+
     lines = 0
 
     if options.csv:
         csv_file = open(options.csv, "w")
 
+    if options.store:
+        store = Store(options.store, compression=compression)
+
+    if options.record:
+        recorder = Recorder(options.record,
+                            options.rotate_bytes,
+                            options.rotate_seconds,
+                            options.compress)
+
+    if options.batch:
+        try:
+            for batch in energino.iter_batches():
+                logging.info("%s: %u readings", batch.port, len(batch))
+                if options.stream:
+                    monitor.update_batch(batch)
+                if options.store:
+                    store.add_batch(batch)
+                if options.record:
+                    recorder.add_batch(batch)
+                if options.csv:
+                    csv_file.write("".join(["%s\n" % ",".join([str(x)
+                                                               for x in line])
+                                            for line in batch.lines()]))
+                lines = lines + len(batch)
+                if options.lines and lines >= options.lines:
+                    break
+        except KeyboardInterrupt:
+            logging.debug("Bye!")
+        if options.csv:
+            csv_file.close()
+        if options.store:
+            store.close()
+        if options.record:
+            recorder.close()
+        if options.stream:
+            monitor.report()
+        return
+
     while True:
 
-        energino.ser.flushInput()
+        # streaming mode never discards buffered samples, and neither
+        # does binary mode: the framer would be left with half a frame
+        # and report the flushed frames as lost
+        if not options.all and not options.stream and not options.binary:
+            energino.ser.flushInput()
 
         try:
             readings, line, log = energino.fetch()
         except KeyboardInterrupt:
-            if options.csv:
-                csv_file.close()
             logging.debug("Bye!")
-            sys.exit()
-        except:
-            pass
+            break
+        except ValueError as ex:
+            logging.debug(ex)
+            if options.stream and not options.all:
+                monitor.invalid(energino.ser.port)
         else:
-            logging.info(log)
+            if options.stream and options.all:
+                # the fleet readers count the lines they could not parse
+                for reader in energino.readers:
+                    monitor.invalid_total(reader.energino.ser.port,
+                                          reader.lost)
+            if options.stream:
+                monitor.update(readings)
+            if options.store:
+                store.add(readings)
+            if options.record:
+                recorder.add(readings)
+            if options.all:
+                logging.info("%s %s", readings['port'], log)
+            else:
+                logging.info(log)
             if options.csv:
                 csv_file.write("%s\n" % ",".join([str(x) for x in line]))
             lines = lines + 1
@@ -363,5 +764,14 @@ def main():
     if options.csv:
         csv_file.close()
 
+    if options.store:
+        store.close()
+
+    if options.record:
+        recorder.close()
+
+    if options.stream:
+        monitor.report()
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013, Roberto Riggio
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the CREATE-NET nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY CREATE-NET ''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL CREATE-NET BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Fan-out of live readings to Server-Sent Events subscribers.
+
+The poller publishes every reading to the hub, which hands it to each
+subscriber interested in its port. Publishing never blocks: every
+subscriber has a bounded queue, and when a slow client lets it fill up
+the queue is coalesced to the latest reading of each port, so a client
+that cannot keep up sees fewer, but current, readings. Subscribers can
+also ask for at most one reading per interval and per port.
+"""
+
+from __future__ import absolute_import
+
+import json
+import threading
+
+from collections import deque
+
+from energino.clock import format_ns
+
+DEFAULT_QUEUE = 256
+DEFAULT_KEEPALIVE = 15
+
+NS_PER_MS = 1000000
+
+
+class Subscriber(object):
+    """ A client of the live stream, with its own bounded queue. """
+
+    def __init__(self, ports=None, streams=None, interval=0,
+                 size=DEFAULT_QUEUE):
+        self.ports = set(ports) if ports else None
+        self.streams = tuple(streams) if streams else None
+        self.interval = interval * NS_PER_MS
+        self.size = max(1, size)
+        self.queue = deque()
+        self.sent = {}
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)
+        self.closed = False
+        self.coalesced = 0
+        self.decimated = 0
+
+    def offer(self, port, ts, values):
+        """ Queue a reading unless filtered out, never blocks. """
+
+        if self.ports is not None and port not in self.ports:
+            return
+
+        if self.interval:
+            last = self.sent.get(port)
+            if last is not None and ts - last < self.interval:
+                self.decimated = self.decimated + 1
+                return
+            self.sent[port] = ts
+
+        if self.streams is not None:
+            values = dict((stream, values[stream]) for stream in self.streams
+                          if stream in values)
+
+        with self.ready:
+            if len(self.queue) >= self.size:
+                self.coalesce()
+            self.queue.append((port, ts, values))
+            self.ready.notify()
+
+    def coalesce(self):
+        """ Keep only the latest queued reading of each port. """
+
+        latest = {}
+        for item in self.queue:
+            latest[item[0]] = item
+
+        self.coalesced = self.coalesced + len(self.queue) - len(latest)
+        self.queue = deque(sorted(latest.values(), key=lambda item: item[1]))
+
+        # a single port, nothing to merge: drop the oldest
+        if len(self.queue) >= self.size:
+            self.queue.popleft()
+            self.coalesced = self.coalesced + 1
+
+    def get(self, timeout):
+        """ Return the queued readings, empty after timeout or if closed. """
+
+        with self.ready:
+            if not self.queue and not self.closed:
+                self.ready.wait(timeout)
+            items = list(self.queue)
+            self.queue.clear()
+
+        return items
+
+    def close(self):
+        """ Wake up and stop the client. """
+
+        with self.ready:
+            self.closed = True
+            self.ready.notify()
+
+
+class Hub(object):
+    """ Publish readings to every subscriber. """
+
+    def __init__(self, streams):
+        self.streams = tuple(streams)
+        self.lock = threading.Lock()
+        self.subscribers = []
+
+    def subscribe(self, subscriber):
+        """ Add a subscriber. """
+
+        with self.lock:
+            self.subscribers = self.subscribers + [subscriber]
+
+    def unsubscribe(self, subscriber):
+        """ Remove a subscriber. """
+
+        with self.lock:
+            self.subscribers = [other for other in self.subscribers
+                                if other is not subscriber]
+
+    def close(self):
+        """ Close every subscriber. """
+
+        for subscriber in self.subscribers:
+            subscriber.close()
+
+    def publish(self, readings):
+        """ Publish a reading. """
+
+        # copy on write, publishing does not take the lock
+        subscribers = self.subscribers
+
+        if not subscribers:
+            return
+
+        values = dict((stream, readings[stream]) for stream in self.streams
+                      if stream in readings)
+
+        for subscriber in subscribers:
+            subscriber.offer(readings['port'], readings['ts'], values)
+
+    def publish_batch(self, batch):
+        """ Publish every row of a batch. """
+
+        subscribers = self.subscribers
+
+        if not subscribers:
+            return
+
+        columns = [(stream, batch.columns[stream]) for stream in self.streams
+                   if stream in batch.columns]
+
+        for index in range(len(batch)):
+            values = dict((stream, column[index])
+                          for stream, column in columns)
+            for subscriber in subscribers:
+                subscriber.offer(batch.port, batch.ts[index], values)
+
+
+def event(port, ts, values):
+    """ Return a reading as a Server-Sent Event. """
+
+    data = dict(values)
+    data['port'] = port
+    data['at'] = format_ns(ts)
+
+    return "event: reading\nid: %u\ndata: %s\n\n" % (ts, json.dumps(data))
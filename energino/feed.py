@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013, Roberto Riggio
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the CREATE-NET nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY CREATE-NET ''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL CREATE-NET BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Streaming encoders for Xively feed updates.
+
+The encoders read datapoints straight from a ring buffer or spool view
+and yield the document in chunks, instead of building a dictionary per
+datapoint and serializing the whole feed at once. The JSON encoder
+produces exactly what json.dumps() returns for the feed dictionary the
+dispatcher used to build: the feed and datastream dictionaries are
+updated in place as the dispatcher did, so that keys come out in the
+same order, and integer streams keep an integer current_value. The CSV
+encoder produces Xively's "stream,timestamp,value" format, which
+carries no metadata.
+
+NaN values are gaps left by compression and are not sent; a datastream
+without values in an update is left out of it.
+"""
+
+from __future__ import absolute_import
+
+import json
+
+FORMAT_JSON = 'json'
+FORMAT_CSV = 'csv'
+
+FORMATS = (FORMAT_JSON, FORMAT_CSV)
+
+CONTENT_TYPES = {FORMAT_JSON : 'application/json',
+                 FORMAT_CSV : 'text/csv'}
+
+DEFAULT_CHUNK_SIZE = 16384
+
+# datapoints formatted per join, bounds the size of intermediate lists
+BLOCK_ROWS = 256
+
+# json.dumps() follows the dict iteration order, which in py2 is not
+# the insertion order
+if list({'at' : None, 'value' : None})[0] == 'at':
+    DATAPOINT = '{"at": "%s", "value": "%.3f"}'
+    AT_FIRST = True
+else:
+    DATAPOINT = '{"value": "%.3f", "at": "%s"}'
+    AT_FIRST = False
+
+
+def iter_blocks(ats, values):
+    """ Yield lists of (at, value) pairs of at most BLOCK_ROWS items. """
+
+    block = []
+
+    for pair in zip(ats, values):
+        # NaN, dropped by compression
+        if pair[1] != pair[1]:
+            continue
+        block.append(pair)
+        if len(block) == BLOCK_ROWS:
+            yield block
+            block = []
+
+    if block:
+        yield block
+
+
+def encode_datapoints(ats, values):
+    """ Yield the datapoints array of a datastream. """
+
+    yield '['
+    separator = ''
+
+    for block in iter_blocks(ats, values):
+        if AT_FIRST:
+            points = [DATAPOINT % (at, value) for at, value in block]
+        else:
+            points = [DATAPOINT % (value, at) for at, value in block]
+        yield separator + ', '.join(points)
+        separator = ', '
+
+    yield ']'
+
+
+def last_value(view, name):
+    """ Return the last value of a column which is not NaN, or None. """
+
+    last = view.last(name)
+
+    if last == last:
+        return last
+
+    last = None
+
+    for value in view.iter_column(name):
+        if value == value:
+            last = value
+
+    return last
+
+
+def encode_stream(stream, current, ats, view):
+    """ Yield a datastream object with its datapoints. """
+
+    stream['current_value'] = current
+
+    yield '{'
+    separator = ''
+
+    for key, value in stream.items():
+        yield separator + json.dumps(key) + ': '
+        if key == 'datapoints':
+            values = view.iter_column(stream['id'])
+            for chunk in encode_datapoints(ats, values):
+                yield chunk
+        else:
+            yield json.dumps(value)
+        separator = ', '
+
+    yield '}'
+
+
+def encode_json(feed, streams, ats, view, integers=()):
+    """ Yield the JSON feed document, datapoints coming from view.
+
+    ats holds the formatted timestamps of the rows in view, integers the
+    ids of the datastreams with integer values. feed and streams are
+    updated in place.
+    """
+
+    feed['datastreams'] = None
+
+    currents = [(stream, last_value(view, stream['id'])) for stream in streams]
+    currents = [(stream, int(current) if stream['id'] in integers
+                 else current)
+                for stream, current in currents if current is not None]
+
+    yield '{'
+    separator = ''
+
+    for key, value in feed.items():
+        yield separator + json.dumps(key) + ': '
+        if key == 'datastreams':
+            yield '['
+            for index, (stream, current) in enumerate(currents):
+                if index:
+                    yield ', '
+                for chunk in encode_stream(stream, current, ats, view):
+                    yield chunk
+            yield ']'
+        else:
+            yield json.dumps(value)
+        separator = ', '
+
+    yield '}'
+
+
+def encode_csv(names, ats, view):
+    """ Yield the CSV feed document, one line per datapoint. """
+
+    for name in names:
+        for block in iter_blocks(ats, view.iter_column(name)):
+            yield ''.join(["%s,%s,%.3f\n" % (name, at, value)
+                           for at, value in block])
+
+
+def chunks(pieces, size=DEFAULT_CHUNK_SIZE):
+    """ Coalesce the pieces yielded by an encoder in chunks of ~size. """
+
+    buf = []
+    length = 0
+
+    for piece in pieces:
+        buf.append(piece)
+        length = length + len(piece)
+        if length >= size:
+            yield ''.join(buf)
+            buf = []
+            length = 0
+
+    if buf:
+        yield ''.join(buf)
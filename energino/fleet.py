@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013, Roberto Riggio
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the CREATE-NET nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY CREATE-NET ''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL CREATE-NET BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Concurrent acquisition from a fleet of energino devices.
+"""
+
+from __future__ import absolute_import
+
+import logging
+import threading
+import Queue
+
+from energino.energino import probe
+from energino.energino import DEFAULT_INTERVAL
+from energino.energino import DEFAULT_DEVICE
+from energino.energino import DEFAULT_DEVICE_SPEED_BPS
+
+# readings (or batches) waiting for fetch(), readers block when full
+QUEUE_SIZE = 10000
+
+# seconds to wait for a reader, a silent device never returns
+JOIN_TIMEOUT = 5.0
+
+
+class FleetReader(threading.Thread):
+    """ Reads one energino and forwards its readings to the fleet. """
+
+    def __init__(self, energino, fleet):
+        super(FleetReader, self).__init__()
+        self.daemon = True
+        self.energino = energino
+        self.fleet = fleet
+        self.samples = 0
+        self.lost = 0
+
+    def run(self):
+        port = self.energino.ser.port
+        logging.info("starting reader on %s", port)
+        while not self.fleet.stop.isSet():
+            try:
+                if self.fleet.batch:
+                    readings = self.energino.fetch_many()
+                    if not len(readings):
+                        continue
+                else:
+                    readings = self.energino.fetch()
+            except ValueError:
+                self.lost = self.lost + 1
+                logging.warning("sample lost on %s", port)
+                continue
+            except Exception as ex:
+                logging.exception(ex)
+                break
+            if self.fleet.batch:
+                self.samples = self.samples + len(readings)
+            else:
+                self.samples = self.samples + 1
+            self.fleet.put(readings)
+        logging.info("reader on %s stopped", port)
+
+
+class PyEnerginoFleet(object):
+    """ A set of energinos read concurrently, one worker per device.
+
+    Readings from every device are merged into a single stream, fetch()
+    returns them in arrival order tagged with readings['port']. In batch
+    mode the readers forward whole batches, returned by fetch_many().
+    """
+
+    def __init__(self,
+                 port=DEFAULT_DEVICE,
+                 bps=DEFAULT_DEVICE_SPEED_BPS,
+                 interval=DEFAULT_INTERVAL,
+                 batch=False):
+
+        self.interval = interval
+        self.batch = batch
+        self.stop = threading.Event()
+        self.readings = Queue.Queue(QUEUE_SIZE)
+        self.readers = []
+
+        for energino in probe(port, bps, interval):
+            self.readers.append(FleetReader(energino, self))
+
+        if not self.readers:
+            raise RuntimeError("unable to configure serial port")
+
+    @property
+    def energinos(self):
+        """ Return the attached energinos. """
+
+        return [reader.energino for reader in self.readers]
+
+    def send_cmds(self, cmds):
+        """ Send command list to every device in parallel. """
+
+        threads = [threading.Thread(target=energino.send_cmds, args=(cmds,))
+                   for energino in self.energinos]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+    def set_binary(self, binary=True):
+        """ Switch every device to binary frames, or back to text lines. """
+
+        for energino in self.energinos:
+            energino.set_binary(binary)
+
+    def start(self):
+        """ Start one reader per device. """
+
+        for reader in self.readers:
+            # a thread can only be started once
+            if reader.ident is None:
+                reader.start()
+
+    def put(self, readings):
+        """ Queue readings for fetch(), waiting while the queue is full. """
+
+        while not self.stop.isSet():
+            try:
+                self.readings.put(readings, timeout=1.0)
+                return
+            except Queue.Full:
+                continue
+
+    def shutdown(self):
+        """ Stop the readers and wait for them to exit. """
+
+        self.stop.set()
+
+        for reader in self.readers:
+            if reader.is_alive():
+                reader.join(JOIN_TIMEOUT)
+            if reader.is_alive():
+                logging.warning("reader on %s still running",
+                                reader.energino.ser.port)
+
+    def fetch(self, timeout=None):
+        """ Return the next reading from any device. """
+
+        self.start()
+
+        # a blocking get() cannot be interrupted by SIGINT, so poll
+        while True:
+            try:
+                return self.readings.get(timeout=timeout or 1.0)
+            except Queue.Empty:
+                if timeout is not None:
+                    raise ValueError("no readings within %ss" % timeout)
+                if self.stop.isSet():
+                    raise RuntimeError("fleet has been shut down")
+
+    def fetch_many(self, timeout=None):
+        """ Return the next batch from any device. """
+
+        return self.fetch(timeout)
+
+    def iter_batches(self):
+        """ Yield batches from every device as they are received. """
+
+        while True:
+            yield self.fetch_many()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013, Roberto Riggio
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the CREATE-NET nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY CREATE-NET ''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL CREATE-NET BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Binary status frames.
+
+Once switched to binary mode with #M1 the sketch sends fixed-width
+little endian frames instead of text lines:
+
+    sync (0xAA 0x55), seq, voltage, current, power, relay, period,
+    samples, v_error, i_error, crc
+
+The CRC-16/CCITT covers every byte between sync and crc. Corrupted
+frames and gaps in the sequence number are counted by the FrameSplitter.
+"""
+
+from __future__ import absolute_import
+
+import binascii
+import logging
+import struct
+
+from energino.parser import LogLine
+
+FRAME_SYNC = '\xaa\x55'
+FRAME = struct.Struct('<HfffBHHHHH')
+FRAME_SIZE = len(FRAME_SYNC) + FRAME.size
+CRC = struct.Struct('<H')
+
+
+class FrameSplitter(object):
+    """ Split a serial byte stream into binary frames.
+
+    Bytes that do not belong to a valid frame are skipped, the partial
+    frame at the end of the data is kept for the next call.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.seq = None
+        self.frames = 0
+        self.crc_errors = 0
+        self.lost = 0
+
+    def split(self, data):
+        """ Return the valid frames received so far as tuples. """
+
+        self.buffer.extend(data)
+        frames = []
+        start = 0
+
+        while True:
+
+            index = self.buffer.find(FRAME_SYNC, start)
+
+            if index < 0:
+                # the last byte may be the beginning of a sync sequence
+                start = max(start, len(self.buffer) - 1)
+                break
+
+            if len(self.buffer) - index < FRAME_SIZE:
+                start = index
+                break
+
+            frame = str(self.buffer[index + 2:index + FRAME_SIZE])
+
+            if binascii.crc_hqx(frame[:-2], 0xFFFF) != \
+               CRC.unpack(frame[-2:])[0]:
+                self.crc_errors = self.crc_errors + 1
+                logging.warning("corrupted frame")
+                start = index + 1
+                continue
+
+            fields = FRAME.unpack(frame)
+
+            if self.seq is not None:
+                gap = (fields[0] - self.seq - 1) & 0xFFFF
+                if gap:
+                    self.lost = self.lost + gap
+                    logging.warning("%u frames lost", gap)
+
+            self.seq = fields[0]
+            self.frames = self.frames + 1
+            frames.append(fields)
+            start = index + FRAME_SIZE
+
+        del self.buffer[:start]
+
+        return frames
+
+
+class FrameDecoder(object):
+    """ Decode binary frames into readings of the given schema.
+
+    The schema fields must follow the frame layout, sequence number
+    first, so that readings and batches look like the text ones.
+    """
+
+    binary = True
+
+    def __init__(self, schema):
+        self.schema = schema
+        self.fields = schema.fields
+        self.reading = schema.reading
+        self.indexes = tuple(self.fields.index(value)
+                             for value in schema.values)
+
+    def framer(self):
+        """ Return a new splitter for this decoder. """
+
+        return FrameSplitter()
+
+    def batch(self):
+        """ Return an empty batch for this decoder. """
+
+        return self.schema.batch()
+
+    def unpack(self, frame):
+        """ Unpack a frame returned by FrameSplitter.split(). """
+
+        readings = self.reading(*frame[:-1])
+        line = tuple(frame[index] for index in self.indexes)
+
+        return readings, line, LogLine(readings)
+
+    def unpack_many(self, frames, batch):
+        """ Append frames to batch, return the number of frames lost. """
+
+        for index, field in enumerate(self.fields):
+            batch.columns[field].extend([frame[index] for frame in frames])
+
+        return 0
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013, Roberto Riggio
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the CREATE-NET nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY CREATE-NET ''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL CREATE-NET BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Pool of persistent HTTP/1.1 connections.
+
+Connections are kept open after a response has been fully read and are
+handed out again for the next request, so periodic uploads do not pay a
+DNS lookup and a TCP handshake each time. Connections idle for longer
+than the idle timeout are closed, since servers drop them anyway. A
+request is retried on a new connection only when it provably did not
+reach the server: the reused connection had been closed by the server
+(a broken pipe or a reset while sending, no status line or a reset when
+reading the response). Any other error, such as a timeout once the body
+has been sent, is left to the caller, since the server may have acted
+on the request.
+"""
+
+from __future__ import absolute_import
+
+import time
+import errno
+import socket
+import httplib
+import logging
+import threading
+
+from collections import namedtuple
+
+DEFAULT_TIMEOUT = 10
+DEFAULT_POOL_SIZE = 2
+DEFAULT_IDLE = 30
+
+Response = namedtuple('Response', ['status', 'reason', 'headers', 'body'])
+
+# errors telling that the server had closed a reused connection
+CLOSED = (errno.EPIPE, errno.ECONNRESET, errno.ECONNABORTED)
+
+
+class Connection(httplib.HTTPConnection):
+    """ An HTTP connection sending small writes right away. """
+
+    def connect(self):
+        httplib.HTTPConnection.connect(self)
+        # headers and chunks are separate writes, Nagle would hold each
+        # one back until the server acknowledges the previous one
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+class HTTPPool(object):
+    """ Keep-alive connections to a single host. """
+
+    def __init__(self, host, port, timeout=DEFAULT_TIMEOUT,
+                 size=DEFAULT_POOL_SIZE, idle=DEFAULT_IDLE):
+
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.size = size
+        self.idle = idle
+        self.lock = threading.Lock()
+        self.connections = []
+        self.created = 0
+        self.reused = 0
+
+    def acquire(self):
+        """ Return an idle connection or a new one, and if it is new. """
+
+        now = time.time()
+
+        with self.lock:
+            while self.connections:
+                conn, last = self.connections.pop()
+                if now - last < self.idle:
+                    self.reused = self.reused + 1
+                    return conn, False
+                conn.close()
+            self.created = self.created + 1
+
+        logging.debug("opening connection to %s:%u", self.host, self.port)
+
+        conn = Connection(host=self.host,
+                          port=self.port,
+                          timeout=self.timeout)
+
+        return conn, True
+
+    def release(self, conn, reuse=True):
+        """ Return a connection to the pool, or close it. """
+
+        with self.lock:
+            if reuse and len(self.connections) < self.size:
+                self.connections.append((conn, time.time()))
+                return
+
+        conn.close()
+
+    def request(self, method, url, body=None, headers=None):
+        """ Send a request and return the fully read Response.
+
+        If body is callable it must return an iterable of strings, which
+        are sent with chunked transfer encoding.
+        """
+
+        while True:
+
+            conn, fresh = self.acquire()
+
+            try:
+                if callable(body):
+                    self.send_chunked(conn, method, url, body(), headers or {})
+                else:
+                    conn.request(method, url, body, headers or {})
+                resp = conn.getresponse()
+            except (httplib.HTTPException, socket.error) as ex:
+                conn.close()
+                if fresh or not self.stale(ex):
+                    raise
+                logging.debug("stale connection to %s:%u, retrying",
+                              self.host, self.port)
+                continue
+
+            try:
+                data = resp.read()
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                raise
+
+            self.release(conn, not resp.will_close)
+
+            return Response(resp.status, resp.reason, resp.getheaders(), data)
+
+    @staticmethod
+    def stale(ex):
+        """ Return True if ex shows the server had closed the connection.
+
+        A timeout is not enough, the request may have been received.
+        """
+
+        if isinstance(ex, httplib.BadStatusLine):
+            return True
+
+        if isinstance(ex, socket.timeout):
+            return False
+
+        return isinstance(ex, socket.error) and ex.errno in CLOSED
+
+    def send_chunked(self, conn, method, url, chunks, headers):
+        """ Send a request with a chunked body. """
+
+        conn.putrequest(method, url)
+
+        for header, value in headers.items():
+            conn.putheader(header, value)
+
+        conn.putheader('Transfer-Encoding', 'chunked')
+        conn.endheaders()
+
+        for chunk in chunks:
+            if chunk:
+                conn.send("%x\r\n%s\r\n" % (len(chunk), chunk))
+
+        conn.send("0\r\n\r\n")
+
+    def close(self):
+        """ Close every idle connection. """
+
+        with self.lock:
+            connections = self.connections
+            self.connections = []
+
+        for conn, _ in connections:
+            conn.close()
@@ -0,0 +1,337 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013, Roberto Riggio
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the CREATE-NET nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY CREATE-NET ''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL CREATE-NET BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Counters, gauges and histograms in the Prometheus text format.
+
+Metrics are created through a Registry, which renders all of them for
+the /metrics endpoint served by MetricsServer. Values kept elsewhere
+(e.g. the counters of the devices, or the depth of a queue) are copied
+into their metric by collectors, called by the registry right before
+rendering. Labels are given as keyword arguments:
+
+    lost = registry.counter("energino_samples_lost_total",
+                            "Samples lost.", ("port",))
+    lost.inc(port="/dev/ttyACM0")
+"""
+
+from __future__ import absolute_import
+
+import bisect
+import socket
+import logging
+import threading
+import SocketServer
+import BaseHTTPServer
+
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+INF = float('inf')
+
+
+def format_value(value):
+    """ Format a sample value. """
+
+    if value == INF:
+        return "+Inf"
+
+    if value == -INF:
+        return "-Inf"
+
+    return repr(float(value))
+
+
+def escape(value):
+    """ Escape a label value. """
+
+    return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+                     .replace('\n', '\\n')
+
+
+def parse_listen(listen):
+    """ Return the (address, port) of a "[address:]port" string. """
+
+    address, _, port = listen.rpartition(':')
+
+    return address, int(port)
+
+
+class Metric(object):
+    """ A metric, with one value per combination of labels. """
+
+    kind = None
+
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+        # without labels there is a single value, exported from the start
+        if not self.labels:
+            self.values[()] = self.zero()
+
+    def zero(self):
+        """ Return the initial value. """
+
+        return 0
+
+    def key(self, labels):
+        """ Return the label values, in order. """
+
+        if len(labels) != len(self.labels):
+            raise ValueError("%s takes labels %s" % (self.name,
+                                                     ", ".join(self.labels)))
+
+        return tuple(labels[label] for label in self.labels)
+
+    def selector(self, key, extra=()):
+        """ Return the {label="value",...} part of a sample. """
+
+        pairs = list(zip(self.labels, key)) + list(extra)
+
+        if not pairs:
+            return ""
+
+        return "{%s}" % ",".join('%s="%s"' % (label, escape(value))
+                                 for label, value in pairs)
+
+    def samples(self):
+        """ Return the (suffix, selector, value) of every sample. """
+
+        with self.lock:
+            values = sorted(self.values.items())
+
+        return [("", self.selector(key), value) for key, value in values]
+
+    def render(self):
+        """ Return the metric in the text format. """
+
+        lines = ["# HELP %s %s" % (self.name, self.doc),
+                 "# TYPE %s %s" % (self.name, self.kind)]
+
+        for suffix, selector, value in self.samples():
+            lines.append("%s%s%s %s" % (self.name, suffix, selector,
+                                        format_value(value)))
+
+        return "\n".join(lines) + "\n"
+
+
+class Counter(Metric):
+    """ A monotonic total. """
+
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        """ Add amount to the total. """
+
+        key = self.key(labels)
+
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def set(self, value, **labels):
+        """ Set the total, for totals counted elsewhere. """
+
+        key = self.key(labels)
+
+        with self.lock:
+            self.values[key] = value
+
+
+class Gauge(Counter):
+    """ A value that can go up and down. """
+
+    kind = "gauge"
+
+
+class Histogram(Metric):
+    """ Counts of observations by upper bound, with their sum. """
+
+    kind = "histogram"
+
+    def __init__(self, name, doc, buckets, labels=()):
+        self.buckets = tuple(sorted(buckets))
+        super(Histogram, self).__init__(name, doc, labels)
+
+    def zero(self):
+        """ Return the counts, one per bucket then +Inf, and the sum. """
+
+        return [0] * (len(self.buckets) + 2)
+
+    def observe(self, value, **labels):
+        """ Record an observation. """
+
+        key = self.key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = self.zero()
+            counts[index] = counts[index] + 1
+            counts[-1] = counts[-1] + value
+
+    def samples(self):
+
+        with self.lock:
+            values = sorted((key, list(counts))
+                            for key, counts in self.values.items())
+
+        samples = []
+
+        for key, counts in values:
+            total = 0
+            for bound, count in zip(self.buckets + (INF,), counts):
+                total = total + count
+                selector = self.selector(key, [('le', format_value(bound))])
+                samples.append(("_bucket", selector, total))
+            samples.append(("_sum", self.selector(key), counts[-1]))
+            samples.append(("_count", self.selector(key), total))
+
+        return samples
+
+
+class Registry(object):
+    """ The metrics exported by a process. """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = []
+        self.collectors = []
+
+    def register(self, metric):
+        """ Add a metric, return it. """
+
+        with self.lock:
+            if any(other.name == metric.name for other in self.metrics):
+                raise ValueError("duplicate metric %s" % metric.name)
+            self.metrics.append(metric)
+
+        return metric
+
+    def counter(self, name, doc, labels=()):
+        """ Return a new counter. """
+
+        return self.register(Counter(name, doc, labels))
+
+    def gauge(self, name, doc, labels=()):
+        """ Return a new gauge. """
+
+        return self.register(Gauge(name, doc, labels))
+
+    def histogram(self, name, doc, buckets, labels=()):
+        """ Return a new histogram. """
+
+        return self.register(Histogram(name, doc, buckets, labels))
+
+    def collect(self, collector):
+        """ Call collector before every rendering. """
+
+        with self.lock:
+            self.collectors.append(collector)
+
+    def render(self):
+        """ Return every metric in the text format. """
+
+        with self.lock:
+            collectors = list(self.collectors)
+            metrics = list(self.metrics)
+
+        for collector in collectors:
+            try:
+                collector()
+            except Exception as ex:
+                logging.exception(ex)
+
+        return "".join(metric.render() for metric in metrics)
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Serve the registry on /metrics. """
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        """ Render the metrics. """
+
+        if self.path.split('?')[0] != "/metrics":
+            self.send_error(404)
+            return
+
+        body = self.server.registry.render()
+
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle(self):
+        try:
+            BaseHTTPServer.BaseHTTPRequestHandler.handle(self)
+        except socket.error:
+            # the scraper went away before the reply was flushed
+            pass
+
+    def finish(self):
+        try:
+            BaseHTTPServer.BaseHTTPRequestHandler.finish(self)
+        except socket.error:
+            pass
+
+    def log_message(self, fmt, *args):
+        logging.debug("%s %s", self.client_address[0], fmt % args)
+
+
+class MetricsServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ HTTP server for the metrics, running in a background thread. """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, registry):
+        BaseHTTPServer.HTTPServer.__init__(self, address, MetricsHandler)
+        self.registry = registry
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+
+    def start(self):
+        """ Start serving. """
+
+        logging.info("metrics on http://%s:%u/metrics",
+                     self.server_address[0], self.server_address[1])
+
+        self.thread.start()
+
+    def stop(self):
+        """ Stop serving and close the socket. """
+
+        if self.thread.is_alive():
+            self.shutdown()
+
+        self.server_close()
@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013, Roberto Riggio
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the CREATE-NET nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY CREATE-NET ''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL CREATE-NET BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Sample loss and clock drift accounting for continuous streams.
+
+Lost samples are counted exactly from the sequence number of binary
+frames. Text lines carry no counter, so every sample is checked against
+the time it was received: the device timeline (the sum of the windows)
+plus the least delayed arrival seen so far tells when a sample should
+have arrived at the earliest. A sample arriving whole windows later
+means samples went missing, unless the stream catches up again within
+a short while, as it does after a USB burst or a stall. Invalid lines
+are lost samples too. Drift is how far the least delayed arrival moved
+relative to the device timeline.
+
+Energy only accounts for the samples received, gaps are reported as
+lost samples and are not filled in.
+"""
+
+from __future__ import absolute_import
+
+import logging
+import time
+
+from energino.clock import NS_PER_MS
+from energino.clock import NS_PER_S
+
+# an arrival this many windows behind the device timeline may be a gap
+GAP_WINDOWS = 0.5
+
+# a gap is confirmed once it lasted this long (in ns, or windows if
+# longer) without the stream catching up, the least delayed arrival of
+# such a period follows the drift
+CONFIRM = NS_PER_S
+CONFIRM_WINDOWS = 5
+
+MS_PER_HOUR = 3600 * 1000.0
+
+
+class PortMonitor(object):
+    """ Loss, drift and energy accounting for a single device. """
+
+    def __init__(self, port):
+        self.port = port
+        self.received = 0
+        self.lost = 0
+        self.invalid = 0
+        self.unplaced = 0
+        self.seq = None
+        self.device = None
+        self.first = None
+        self.offset = None
+        self.epoch = None
+        self.lowest = 0
+        self.pending = None
+        self.low = 0
+        self.energy = 0.0
+
+    def update(self, host, window, power, seq=None):
+        """ Account for a sample received at host (in ns). """
+
+        step = int(window) * NS_PER_MS
+
+        if self.device is None:
+            self.device = 0
+            self.first = host
+            self.offset = host
+            self.epoch = host
+        elif seq is not None and self.seq is not None:
+            missing = (seq - self.seq - 1) & 0xFFFF
+            self.lost = self.lost + missing
+            self.device = self.device + (missing + 1) * step
+        else:
+            self.device = self.device + step
+
+        self.energy = self.energy + power * window / MS_PER_HOUR
+        self.received = self.received + 1
+        self.seq = seq
+
+        excess = host - self.device - self.offset
+
+        if excess < 0:
+            # the least delayed arrival so far
+            self.offset = self.offset + excess
+            self.lowest = self.lowest - excess
+            self.low = self.low - excess
+            excess = 0
+
+        self.lowest = min(self.lowest, excess)
+
+        if seq is None and step > 0:
+            self.check(host, excess, step)
+
+        if self.pending is None and \
+           host - self.epoch >= max(CONFIRM, CONFIRM_WINDOWS * step):
+            self.offset = self.offset + self.lowest
+            self.lowest = excess - self.lowest
+            self.epoch = host
+            # invalid lines that never showed up as a gap
+            self.unplaced = 0
+
+    def check(self, host, excess, step):
+        """ Look for a gap in the device timeline at a text sample. """
+
+        if excess < GAP_WINDOWS * step:
+            # caught up, it was a delay
+            self.pending = None
+            return
+
+        if self.pending is None:
+            self.pending = host
+            self.low = excess
+            return
+
+        self.low = min(self.low, excess)
+
+        if host - self.pending < max(CONFIRM, CONFIRM_WINDOWS * step):
+            return
+
+        missing = int(self.low / step + 0.5)
+        placed = min(missing, self.unplaced)
+
+        # invalid lines were counted already
+        self.lost = self.lost + missing - placed
+        self.unplaced = self.unplaced - placed
+        self.device = self.device + missing * step
+        # what is left is drift, as when an epoch ends
+        self.offset = self.offset + self.low - missing * step
+        self.lowest = excess - self.low
+        self.pending = None
+        self.epoch = host
+
+    def add_invalid(self, count=1):
+        """ Account for lines or frames that could not be parsed. """
+
+        self.invalid = self.invalid + count
+
+        # sequence numbers account for invalid frames
+        if self.seq is None:
+            self.lost = self.lost + count
+            self.unplaced = self.unplaced + count
+
+    @property
+    def loss_rate(self):
+        """ Return the fraction of samples lost. """
+
+        total = self.received + self.lost
+
+        if not total:
+            return 0.0
+
+        return float(self.lost) / total
+
+    @property
+    def drift(self):
+        """ Return the host clock drift relative to the device clock. """
+
+        if not self.device:
+            return 0.0
+
+        return float(self.offset - self.first) / self.device
+
+    def report(self):
+        """ Log the current counters. """
+
+        logging.info("%s: %u samples, %u lost (%.2f%%), %u invalid, "
+                     "drift %+.3f%%, %.4f Wh",
+                     self.port,
+                     self.received,
+                     self.lost,
+                     self.loss_rate * 100,
+                     self.invalid,
+                     self.drift * 100,
+                     self.energy)
+
+
+class StreamMonitor(object):
+    """ Loss and drift accounting for a set of devices.
+
+    A report is logged every period seconds (never if period is 0).
+    """
+
+    def __init__(self, period=10):
+        self.period = period
+        self.ports = {}
+        self.totals = {}
+        self.reported = time.time()
+
+    def get(self, port):
+        """ Return the monitor for port. """
+
+        if port not in self.ports:
+            self.ports[port] = PortMonitor(port)
+
+        return self.ports[port]
+
+    def update(self, readings, now=None):
+        """ Account for a single reading. """
+
+        if now is None:
+            now = time.time()
+
+        self.get(readings['port']).update(readings['received'],
+                                          readings['window'],
+                                          readings['power'],
+                                          readings.get('seq'))
+        self.tick(now)
+
+    def update_batch(self, batch):
+        """ Account for a batch of readings. """
+
+        monitor = self.get(batch.port)
+
+        if batch.lost:
+            monitor.add_invalid(batch.lost)
+
+        if 'seq' in batch.columns:
+            seqs = batch.columns['seq']
+        else:
+            seqs = [None] * len(batch)
+
+        # rows read together were received together
+        for window, power, seq in zip(batch.window, batch.power, seqs):
+            monitor.update(batch.received, window, power, seq)
+
+        if len(batch):
+            self.tick(time.time())
+
+    def invalid(self, port, count=1):
+        """ Account for lines that could not be parsed. """
+
+        self.get(port).add_invalid(count)
+
+    def invalid_total(self, port, total):
+        """ Account for the invalid lines counted so far by a reader. """
+
+        count = total - self.totals.get(port, 0)
+        self.totals[port] = total
+
+        if count > 0:
+            self.invalid(port, count)
+
+    def tick(self, now):
+        """ Log a report if the period expired. """
+
+        if self.period and now - self.reported >= self.period:
+            self.report()
+            self.reported = now
+
+    def report(self):
+        """ Log the counters of every device. """
+
+        for port in sorted(self.ports):
+            self.ports[port].report()
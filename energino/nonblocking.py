@@ -0,0 +1,331 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013, Roberto Riggio
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the CREATE-NET nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY CREATE-NET ''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL CREATE-NET BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Non-blocking interface to the energino power consumption monitor.
+
+Devices are asyncore dispatchers, so a single loop() can serve many
+devices alongside any other asyncore channel (e.g. an HTTP server)
+without a thread per blocking call. Python 2 has no asyncio, asyncore
+is the standard library event loop available here.
+
+AsyncFleet wraps the devices in the backend interface of the daemons:
+one thread runs the loop for every device, fetch() returns the readings
+in arrival order.
+"""
+
+from __future__ import absolute_import
+
+import asyncore
+import logging
+import serial
+import threading
+import time
+import Queue
+
+from collections import deque
+
+from energino.energino import identify
+from energino.energino import annotate
+from energino.energino import find_devices
+from energino.clock import DeviceClock
+from energino.energino import DEFAULT_INTERVAL
+from energino.energino import DEFAULT_DEVICE
+from energino.energino import DEFAULT_DEVICE_SPEED_BPS
+from energino.energino import DEFAULT_PROBE_TIMEOUT
+
+READ_SIZE = 4096
+MAX_ATTEMPTS = 5
+
+# readings waiting for fetch(), the loop stops reading beyond this
+QUEUE_SIZE = 10000
+
+
+class AsyncPyEnergino(asyncore.file_dispatcher):
+    """ Non-blocking energino.
+
+    Readings are queued as they arrive and returned by fetch() or by
+    iterating over the device. If a callback is set, it is invoked with
+    every (readings, line, log) tuple instead.
+    """
+
+    def __init__(self,
+                 port=DEFAULT_DEVICE,
+                 bps=DEFAULT_DEVICE_SPEED_BPS,
+                 interval=DEFAULT_INTERVAL,
+                 callback=None,
+                 channels=None):
+
+        devs = find_devices(port)
+
+        if not devs:
+            raise RuntimeError("unable to configure serial port")
+
+        self.ser = serial.Serial(port=devs[0],
+                                 baudrate=bps,
+                                 parity=serial.PARITY_NONE,
+                                 stopbits=serial.STOPBITS_ONE,
+                                 bytesize=serial.EIGHTBITS,
+                                 timeout=0)
+
+        asyncore.file_dispatcher.__init__(self, self.ser.fileno(), channels)
+
+        self.port = devs[0]
+        self.interval = interval
+        self.callback = callback
+        self.schema = None
+        self.unpack = None
+        self.attempts = 0
+        self.incoming = ''
+        self.outgoing = ''
+        self.commands = deque()
+        self.readings = deque()
+        self.clock = DeviceClock()
+        self.parsed = 0
+        self.errors = 0
+        self.lost = 0
+
+    def __iter__(self):
+        while self.readings:
+            yield self.readings.popleft()
+
+    def fetch(self):
+        """ Return the next reading, or None if none is available. """
+
+        if self.readings:
+            return self.readings.popleft()
+
+        return None
+
+    def send_cmd(self, cmd):
+        """ Queue command for the serial port. """
+
+        self.commands.append(cmd)
+
+    def send_cmds(self, cmds):
+        """ Queue command list for the serial port. """
+
+        for cmd in cmds:
+            self.send_cmd(cmd)
+
+    def next_cmd(self):
+        """ Move next command to the output buffer.
+
+        Commands are paced by the device: one is sent for every line
+        received once the sketch is up, so none is lost while the board
+        is still in its bootloader.
+        """
+
+        if self.unpack and self.commands:
+            cmd = self.commands.popleft()
+            logging.debug("sending initialization sequence %s", cmd)
+            self.outgoing += cmd + '\n'
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return len(self.outgoing) > 0
+
+    def handle_read(self):
+        self.incoming += self.recv(READ_SIZE)
+        lines = self.incoming.split('\n')
+        self.incoming = lines.pop()
+        for line in lines:
+            self.handle_line(line + '\n')
+
+    def handle_write(self):
+        sent = self.send(self.outgoing)
+        self.outgoing = self.outgoing[sent:]
+
+    def handle_line(self, line):
+        """ Process a complete line from the serial port. """
+
+        if self.unpack is None:
+            self.schema = identify(line)
+            if self.schema is None:
+                self.attempts = self.attempts + 1
+                if self.attempts >= MAX_ATTEMPTS:
+                    logging.error("unable to identify model on %s", self.port)
+                    self.close()
+                return
+            self.unpack = self.schema.unpack
+            logging.debug("attaching to port %s!", self.port)
+
+        self.next_cmd()
+
+        if line[0] != "#":
+            logging.debug("line: %s", line.replace('\n', ''))
+            return
+
+        try:
+            readings, line, log = self.unpack(line)
+        except ValueError:
+            logging.warning("sample lost on %s", self.port)
+            self.errors = self.errors + 1
+            self.lost = self.lost + 1
+            return
+
+        self.parsed = self.parsed + 1
+
+        annotate(readings, self.port, self.interval, self.clock)
+
+        if self.callback:
+            self.callback((readings, line, log))
+        else:
+            self.readings.append((readings, line, log))
+
+    def handle_close(self):
+        self.close()
+
+    def close(self):
+        logging.info("closing %s", self.port)
+        asyncore.file_dispatcher.close(self)
+        self.ser.close()
+
+
+def attach_all(port=DEFAULT_DEVICE,
+               bps=DEFAULT_DEVICE_SPEED_BPS,
+               interval=DEFAULT_INTERVAL,
+               callback=None,
+               channels=None):
+    """ Return an AsyncPyEnergino for every device matching port. """
+
+    return [AsyncPyEnergino(dev, bps, interval, callback, channels)
+            for dev in find_devices(port)]
+
+
+def loop(timeout=1.0, count=None, channels=None):
+    """ Run the event loop serving every attached device. """
+
+    asyncore.loop(timeout=timeout, use_poll=True, map=channels, count=count)
+
+
+class AsyncFleet(object):
+    """ A set of energinos served by a single event loop thread.
+
+    Same interface as PyEnerginoFleet in text mode: fetch() returns the
+    readings of every device in arrival order, tagged with
+    readings['port'].
+    """
+
+    def __init__(self,
+                 port=DEFAULT_DEVICE,
+                 bps=DEFAULT_DEVICE_SPEED_BPS,
+                 interval=DEFAULT_INTERVAL,
+                 timeout=DEFAULT_PROBE_TIMEOUT):
+
+        self.interval = interval
+        self.stop = threading.Event()
+        self.readings = Queue.Queue(QUEUE_SIZE)
+        self.channels = {}
+        self.thread = None
+
+        devices = attach_all(port, bps, interval, self.put, self.channels)
+
+        # wait for the first status line of every device, the ones that
+        # cannot be identified close themselves
+        deadline = time.time() + timeout
+        while self.channels and time.time() < deadline and \
+                any(device.unpack is None
+                    for device in self.channels.values()):
+            loop(timeout=0.1, count=1, channels=self.channels)
+
+        self.devices = [device for device in devices if device.unpack]
+
+        for device in devices:
+            if device.unpack is None and device.ser.isOpen():
+                device.close()
+
+        if not self.devices:
+            raise RuntimeError("unable to configure serial port")
+
+    @property
+    def energinos(self):
+        """ Return the attached energinos. """
+
+        return list(self.devices)
+
+    def put(self, readings):
+        """ Queue readings for fetch(), waiting while the queue is full. """
+
+        while not self.stop.isSet():
+            try:
+                self.readings.put(readings, timeout=1.0)
+                return
+            except Queue.Full:
+                continue
+
+    def send_cmds(self, cmds):
+        """ Queue command list for every device. """
+
+        for device in self.devices:
+            device.send_cmds(cmds)
+
+    def run(self):
+        """ Serve every device until shutdown. """
+
+        logging.info("starting event loop on %u devices", len(self.devices))
+
+        while self.channels and not self.stop.isSet():
+            loop(timeout=1.0, count=1, channels=self.channels)
+
+        for device in list(self.channels.values()):
+            device.close()
+
+        logging.info("event loop stopped")
+
+    def start(self):
+        """ Start the event loop thread. """
+
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def shutdown(self):
+        """ Stop the event loop and close the devices. """
+
+        self.stop.set()
+
+        if self.thread is not None:
+            self.thread.join()
+
+    def fetch(self, timeout=None):
+        """ Return the next reading from any device. """
+
+        self.start()
+
+        # a blocking get() cannot be interrupted by SIGINT, so poll
+        while True:
+            try:
+                return self.readings.get(timeout=timeout or 1.0)
+            except Queue.Empty:
+                if timeout is not None:
+                    raise ValueError("no readings within %ss" % timeout)
+                if not self.thread.is_alive():
+                    raise RuntimeError("every device has been closed")
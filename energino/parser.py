@@ -0,0 +1,411 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013, Roberto Riggio
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the CREATE-NET nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY CREATE-NET ''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL CREATE-NET BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Table-driven parser for the energino status lines.
+
+Each model describes its line with a Schema, i.e. the type of every
+comma-separated field after the magic string and the revision. The
+schema compiles a specialized unpack function and a reading class with
+__slots__, so parsing a line allocates a single object plus the values.
+
+In bulk mode a Framer splits raw serial bytes into frames, and the
+schema parses all of them in one pass into a columnar Batch.
+"""
+
+from __future__ import absolute_import
+
+import re
+import keyword
+
+from array import array
+
+from energino.clock import format_ns
+from energino.clock import ns_array
+
+CONVERTERS = {float: "float(%s)", int: "int(%s)", str: "text(%s)"}
+
+TYPECODES = {float: 'd', int: 'l'}
+
+# names used by the generated code
+RESERVED = ('self', 'line', 'fields', 'readings', 'reading', 'LogLine',
+            'frame', 'frames', 'batch', 'columns', 'lost', 'text')
+
+PRINTABLE = re.compile(r'[\x20-\x7e]*\Z')
+
+INIT = """
+def __init__(self, %(args)s):
+    self.extra = None
+%(body)s
+"""
+
+UNPACK = """
+def unpack(line):
+    if line[:1] == '#' and line[-1:] == '\\n':
+        fields = line[1:-1].split(',')
+        if len(fields) == %(size)u:
+%(body)s
+            readings = reading(%(args)s)
+            return readings, (%(values)s,), LogLine(readings)
+    raise ValueError("invalid line: %%s" %% line[0:-1])
+"""
+
+
+UNPACK_MANY = """
+def unpack_many(frames, batch):
+    columns = batch.columns
+%(appends)s
+    lost = 0
+    for frame in frames:
+        fields = frame.split(',')
+        if len(fields) != %(size)u:
+            lost += 1
+            continue
+        try:
+%(body)s
+        except ValueError:
+            lost += 1
+            continue
+%(calls)s
+    return lost
+"""
+
+
+def text(value):
+    """ Return a text field, ValueError if it is not printable ASCII.
+
+    Corrupted lines can still have the right number of fields, garbage
+    in a text field is only caught here.
+    """
+
+    value = value.rstrip('\r')
+
+    if PRINTABLE.match(value) is None:
+        raise ValueError("invalid text: %r" % value)
+
+    return value
+
+
+class Reading(object):
+    """ A single reading.
+
+    Fields are slots but can also be accessed as dictionary keys. Keys
+    that are not part of the schema are kept in the extra dictionary.
+    The timestamp is kept in nanoseconds (ts), at is its text form.
+    received is the time (in ns) the reading was read from the device.
+    """
+
+    __slots__ = ('port', 'ts', 'received', 'extra')
+
+    fields = ()
+    values = ()
+    names = frozenset(('port', 'ts', 'received', 'at'))
+    template = ""
+
+    def __init__(self):
+        self.extra = None
+
+    def __getitem__(self, key):
+        if key in self.names:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        if self.extra is not None and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in self.names:
+            setattr(self, key, value)
+            return
+        if self.extra is None:
+            self.extra = {}
+        self.extra[key] = value
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def get(self, key, default=None):
+        """ Return the value for key if present, default otherwise. """
+
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        """ Return the keys set in this reading. """
+
+        keys = [key for key in self.fields if key in self]
+        keys.extend(key for key in ('port', 'ts', 'at') if key in self)
+        if self.extra:
+            keys.extend(self.extra.keys())
+        return keys
+
+    def items(self):
+        """ Return the (key, value) pairs set in this reading. """
+
+        return [(key, self[key]) for key in self.keys()]
+
+    def to_dict(self):
+        """ Return the reading as a dictionary. """
+
+        return dict(self.items())
+
+    @property
+    def at(self):
+        """ Return the timestamp as text. """
+
+        return format_ns(self.ts)
+
+    @property
+    def line(self):
+        """ Return the values as a tuple. """
+
+        return tuple(getattr(self, value) for value in self.values)
+
+    @property
+    def log(self):
+        """ Return the human-readable log text. """
+
+        return self.template % self.line
+
+
+class LogLine(object):
+    """ Defer formatting of a reading until it is actually logged. """
+
+    __slots__ = ('readings',)
+
+    def __init__(self, readings):
+        self.readings = readings
+
+    def __str__(self):
+        return self.readings.log
+
+
+class Schema(object):
+    """ Field layout of a status line.
+
+    fields lists the (name, type) of every field after the magic string
+    and the revision, values the (name, unit) of the fields returned as
+    a tuple and logged.
+    """
+
+    binary = False
+
+    def __init__(self, name, fields, values):
+
+        for field, _ in fields:
+            if keyword.iskeyword(field) or \
+               field in Reading.__slots__ or \
+               field in RESERVED:
+                raise ValueError("invalid field name: %s" % field)
+
+        self.name = name
+        self.fields = tuple(field for field, _ in fields)
+        self.values = tuple(value for value, _ in values)
+        self.size = len(fields) + 2
+
+        template = " ".join("%%s [%s]" % unit.replace('%', '%%')
+                            for _, unit in values)
+
+        self.types = tuple(fields)
+        self.reading = self.compile_reading(template)
+        self.unpack = self.compile_unpack(fields)
+        self.unpack_many = self.compile_unpack_many(fields)
+
+    def batch(self):
+        """ Return an empty batch for this schema. """
+
+        return Batch(self)
+
+    def framer(self):
+        """ Return a new framer for this schema. """
+
+        return Framer()
+
+    def compile_reading(self, template):
+        """ Build the reading class for this schema. """
+
+        fields = self.fields
+
+        source = INIT % {'args': ", ".join(fields),
+                         'body': "\n".join("    self.%s = %s" % (field, field)
+                                           for field in fields)}
+
+        namespace = {}
+        exec(compile(source, "<schema %s>" % self.name, "exec"), namespace)
+
+        return type(self.name + "Reading", (Reading,),
+                    {'__slots__': fields,
+                     '__init__': namespace['__init__'],
+                     'fields': fields,
+                     'names': Reading.names.union(fields),
+                     'values': self.values,
+                     'template': template})
+
+    def compile_unpack(self, fields):
+        """ Build the unpack function for this schema. """
+
+        body = "\n".join("            %s = %s" % (field, CONVERTERS[kind] %
+                                                  "fields[%u]" % (index + 2))
+                         for index, (field, kind) in enumerate(fields))
+
+        source = UNPACK % {'size': self.size,
+                           'body': body,
+                           'args': ", ".join(self.fields),
+                           'values': ", ".join(self.values)}
+
+        namespace = {'reading': self.reading, 'LogLine': LogLine,
+                     'text': text}
+        exec(compile(source, "<schema %s>" % self.name, "exec"), namespace)
+
+        return namespace['unpack']
+
+    def compile_unpack_many(self, fields):
+        """ Build the bulk unpack function for this schema. """
+
+        appends = "\n".join("    append_%s = columns['%s'].append" %
+                            (field, field) for field in self.fields)
+
+        body = "\n".join("            %s = %s" % (field, CONVERTERS[kind] %
+                                                  "fields[%u]" % (index + 2))
+                         for index, (field, kind) in enumerate(fields))
+
+        calls = "\n".join("        append_%s(%s)" % (field, field)
+                          for field in self.fields)
+
+        source = UNPACK_MANY % {'size': self.size,
+                                'appends': appends,
+                                'body': body,
+                                'calls': calls}
+
+        namespace = {'text': text}
+        exec(compile(source, "<schema %s>" % self.name, "exec"), namespace)
+
+        return namespace['unpack_many']
+
+
+class Framer(object):
+    """ Split a serial byte stream into status frames.
+
+    The partial line at the end of the data is kept for the next call.
+    Frames are returned without the leading '#' and the line terminator,
+    other lines (e.g. command echoes) are skipped.
+    """
+
+    # lines carry neither a checksum nor a sequence number, see
+    # FrameSplitter
+    crc_errors = 0
+    lost = 0
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def split(self, data):
+        """ Return the complete frames received so far. """
+
+        self.buffer.extend(data)
+        end = self.buffer.rfind('\n')
+
+        if end < 0:
+            return []
+
+        lines = str(self.buffer[:end]).split('\n')
+        del self.buffer[:end + 1]
+
+        return [line[1:].rstrip('\r') for line in lines if line[:1] == '#']
+
+
+class Batch(object):
+    """ Columnar batch of readings from a single device.
+
+    Every schema field is a column (an array for numeric fields, a list
+    otherwise), timestamps are kept in nanoseconds in the ts column.
+    received is the time of the last read from the device, lost the
+    number of lines or frames that could not be parsed.
+    """
+
+    def __init__(self, schema):
+        self.schema = schema
+        self.port = None
+        self.received = None
+        self.lost = 0
+        self.ts = ns_array()
+        self.columns = {}
+        for field, kind in schema.types:
+            if kind in TYPECODES:
+                self.columns[field] = array(TYPECODES[kind])
+            else:
+                self.columns[field] = []
+
+    def __len__(self):
+        return len(self.ts)
+
+    def __getattr__(self, name):
+        columns = self.__dict__.get('columns')
+        if columns is not None and name in columns:
+            return columns[name]
+        raise AttributeError(name)
+
+    def clear(self):
+        """ Remove every reading. """
+
+        for column in self.columns.values():
+            del column[:]
+
+        del self.ts[:]
+
+    def lines(self):
+        """ Return the value tuples, as returned by unpack. """
+
+        return zip(*[self.columns[value] for value in self.schema.values])
+
+    def row(self, index):
+        """ Return reading at index as a dictionary. """
+
+        readings = dict((field, column[index])
+                        for field, column in self.columns.items())
+        readings['port'] = self.port
+        readings['ts'] = self.ts[index]
+        readings['at'] = format_ns(self.ts[index])
+
+        return readings
+
+    def rows(self):
+        """ Iterate over the readings as dictionaries. """
+
+        for index in range(len(self)):
+            yield self.row(index)
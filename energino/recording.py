@@ -0,0 +1,542 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013, Roberto Riggio
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the CREATE-NET nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY CREATE-NET ''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL CREATE-NET BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Columnar binary recordings.
+
+A recording file holds the readings of a single device. It starts with
+a header (magic, then the length and text of a JSON document with the
+port, the schema and the columns with their types) followed by blocks.
+Each block has a fixed-size header with the number of rows, the time
+range they cover, the size of the payload and its CRC32; the payload is
+the ts column followed by every other column, each stored contiguously.
+Numbers are little endian: timestamps and integers are 8-byte signed,
+floats are doubles, text values are stored as their raw bytes, each
+after a 4-byte length (version 1 files separate them with NUL bytes
+instead). Payloads can be zlib-compressed, uncompressed payloads can be
+mapped straight into arrays. Recordings are lossless, the deadband and
+swinging door filters of the uploads and of the store never apply here.
+
+The Recorder writes one file per device, starting a new file past a
+given size or age.
+"""
+
+from __future__ import absolute_import
+
+import os
+import sys
+import json
+import time
+import zlib
+import struct
+import logging
+import optparse
+
+from array import array
+
+from energino.clock import format_ns
+from energino.clock import ns_array
+from energino.clock import now_ns
+
+MAGIC = b'ENRG'
+VERSION = 2
+
+HEADER = struct.Struct('<4sI')
+BLOCK = struct.Struct('<4sBIqqII')
+BLOCK_MAGIC = b'EBLK'
+
+COMPRESSED = 1
+
+FLOAT = '<f8'
+INT = '<i8'
+TEXT = 'text'
+
+SUFFIX = '.enr'
+
+DEFAULT_BLOCK_ROWS = 4096
+DEFAULT_BLOCK_SECONDS = 10
+DEFAULT_ROTATE_BYTES = 256 * 1024 * 1024
+DEFAULT_ROTATE_SECONDS = 24 * 3600
+DEFAULT_LEVEL = 6
+
+
+def dtype(kind):
+    """ Return the column type stored for a schema field type. """
+
+    if kind is float:
+        return FLOAT
+
+    if kind is int:
+        return INT
+
+    return TEXT
+
+
+def new_column(kind):
+    """ Return an empty column for a stored type. """
+
+    if kind == FLOAT:
+        return array('d')
+
+    if kind == INT:
+        return ns_array()
+
+    return []
+
+
+def to_bytes(column, kind):
+    """ Return the stored form of a column. """
+
+    if kind == TEXT:
+        values = [value if isinstance(value, bytes) else value.encode('utf-8')
+                  for value in column]
+        return b''.join(struct.pack('<I', len(value)) + value
+                        for value in values)
+
+    if sys.byteorder == 'big':
+        column = array(column.typecode, column)
+        column.byteswap()
+
+    return column.tostring()
+
+
+def from_bytes(data, kind, rows, version=VERSION):
+    """ Return a column from its stored form. """
+
+    if kind == TEXT and version < 2:
+        return [value.decode('utf-8') for value in data.split(b'\0')] \
+            if rows else []
+
+    if kind == TEXT:
+        column = []
+        offset = 0
+        for _ in range(rows):
+            size = struct.unpack_from('<I', data, offset)[0]
+            offset = offset + 4
+            column.append(data[offset:offset + size])
+            offset = offset + size
+        return column
+
+    column = new_column(kind)
+    column.fromstring(data)
+
+    if sys.byteorder == 'big':
+        column.byteswap()
+
+    return column
+
+
+class Block(object):
+    """ A block header, as found in a recording. """
+
+    def __init__(self, offset, flags, rows, first, last, size, crc):
+        self.offset = offset
+        self.flags = flags
+        self.rows = rows
+        self.first = first
+        self.last = last
+        self.size = size
+        self.crc = crc
+
+    @property
+    def compressed(self):
+        """ Return True if the payload is compressed. """
+
+        return bool(self.flags & COMPRESSED)
+
+    @property
+    def payload(self):
+        """ Return the file offset of the payload. """
+
+        return self.offset + BLOCK.size
+
+
+class RecordingWriter(object):
+    """ Write the readings of a device to a recording file. """
+
+    def __init__(self, path, port, schema, columns,
+                 block_rows=DEFAULT_BLOCK_ROWS,
+                 block_seconds=DEFAULT_BLOCK_SECONDS,
+                 level=DEFAULT_LEVEL):
+
+        self.path = path
+        self.columns = tuple(columns)
+        self.block_rows = block_rows
+        self.block_seconds = block_seconds
+        self.level = level
+        self.rows = 0
+        self.opened = time.time()
+        self.flushed = self.opened
+        self.ts = ns_array()
+        self.data = [new_column(kind) for _, kind in self.columns]
+
+        meta = json.dumps({'version' : VERSION,
+                           'port' : port,
+                           'schema' : schema,
+                           'columns' : [list(column)
+                                        for column in self.columns],
+                           'compression' : 'zlib' if level else None,
+                           'created' : now_ns()}).encode('utf-8')
+
+        self.fd = open(path, 'wb')
+        self.fd.write(HEADER.pack(MAGIC, len(meta)))
+        self.fd.write(meta)
+        self.size = self.fd.tell()
+
+    def append(self, ts, values):
+        """ Append a row, values in the order of the columns. """
+
+        self.ts.append(ts)
+
+        for column, value in zip(self.data, values):
+            column.append(value)
+
+        self.check()
+
+    def extend(self, ts, columns):
+        """ Append rows given as a timestamp array and one per column. """
+
+        self.ts.extend(ts)
+
+        for column, values in zip(self.data, columns):
+            column.extend(values)
+
+        self.check()
+
+    def check(self):
+        """ Write a block if enough rows or time went by. """
+
+        if len(self.ts) >= self.block_rows or \
+           time.time() - self.flushed >= self.block_seconds:
+            self.flush()
+
+    def flush(self):
+        """ Write the pending rows, in blocks of at most block_rows. """
+
+        self.flushed = time.time()
+
+        for start in range(0, len(self.ts), self.block_rows):
+            self.write(start, min(start + self.block_rows, len(self.ts)))
+
+        self.fd.flush()
+
+        del self.ts[:]
+        for column in self.data:
+            del column[:]
+
+    def write(self, start, stop):
+        """ Write the pending rows from start to stop as a block. """
+
+        ts = self.ts[start:stop]
+        payload = [to_bytes(ts, INT)]
+
+        for (_, kind), column in zip(self.columns, self.data):
+            data = to_bytes(column[start:stop], kind)
+            if kind == TEXT:
+                payload.append(struct.pack('<I', len(data)))
+            payload.append(data)
+
+        payload = b''.join(payload)
+        flags = 0
+
+        if self.level:
+            payload = zlib.compress(payload, self.level)
+            flags = flags | COMPRESSED
+
+        self.fd.write(BLOCK.pack(BLOCK_MAGIC, flags, len(ts), ts[0], ts[-1],
+                                 len(payload),
+                                 zlib.crc32(payload) & 0xffffffff))
+        self.fd.write(payload)
+
+        self.size = self.size + BLOCK.size + len(payload)
+        self.rows = self.rows + len(ts)
+
+    def close(self):
+        """ Write the pending rows and close the file. """
+
+        self.flush()
+        self.fd.close()
+
+
+class Recording(object):
+    """ Read a recording file.
+
+    Block headers are scanned when opening, unless they are given.
+    """
+
+    def __init__(self, path, blocks=None):
+        self.path = path
+        self.fd = open(path, 'rb')
+
+        magic, length = HEADER.unpack(self.fd.read(HEADER.size))
+
+        if magic != MAGIC:
+            raise ValueError("%s is not a recording" % path)
+
+        meta = json.loads(self.fd.read(length).decode('utf-8'))
+
+        if meta['version'] > VERSION:
+            raise ValueError("%s: unsupported version %s" %
+                             (path, meta['version']))
+
+        self.version = meta['version']
+        self.port = meta['port']
+        self.schema = meta['schema']
+        self.columns = [tuple(column) for column in meta['columns']]
+        self.names = [name for name, _ in self.columns]
+        self.start = HEADER.size + length
+        self.blocks = self.scan() if blocks is None else blocks
+
+    def __len__(self):
+        return sum(block.rows for block in self.blocks)
+
+    def scan(self):
+        """ Return the block headers, stopping at a torn block. """
+
+        blocks = []
+        offset = self.start
+        end = os.fstat(self.fd.fileno()).st_size
+
+        while offset + BLOCK.size <= end:
+            self.fd.seek(offset)
+            fields = BLOCK.unpack(self.fd.read(BLOCK.size))
+            if fields[0] != BLOCK_MAGIC or \
+               offset + BLOCK.size + fields[5] > end:
+                logging.warning("%s: torn block at %u", self.path, offset)
+                break
+            blocks.append(Block(offset, *fields[1:]))
+            offset = offset + BLOCK.size + fields[5]
+
+        return blocks
+
+    def payload(self, block):
+        """ Return the uncompressed payload of a block. """
+
+        self.fd.seek(block.payload)
+        data = self.fd.read(block.size)
+
+        if zlib.crc32(data) & 0xffffffff != block.crc:
+            raise ValueError("%s: corrupted block at %u" %
+                             (self.path, block.offset))
+
+        if block.compressed:
+            data = zlib.decompress(data)
+
+        return data
+
+    def layout(self, block, data=None):
+        """ Return the (offset, size) of every column in a payload.
+
+        The ts column comes first. Text columns need the payload to be
+        located, data is read if not given.
+        """
+
+        layout = [(0, block.rows * 8)]
+        offset = block.rows * 8
+
+        for _, kind in self.columns:
+            if kind == TEXT:
+                if data is None:
+                    data = self.payload(block)
+                size = struct.unpack_from('<I', data, offset)[0]
+                offset = offset + 4
+            else:
+                size = block.rows * 8
+            layout.append((offset, size))
+            offset = offset + size
+
+        return layout
+
+    def read(self, block):
+        """ Return (ts, columns) of a block, columns keyed by name. """
+
+        data = self.payload(block)
+        layout = self.layout(block, data)
+
+        ts = from_bytes(data[layout[0][0]:sum(layout[0])], INT, block.rows)
+        columns = {}
+
+        for (name, kind), (offset, size) in zip(self.columns, layout[1:]):
+            columns[name] = from_bytes(data[offset:offset + size], kind,
+                                       block.rows, self.version)
+
+        return ts, columns
+
+    def iter_blocks(self, start=None, end=None):
+        """ Yield (ts, columns) of the blocks overlapping [start, end]. """
+
+        for block in self.blocks:
+            if start is not None and block.last < start:
+                continue
+            if end is not None and block.first > end:
+                continue
+            yield self.read(block)
+
+    def close(self):
+        """ Close the file. """
+
+        self.fd.close()
+
+
+def file_name(prefix, port, now=None):
+    """ Return the name of a new recording of port. """
+
+    stamp = time.strftime("%Y%m%dT%H%M%S", time.gmtime(now))
+
+    return "%s-%s-%s%s" % (prefix, os.path.basename(port), stamp, SUFFIX)
+
+
+class Recorder(object):
+    """ Record readings, one rotated file per device. """
+
+    def __init__(self, prefix,
+                 rotate_bytes=DEFAULT_ROTATE_BYTES,
+                 rotate_seconds=DEFAULT_ROTATE_SECONDS,
+                 level=DEFAULT_LEVEL,
+                 block_rows=DEFAULT_BLOCK_ROWS):
+
+        self.prefix = prefix
+        self.rotate_bytes = rotate_bytes
+        self.rotate_seconds = rotate_seconds
+        self.level = level
+        self.block_rows = block_rows
+        self.writers = {}
+
+        directory = os.path.dirname(prefix)
+
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def writer(self, port, schema, fields):
+        """ Return the writer of port, starting a new file if due. """
+
+        writer = self.writers.get(port)
+
+        if writer is not None and \
+           (writer.size >= self.rotate_bytes or
+            time.time() - writer.opened >= self.rotate_seconds):
+            writer.close()
+            writer = None
+
+        if writer is None:
+            path = file_name(self.prefix, port)
+            base = path[:-len(SUFFIX)]
+            suffix = 1
+            # rotating twice within a second
+            while os.path.exists(path):
+                path = "%s.%u%s" % (base, suffix, SUFFIX)
+                suffix = suffix + 1
+            logging.info("recording %s to %s", port, path)
+            writer = RecordingWriter(path, port, schema,
+                                     [(field, dtype(kind))
+                                      for field, kind in fields],
+                                     self.block_rows,
+                                     level=self.level)
+            self.writers[port] = writer
+
+        return writer
+
+    def add(self, readings):
+        """ Record a reading (as returned by PyEnergino.fetch()). """
+
+        fields = [(field, type(readings[field]))
+                  for field in readings.fields]
+        # reading classes are named after their schema
+        schema = type(readings).__name__[:-len("Reading")]
+        writer = self.writer(readings['port'], schema, fields)
+        writer.append(readings['ts'],
+                      [readings[field] for field in readings.fields])
+
+    def add_batch(self, batch):
+        """ Record a batch of readings. """
+
+        if not len(batch):
+            return
+
+        writer = self.writer(batch.port, batch.schema.name,
+                             batch.schema.types)
+        writer.extend(batch.ts, [batch.columns[field]
+                                 for field in batch.schema.fields])
+
+    def close(self):
+        """ Write pending rows and close every file. """
+
+        for writer in self.writers.values():
+            writer.close()
+
+        self.writers = {}
+
+
+def main():
+    """ Print recordings as CSV. """
+
+    parser = optparse.OptionParser(usage="%prog [options] file.enr ...")
+
+    parser.add_option('--info', '-I',
+                      dest="info",
+                      action="store_true",
+                      default=False,
+                      help="print the blocks instead of the readings")
+
+    options, args = parser.parse_args()
+
+    if not args:
+        parser.error("recording missing")
+
+    for path in args:
+
+        recording = Recording(path)
+
+        if options.info:
+            print("# %s: %s, %u rows, %u blocks" % (recording.port,
+                                                    recording.schema,
+                                                    len(recording),
+                                                    len(recording.blocks)))
+            for block in recording.blocks:
+                print("%u,%u,%s,%s,%u,%s" % (block.offset,
+                                             block.rows,
+                                             format_ns(block.first),
+                                             format_ns(block.last),
+                                             block.size,
+                                             block.compressed))
+            continue
+
+        print("port,at,%s" % ",".join(recording.names))
+
+        for ts, columns in recording.iter_blocks():
+            values = [columns[name] for name in recording.names]
+            for index in range(len(ts)):
+                print("%s,%s,%s" % (recording.port,
+                                    format_ns(ts[index]),
+                                    ",".join(str(value[index])
+                                             for value in values)))
+
+        recording.close()
+
+
+if __name__ == "__main__":
+    main()
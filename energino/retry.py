@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013, Roberto Riggio
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the CREATE-NET nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY CREATE-NET ''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL CREATE-NET BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Retry policies for uploads: exponential backoff with jitter, a circuit
+breaker and the classification of HTTP outcomes.
+"""
+
+from __future__ import absolute_import
+
+import time
+import random
+import logging
+
+DEFAULT_BACKOFF_BASE = 1
+DEFAULT_BACKOFF_MAX = 300
+DEFAULT_BREAKER_FAILURES = 5
+DEFAULT_BREAKER_COOLDOWN = 120
+
+SUCCESS = 'success'
+RETRY = 'retry'
+REJECTED = 'rejected'
+TOO_LARGE = 'too_large'
+UNAUTHORIZED = 'unauthorized'
+SERVER_ERROR = 'server_error'
+NETWORK_ERROR = 'network_error'
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+def classify(status):
+    """ Map an HTTP status (None for network errors) to an outcome. """
+
+    if status is None:
+        return NETWORK_ERROR
+
+    if 200 <= status < 300:
+        return SUCCESS
+
+    if status in (408, 429):
+        return RETRY
+
+    if status == 413:
+        return TOO_LARGE
+
+    if status in (401, 403, 404):
+        return UNAUTHORIZED
+
+    if 400 <= status < 500:
+        return REJECTED
+
+    return SERVER_ERROR
+
+
+def retry_after(headers):
+    """ Return the Retry-After delay in seconds from response headers. """
+
+    for header, value in headers:
+        if header.lower() == 'retry-after':
+            try:
+                return max(0, int(value))
+            except ValueError:
+                return 0
+
+    return 0
+
+
+class Backoff(object):
+    """ Exponential backoff with jitter.
+
+    The n-th consecutive delay is drawn uniformly between half and all
+    of min(maximum, base * 2^n), so that several daemons failing at the
+    same time do not retry in lockstep.
+    """
+
+    def __init__(self, base=DEFAULT_BACKOFF_BASE, maximum=DEFAULT_BACKOFF_MAX):
+        self.base = base
+        self.maximum = maximum
+        self.attempts = 0
+
+    def next(self):
+        """ Return the next delay and count the attempt. """
+
+        delay = min(self.maximum, self.base * (2 ** self.attempts))
+
+        if delay < self.maximum:
+            self.attempts = self.attempts + 1
+
+        return delay / 2.0 + random.uniform(0, delay / 2.0)
+
+    def reset(self):
+        """ Start again from the base delay. """
+
+        self.attempts = 0
+
+
+class CircuitBreaker(object):
+    """ Stop trying after consecutive failures, for a cooldown period.
+
+    After the cooldown a single attempt is let through (half open): a
+    success closes the breaker, a failure opens it again.
+    """
+
+    def __init__(self, failures=DEFAULT_BREAKER_FAILURES,
+                 cooldown=DEFAULT_BREAKER_COOLDOWN):
+        self.failures = failures
+        self.cooldown = cooldown
+        self.state = CLOSED
+        self.count = 0
+        self.opened = 0
+
+    def allow(self):
+        """ Return True if an attempt can be made now. """
+
+        if self.state == OPEN and self.remaining() <= 0:
+            logging.info("circuit half open, trying again")
+            self.state = HALF_OPEN
+
+        return self.state != OPEN
+
+    def remaining(self):
+        """ Return the seconds left before the breaker lets a try through. """
+
+        return max(0, self.opened + self.cooldown - time.time())
+
+    def success(self):
+        """ Record a successful attempt. """
+
+        if self.state != CLOSED:
+            logging.info("circuit closed")
+
+        self.state = CLOSED
+        self.count = 0
+
+    def failure(self):
+        """ Record a failed attempt. """
+
+        self.count = self.count + 1
+
+        if self.state == HALF_OPEN or (self.state == CLOSED and
+                                       self.count >= self.failures):
+            logging.warning("circuit open after %u failures, pausing %us",
+                            self.count, self.cooldown)
+            self.state = OPEN
+            self.opened = time.time()
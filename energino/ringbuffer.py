@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013, Roberto Riggio
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the CREATE-NET nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY CREATE-NET ''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL CREATE-NET BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Fixed-capacity ring buffer backed by typed arrays.
+
+Rows are a timestamp (ns) plus one double per column, stored in
+preallocated arrays, so a sample costs 8 bytes per column instead of a
+dictionary. Rows have absolute offsets: a view taken before an upload
+can be consumed afterwards even if new rows were appended or old ones
+dropped in the meantime.
+
+DoubleBuffer sits in front of a ring buffer (or a spool) when the
+producer and the consumer are different threads: the producer only
+pushes references, the consumer swaps in an empty list and drains the
+old one into the buffer it owns.
+"""
+
+from __future__ import absolute_import
+
+import threading
+
+from array import array
+
+from energino.clock import ns_array
+
+DEFAULT_CAPACITY = 100000
+
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
+RAISE = 'raise'
+
+OVERFLOW_POLICIES = (DROP_OLDEST, DROP_NEWEST, RAISE)
+
+
+class RingView(object):
+    """ A zero-copy view over a contiguous range of rows. """
+
+    def __init__(self, ring, first, count):
+        self.ring = ring
+        self.first = first
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def end(self):
+        """ Return the offset following the last row in the view. """
+
+        return self.first + self.count
+
+    def segments(self):
+        """ Return the (begin, end) array ranges covering the view. """
+
+        return self.ring.segments(self.first, self.count)
+
+    def iter_ts(self):
+        """ Iterate over the timestamps. """
+
+        return self.iter_array(self.ring.ts)
+
+    def iter_column(self, name):
+        """ Iterate over the values of a column. """
+
+        return self.iter_array(self.ring.columns[self.ring.index[name]])
+
+    def iter_array(self, values):
+        """ Iterate over the rows of one of the ring arrays. """
+
+        for begin, end in self.segments():
+            for index in range(begin, end):
+                yield values[index]
+
+    def last(self, name):
+        """ Return the value of the last row for a column. """
+
+        ring = self.ring
+        index = (self.end - 1) % ring.capacity
+
+        return ring.columns[ring.index[name]][index]
+
+
+class RingBuffer(object):
+    """ Ring buffer with a timestamp and a double per named column.
+
+    When full, append() follows the overflow policy: drop the oldest
+    row, drop the new row, or raise BufferError.
+    """
+
+    def __init__(self, names, capacity=DEFAULT_CAPACITY,
+                 overflow=DROP_OLDEST):
+
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError("invalid overflow policy: %s" % overflow)
+
+        if capacity <= 0:
+            raise ValueError("invalid capacity: %s" % capacity)
+
+        self.names = tuple(names)
+        self.index = dict((name, index) for index, name in
+                          enumerate(self.names))
+        self.capacity = capacity
+        self.overflow = overflow
+        self.ts = ns_array([0]) * capacity
+        self.columns = [array('d', [0.0]) * capacity for _ in self.names]
+        self.first = 0
+        self.size = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def end(self):
+        """ Return the offset following the newest row. """
+
+        return self.first + self.size
+
+    def append(self, ts, values):
+        """ Append a row, return False if it was dropped. """
+
+        if self.size == self.capacity:
+            if self.overflow == DROP_NEWEST:
+                self.dropped = self.dropped + 1
+                return False
+            if self.overflow == RAISE:
+                raise BufferError("ring buffer full")
+            self.first = self.first + 1
+            self.size = self.size - 1
+            self.dropped = self.dropped + 1
+
+        index = (self.first + self.size) % self.capacity
+        self.ts[index] = ts
+
+        for column, value in zip(self.columns, values):
+            column[index] = value
+
+        self.size = self.size + 1
+
+        return True
+
+    def extend(self, ts, columns):
+        """ Append rows given as a timestamp array and one per column. """
+
+        for index in range(len(ts)):
+            self.append(ts[index], [column[index] for column in columns])
+
+    def segments(self, first, count):
+        """ Return the (begin, end) array ranges covering count rows. """
+
+        if count <= 0:
+            return []
+
+        begin = first % self.capacity
+        end = begin + count
+
+        if end <= self.capacity:
+            return [(begin, end)]
+
+        return [(begin, self.capacity), (0, end - self.capacity)]
+
+    def view(self, count=None):
+        """ Return a view over the oldest count rows (all by default). """
+
+        if count is None or count > self.size:
+            count = self.size
+
+        return RingView(self, self.first, count)
+
+    def consume(self, end):
+        """ Drop every row before offset end (e.g. the end of a view). """
+
+        count = min(end - self.first, self.size)
+
+        if count > 0:
+            self.first = self.first + count
+            self.size = self.size - count
+
+    def close(self):
+        """ Nothing to release, rows only live in memory. """
+
+        pass
+
+
+class DoubleBuffer(object):
+    """ Producer side of a single-producer, single-consumer queue.
+
+    append() and extend() are O(1): rows and whole batches are queued by
+    reference, under a lock that is never held for longer than a list
+    append or a swap. drain() swaps the queue for an empty one and copies
+    the rows into the target outside of the lock.
+    """
+
+    def __init__(self, names):
+        self.names = tuple(names)
+        self.lock = threading.Lock()
+        self.front = []
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, ts, values):
+        """ Queue a row. """
+
+        with self.lock:
+            self.front.append((False, ts, values))
+            self.count = self.count + 1
+
+    def extend(self, ts, columns):
+        """ Queue rows given as a timestamp array and one per column. """
+
+        with self.lock:
+            self.front.append((True, ts, columns))
+            self.count = self.count + len(ts)
+
+    def swap(self):
+        """ Return the queued entries, leaving an empty queue. """
+
+        with self.lock:
+            back = self.front
+            self.front = []
+            self.count = 0
+
+        return back
+
+    def drain(self, target):
+        """ Move the queued rows to target, return how many were moved.
+
+        If target raises BufferError, the rows that did not fit are put
+        back at the head of the queue and the error is raised again.
+        """
+
+        moved = 0
+        back = self.swap()
+
+        for position, (many, ts, values) in enumerate(back):
+            size = len(target)
+            try:
+                if many:
+                    target.extend(ts, values)
+                    moved = moved + len(ts)
+                else:
+                    target.append(ts, values)
+                    moved = moved + 1
+            except BufferError:
+                fitted = len(target) - size
+                rest = back[position + 1:]
+                if many:
+                    rest.insert(0, (True, ts[fitted:],
+                                    [column[fitted:] for column in values]))
+                else:
+                    rest.insert(0, (False, ts, values))
+                self.restore(rest)
+                raise
+
+        return moved
+
+    def restore(self, entries):
+        """ Put entries back at the head of the queue. """
+
+        count = sum(len(ts) if many else 1 for many, ts, _ in entries)
+
+        with self.lock:
+            self.front = entries + self.front
+            self.count = self.count + count
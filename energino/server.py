@@ -0,0 +1,553 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013, Roberto Riggio
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the CREATE-NET nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY CREATE-NET ''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL CREATE-NET BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Caching HTTP server for energino readings.
+
+Devices are read once, by a single poller thread, into a cache holding
+the latest value of every stream per device. The server answers the
+same URLs as the Ethernet, POE and Yun sketches from that cache:
+
+  GET /arduino/datastreams            (or /read/datastreams)
+  GET /arduino/datastreams/<stream>   (or /read/<stream>)
+  GET /arduino/datastreams/switch/<0|1>   (or /write/switch/<0|1>)
+
+With several devices (--all) the device is picked with ?port=<port>,
+the first one found is the default. Replies are rendered once per new
+reading and shared by every client, with an ETag so that pollers can
+revalidate with If-None-Match. A switch write is forwarded to the
+device, and answered once a reading shows the new state.
+
+Every reading is also pushed as a Server-Sent Event to the clients of
+
+  GET /events?port=<port>&streams=<stream,...>&interval=<ms>&queue=<n>
+
+where every parameter is optional: port can be repeated, interval asks
+for at most one reading per interval and per port, queue bounds the
+readings waiting for a slow client (see energino.events).
+"""
+
+from __future__ import absolute_import
+
+import os
+import json
+import time
+import socket
+import urlparse
+import logging
+import optparse
+import mimetypes
+import threading
+import SocketServer
+import BaseHTTPServer
+
+from energino.energino import PyEnergino
+from energino.energino import DEFAULT_DEVICE
+from energino.energino import DEFAULT_DEVICE_SPEED_BPS
+from energino.energino import DEFAULT_INTERVAL
+from energino.energino import LOG_FORMAT
+from energino.retry import Backoff
+from energino.events import Hub
+from energino.events import Subscriber
+from energino.events import event
+from energino.events import DEFAULT_QUEUE
+from energino.events import DEFAULT_KEEPALIVE
+
+DEFAULT_STREAMS = ('voltage', 'current', 'power', 'switch')
+
+DEFAULT_ADDRESS = ''
+DEFAULT_HTTP_PORT = 8080
+DEFAULT_SWITCH_TIMEOUT = 5
+
+VERSION = "1.0.0"
+
+BACKOFF = 60
+
+# urls of the sketches: (every stream, a stream, switch write)
+ROUTES = (("/arduino/datastreams", "/arduino/datastreams/",
+           "/arduino/datastreams/switch/"),
+          ("/read/datastreams", "/read/", "/write/switch/"))
+
+
+class Cache(object):
+    """ Latest value of every stream, per device.
+
+    Replies are rendered on the first request after an update and kept
+    until the next one, so that the cost of a request does not depend
+    on the number of clients.
+    """
+
+    def __init__(self, streams=DEFAULT_STREAMS):
+        self.streams = tuple(streams)
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.ports = []
+        self.values = {}
+        self.versions = {}
+        self.replies = {}
+
+    def update(self, port, values):
+        """ Set the latest values of port, a dict of stream values. """
+
+        latest = dict((stream, values[stream]) for stream in self.streams
+                      if stream in values)
+
+        with self.changed:
+            if port not in self.values:
+                self.ports.append(port)
+            self.values[port] = latest
+            self.versions[port] = self.versions.get(port, 0) + 1
+            self.changed.notify_all()
+
+    def update_reading(self, readings):
+        """ Update from a reading. """
+
+        self.update(readings['port'], readings)
+
+    def update_batch(self, batch):
+        """ Update from the last row of a batch. """
+
+        if not len(batch):
+            return
+
+        values = dict((stream, batch.columns[stream][-1])
+                      for stream in self.streams if stream in batch.columns)
+
+        self.update(batch.port, values)
+
+    def port(self, port=None):
+        """ Return port if known, the first one if port is None. """
+
+        with self.lock:
+            if port is None:
+                return self.ports[0] if self.ports else None
+            return port if port in self.values else None
+
+    def reply(self, port, stream=None):
+        """ Return (body, etag) for a stream, or for every stream.
+
+        None is returned if there is no such port or stream.
+        """
+
+        with self.lock:
+            values = self.values.get(port)
+            if values is None or (stream is not None and stream not in values):
+                return None
+            version = self.versions[port]
+            index = self.ports.index(port)
+            cached = self.replies.get((port, stream))
+            if cached is not None and cached[0] == version:
+                return cached[1:]
+
+        body = render(values, stream)
+        etag = '"%x-%x-%s"' % (index, version, stream or '')
+
+        with self.lock:
+            if self.versions[port] == version:
+                self.replies[(port, stream)] = (version, body, etag)
+
+        return body, etag
+
+    def wait(self, port, stream, value, timeout):
+        """ Wait until stream shows value, return False on timeout. """
+
+        deadline = time.time() + timeout
+
+        with self.changed:
+            while self.values.get(port, {}).get(stream) != value:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.changed.wait(remaining)
+
+        return True
+
+
+def render(values, stream=None):
+    """ Return the JSON reply of the sketches for a stream, or for all. """
+
+    if stream is not None:
+        return '{"version": "%s", "id": %s, "current_value": %s}\n' % \
+            (VERSION, json.dumps(stream), json.dumps(values[stream]))
+
+    # streams in the order of the sketches, then the others
+    names = [name for name in DEFAULT_STREAMS if name in values]
+    names.extend(sorted(name for name in values if name not in names))
+
+    datastreams = ['{"id": %s, "current_value": %s}' %
+                   (json.dumps(name), json.dumps(values[name]))
+                   for name in names]
+
+    return '{"version": "%s", "datastreams": [%s]}\n' % \
+        (VERSION, ", ".join(datastreams))
+
+
+class Poller(threading.Thread):
+    """ Read devices and update the cache. """
+
+    def __init__(self, backend, cache, hub=None, batch=False):
+        super(Poller, self).__init__()
+        self.daemon = True
+        self.backend = backend
+        self.cache = cache
+        self.hub = hub
+        self.batch = batch
+        self.stop = threading.Event()
+        self.samples = 0
+        self.lost = 0
+
+    def run(self):
+        logging.info("begin polling")
+        backoff = Backoff(1, BACKOFF)
+        while not self.stop.isSet():
+            try:
+                if self.batch:
+                    batch = self.backend.fetch_many()
+                    self.cache.update_batch(batch)
+                    if self.hub:
+                        self.hub.publish_batch(batch)
+                    self.samples = self.samples + len(batch)
+                else:
+                    readings, _, _ = self.backend.fetch()
+                    self.cache.update_reading(readings)
+                    if self.hub:
+                        self.hub.publish(readings)
+                    self.samples = self.samples + 1
+                backoff.reset()
+            except ValueError:
+                self.lost = self.lost + 1
+                logging.warning("sample lost")
+            except RuntimeError as ex:
+                logging.exception(ex)
+                time.sleep(backoff.next())
+        logging.info("thread %s stopped", self.__class__.__name__)
+
+    def shutdown(self):
+        """ Stop polling. """
+
+        self.stop.set()
+
+
+def energinos(backend):
+    """ Return the energinos of a backend, by port. """
+
+    if hasattr(backend, 'energinos'):
+        devices = backend.energinos
+    else:
+        devices = [backend]
+
+    return dict((energino.ser.port, energino) for energino in devices)
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Serve the sketches' URLs from the cache. """
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        """ Dispatch a GET request. """
+
+        url = urlparse.urlparse(self.path)
+        query = urlparse.parse_qs(url.query)
+        port = self.server.cache.port(query.get('port', [None])[0])
+        path = url.path.rstrip('/')
+
+        if path == "/events":
+            return self.send_events(query)
+
+        for every, read, write in ROUTES:
+            if path == every:
+                return self.send_reply(port, None)
+            if path.startswith(write):
+                return self.switch(port, path[len(write):])
+            if path.startswith(read):
+                return self.send_reply(port, path[len(read):])
+
+        if self.server.root:
+            return self.send_file(url.path)
+
+        self.send_error(404)
+
+    def send_reply(self, port, stream):
+        """ Send the cached reply for a stream, or for every stream. """
+
+        reply = self.server.cache.reply(port, stream) if port else None
+
+        if reply is None:
+            return self.send_error(404)
+
+        body, etag = reply
+
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        self.send_body(body, 'application/json', etag)
+
+    def switch(self, port, value):
+        """ Set the switch of port and reply with its new state. """
+
+        if value not in ('0', '1') or port is None:
+            return self.send_error(404)
+
+        energino = self.server.energinos.get(port)
+
+        if energino is None:
+            return self.send_error(404)
+
+        logging.info("setting switch of %s to %s", port, value)
+
+        # the poller owns the serial reads, so the echo is not waited
+        # for, the next reading tells whether the switch was set
+        with self.server.writing:
+            energino.write("#S%s\n" % value)
+
+        if not self.server.cache.wait(port, 'switch', int(value),
+                                      self.server.switch_timeout):
+            logging.warning("switch of %s not set", port)
+            return self.send_error(504)
+
+        self.send_reply(port, 'switch')
+
+    def send_events(self, query):
+        """ Stream readings as Server-Sent Events until the client leaves. """
+
+        streams = [stream for value in query.get('streams', [])
+                   for stream in value.split(',') if stream]
+
+        try:
+            interval = int(query.get('interval', [0])[0])
+            size = int(query.get('queue', [DEFAULT_QUEUE])[0])
+        except ValueError:
+            return self.send_error(400)
+
+        subscriber = Subscriber(query.get('port'), streams, interval, size)
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = 1
+
+        logging.info("%s subscribed", self.client_address[0])
+        self.server.hub.subscribe(subscriber)
+
+        try:
+            self.wfile.write("retry: 1000\n\n")
+            self.wfile.flush()
+            while not subscriber.closed:
+                items = subscriber.get(DEFAULT_KEEPALIVE)
+                if items:
+                    self.wfile.write("".join(event(*item) for item in items))
+                else:
+                    self.wfile.write(": keepalive\n\n")
+                self.wfile.flush()
+        except socket.error:
+            pass
+        finally:
+            self.server.hub.unsubscribe(subscriber)
+            logging.info("%s unsubscribed, %u readings coalesced",
+                         self.client_address[0], subscriber.coalesced)
+
+    def send_file(self, path):
+        """ Send a static file from the server root. """
+
+        root = os.path.abspath(self.server.root)
+        path = os.path.normpath(os.path.join(root, path.lstrip('/')))
+
+        if os.path.isdir(path):
+            path = os.path.join(path, 'index.htm')
+
+        if not path.startswith(root + os.sep) or not os.path.isfile(path):
+            return self.send_error(404)
+
+        with open(path, 'rb') as static:
+            body = static.read()
+
+        mime = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        self.send_body(body, mime)
+
+    def send_body(self, body, content_type, etag=None):
+        """ Send a 200 reply. """
+
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        if etag:
+            self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle(self):
+        try:
+            BaseHTTPServer.BaseHTTPRequestHandler.handle(self)
+        except socket.error:
+            # the client went away before the reply was flushed
+            pass
+
+    def finish(self):
+        try:
+            BaseHTTPServer.BaseHTTPRequestHandler.finish(self)
+        except socket.error:
+            pass
+
+    def log_message(self, fmt, *args):
+        logging.debug("%s %s", self.client_address[0], fmt % args)
+
+
+class EnerginoServer(SocketServer.ThreadingMixIn,
+                     BaseHTTPServer.HTTPServer):
+    """ HTTP server, one thread per connection. """
+
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self, address, cache, hub, backend, root=None,
+                 switch_timeout=DEFAULT_SWITCH_TIMEOUT):
+        BaseHTTPServer.HTTPServer.__init__(self, address, Handler)
+        self.cache = cache
+        self.hub = hub
+        self.energinos = energinos(backend)
+        self.writing = threading.Lock()
+        self.root = root
+        self.switch_timeout = switch_timeout
+
+
+def main():
+    """ Launch the server. """
+
+    parser = optparse.OptionParser()
+
+    parser.add_option('--port', '-p', dest="port", default=DEFAULT_DEVICE)
+
+    parser.add_option('--interval', '-i',
+                      dest="interval",
+                      type="int",
+                      default=DEFAULT_INTERVAL)
+
+    parser.add_option('--bps', '-b',
+                      dest="bps",
+                      type="int",
+                      default=DEFAULT_DEVICE_SPEED_BPS)
+
+    parser.add_option('--all', '-a',
+                      dest="all",
+                      action="store_true",
+                      default=False)
+
+    parser.add_option('--batch', '-B',
+                      dest="batch",
+                      action="store_true",
+                      default=False)
+
+    parser.add_option('--nonblocking', '-n',
+                      dest="nonblocking",
+                      action="store_true",
+                      default=False)
+
+    parser.add_option('--address', '-A',
+                      dest="address",
+                      default=DEFAULT_ADDRESS)
+
+    parser.add_option('--http-port', '-P',
+                      dest="http_port",
+                      type="int",
+                      default=DEFAULT_HTTP_PORT)
+
+    parser.add_option('--root', '-w',
+                      dest="root",
+                      help="serve static files (e.g. sdcard/) from here")
+
+    parser.add_option('--verbose', '-v',
+                      action="store_true",
+                      dest="verbose",
+                      default=False)
+
+    parser.add_option('--log', '-l', dest="log")
+
+    options, _ = parser.parse_args()
+
+    if options.nonblocking and options.batch:
+        parser.error("--nonblocking does not support --batch")
+
+    if options.verbose:
+        lvl = logging.DEBUG
+    else:
+        lvl = logging.INFO
+
+    logging.basicConfig(level=lvl,
+                        format=LOG_FORMAT,
+                        filename=options.log,
+                        filemode='w')
+
+    if options.nonblocking:
+        from energino.nonblocking import AsyncFleet
+        backend = AsyncFleet(options.port, options.bps, options.interval)
+    elif options.all:
+        from energino.fleet import PyEnerginoFleet
+        backend = PyEnerginoFleet(options.port,
+                                  options.bps,
+                                  options.interval,
+                                  options.batch)
+    else:
+        backend = PyEnergino(options.port, options.bps, options.interval)
+
+    backend.send_cmds(["#P%u" % options.interval])
+
+    cache = Cache()
+    hub = Hub(cache.streams)
+    poller = Poller(backend, cache, hub, options.batch)
+    poller.start()
+
+    server = EnerginoServer((options.address, options.http_port), cache,
+                            hub, backend, options.root)
+
+    logging.info("serving on %s:%u", options.address or '*',
+                 options.http_port)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logging.debug("Bye!")
+    finally:
+        poller.shutdown()
+        hub.close()
+        server.server_close()
+        if options.all or options.nonblocking:
+            backend.shutdown()
+
+
+if __name__ == "__main__":
+    main()
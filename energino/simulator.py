@@ -0,0 +1,638 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013, Roberto Riggio
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the CREATE-NET nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY CREATE-NET ''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL CREATE-NET BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Simulated energinos on pseudo terminals.
+
+Every device is a pty speaking the serial protocol of one of the
+sketches, linked as <prefix><n> so that find_devices() picks it up
+exactly like a real /dev/ttyACM<n>. Like the sketch, a device parses
+at most one command per period, right before its status line, and
+echoes it the same way. Faults are injected at a given rate per status
+line:
+
+    noise    relative standard deviation of voltage and current
+    corrupt  a byte is flipped, the line is truncated or garbage added
+    burst    the next lines are held, then written back to back
+    stall    the device goes silent for a while, its output is lost
+
+Output that does not fit in the pty because nobody is reading it is
+dropped, as the USB serial port of the board would do.
+"""
+
+from __future__ import absolute_import
+
+import binascii
+import logging
+import optparse
+import os
+import random
+import select
+import threading
+import time
+import tty
+
+from energino.energino import DEFAULT_DEVICE
+from energino.energino import FRAME_MAGIC
+from energino.energino import LOG_FORMAT
+from energino.energino import MODELS
+from energino.frames import CRC
+from energino.frames import FRAME
+from energino.frames import FRAME_SYNC
+
+DEFAULT_MODEL = "Energino"
+DEFAULT_PERIOD = 2000
+DEFAULT_VOLTAGE = 12.0
+DEFAULT_CURRENT = 0.5
+DEFAULT_BURST = 10
+DEFAULT_STALL = 5.0
+
+# defaults of the sketches, restored by #R
+R1 = 100
+R2 = 10
+OFFSET = 2500
+SENSITIVITY = 185
+AREF = 5000
+
+# analog reads per second in the loop of the sketch
+SAMPLE_RATE = 4000
+
+# battery of the EnerginoAbs, in Wh and V
+CAPACITY = 100.0
+FULL = 12.6
+EMPTY = 11.0
+
+# settings of the EnerginoEthernet
+IP = "192.168.0.100"
+SERVER_PORT = 80
+HOST = "api.xively.com"
+HOST_PORT = 80
+
+GARBAGE = "\x00\xff#,@\r"
+
+# models switching to binary frames on #M1, models echoing commands
+FRAMES = ("Energino", "EnerginoPOE", "EnerginoYun")
+ECHO = ("Energino", "EnerginoAbs", "EnerginoPOE", "EnerginoYun")
+
+
+def atoi(value):
+    """ Parse the leading integer of value like atoi(), 0 if none. """
+
+    digits = value.lstrip()
+    end = 1 if digits[:1] in ('-', '+') else 0
+
+    while end < len(digits) and digits[end].isdigit():
+        end = end + 1
+
+    try:
+        return int(digits[:end])
+    except ValueError:
+        return 0
+
+
+class Faults(object):
+    """ Fault injection rates, per status line. """
+
+    def __init__(self, noise=0.0, corrupt=0.0, burst=0.0,
+                 burst_size=DEFAULT_BURST, stall=0.0,
+                 stall_time=DEFAULT_STALL, seed=None):
+        self.noise = noise
+        self.corrupt = corrupt
+        self.burst = burst
+        self.burst_size = burst_size
+        self.stall = stall
+        self.stall_time = stall_time
+        self.random = random.Random(seed)
+
+    def happens(self, rate):
+        """ Return True with probability rate. """
+
+        return rate > 0 and self.random.random() < rate
+
+    def jitter(self, value):
+        """ Add gaussian noise to value, never below zero. """
+
+        if not self.noise:
+            return value
+
+        return max(0.0, self.random.gauss(value, value * self.noise))
+
+    def mangle(self, data):
+        """ Flip a bit, truncate data or insert garbage into it. """
+
+        index = self.random.randrange(len(data))
+        kind = self.random.randrange(3)
+
+        if kind == 0:
+            flipped = chr(ord(data[index]) ^ (1 << self.random.randrange(8)))
+            return data[:index] + flipped + data[index + 1:]
+
+        if kind == 1:
+            return data[:index]
+
+        garbage = "".join(self.random.choice(GARBAGE)
+                          for _ in range(self.random.randint(1, 8)))
+
+        return data[:index] + garbage + data[index:]
+
+
+class SimulatedEnergino(threading.Thread):
+    """ A pty speaking the serial protocol of an energino sketch. """
+
+    def __init__(self, link,
+                 model=DEFAULT_MODEL,
+                 period=DEFAULT_PERIOD,
+                 voltage=DEFAULT_VOLTAGE,
+                 current=DEFAULT_CURRENT,
+                 faults=None,
+                 boot=0.0):
+
+        super(SimulatedEnergino, self).__init__()
+
+        if model not in MODELS or model == FRAME_MAGIC:
+            raise ValueError("unknown model %s" % model)
+
+        self.daemon = True
+        self.link = link
+        self.model = model
+        self.default_period = period
+        self.voltage = voltage
+        self.current = current
+        self.faults = faults or Faults()
+        self.boot = boot
+        self.stopped = threading.Event()
+
+        self.incoming = ''
+        self.held = []
+        self.silent = 0
+        self.used = 0.0
+        self.relay = 0
+        self.binary = False
+        self.seq = 0
+
+        self.lines = 0
+        self.commands = 0
+        self.corrupted = 0
+        self.bursts = 0
+        self.stalls = 0
+        self.lost = 0
+        self.dropped = 0
+
+        self.reset()
+
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        os.symlink(os.ttyname(self.slave), link)
+
+    def reset(self):
+        """ Restore the default settings, like #R. """
+
+        self.period = self.default_period
+        self.r1 = R1
+        self.r2 = R2
+        self.offset = OFFSET
+        self.sensitivity = SENSITIVITY
+        self.feed = 0
+        self.key = '-'
+        self.url = '-'
+
+    def settings(self):
+        """ Return the settings dump printed on #Z. """
+
+        return ["@magic: %s" % self.model,
+                "@revision: 1",
+                "@period: %u ms" % self.period,
+                "@r1: %u Kohm" % self.r1,
+                "@r2: %u Kohm" % self.r2,
+                "@offset: %u mV" % self.offset,
+                "@sensitivity: %u mV/A" % self.sensitivity,
+                "@apikey: %s" % self.key,
+                "@feedid: %u" % self.feed,
+                "@feedurl: %s" % self.url]
+
+    def execute(self, line):
+        """ Apply a command, return the lines echoed by the sketch. """
+
+        if len(line) < 2 or line[0] != '#':
+            return []
+
+        cmd, value = line[1], line[2:]
+        number = atoi(value)
+
+        self.commands = self.commands + 1
+
+        if cmd == 'R':
+            self.reset()
+            return ["@reset"]
+
+        if cmd == 'Z':
+            return self.settings()
+
+        if cmd == 'T':
+            self.offset = int(self.faults.jitter(OFFSET))
+            return ["@offset: %u" % self.offset]
+
+        if cmd == 'K':
+            self.key = value[:48]
+            return ["@apikey: %s" % self.key]
+
+        if cmd == 'U':
+            self.url = value[:59]
+            return ["@feedurl: %s" % self.url]
+
+        if number < 0:
+            return []
+
+        if cmd == 'F':
+            self.feed = number
+            return ["@feedid: %u" % self.feed]
+
+        if cmd == 'P':
+            self.period = number
+            return ["@period: %ums" % self.period]
+
+        if cmd == 'A':
+            self.r1 = number
+            return ["@r1: %u Kohm" % self.r1]
+
+        if cmd == 'B':
+            self.r2 = number
+            return ["@r2: %u Kohm" % self.r2]
+
+        if cmd == 'C':
+            self.offset = number
+            return ["@offset: %u mV" % self.offset]
+
+        if cmd == 'D':
+            self.sensitivity = number
+            return ["@sensitivity: %u mV/A" % self.sensitivity]
+
+        if cmd == 'M' and self.model in FRAMES:
+            self.binary = number > 0
+            self.seq = 0
+            return ["@mode: %s" % ("binary" if self.binary else "ascii")]
+
+        if cmd == 'S':
+            self.relay = 1 if number > 0 else 0
+            return ["@switch: %s" % ("high" if self.relay else "low")]
+
+        return []
+
+    def measure(self):
+        """ Return voltage, current and power as computed by the sketch. """
+
+        voltage = self.faults.jitter(self.voltage)
+        current = 0.0 if self.relay else self.faults.jitter(self.current)
+
+        # sensor outputs in mV, converted back with the current settings
+        v_out = voltage * 1000.0 * R2 / (R1 + R2)
+        i_out = OFFSET + current * SENSITIVITY
+
+        voltage = v_out * (self.r1 + self.r2) / max(self.r2, 1) / 1000.0
+        current = max(0.0, (i_out - self.offset) / max(self.sensitivity, 1))
+
+        return voltage, current, voltage * current
+
+    def battery(self, voltage, current, power):
+        """ Return the battery level and the minutes left. """
+
+        self.used = self.used + power * self.period / 3600000.0
+
+        level = (voltage - EMPTY) / (FULL - EMPTY)
+        level = min(1.0, max(0.0, level))
+
+        if current < 0.1:
+            return level, -1
+
+        minutes = int((CAPACITY - self.used) / power * 60)
+
+        return level, minutes if minutes >= 10 else 0
+
+    def status(self):
+        """ Return the next status line, or frame in binary mode. """
+
+        voltage, current, power = self.measure()
+
+        samples = min(0xffff, self.period * SAMPLE_RATE // 1000)
+        resolution = AREF / 1024.0
+        v_error = int(resolution * (self.r1 + self.r2) / max(self.r2, 1))
+        i_error = int(resolution / max(self.sensitivity, 1) * 1000)
+
+        if self.binary:
+            body = FRAME.pack(self.seq, voltage, current, power, self.relay,
+                              min(0xffff, self.period), samples, v_error,
+                              i_error, 0)[:-CRC.size]
+            self.seq = (self.seq + 1) & 0xffff
+            return FRAME_SYNC + body + CRC.pack(binascii.crc_hqx(body, 0xFFFF))
+
+        line = "#%s,1,%.3f,%.3f,%.2f,%u,%u,%u" % \
+            (self.model, voltage, current, power, self.relay, self.period,
+             samples)
+
+        if self.model == "EnerginoEthernet":
+            return line + ",%s,%u,%s,%u,%u,%s\n" % \
+                (IP, SERVER_PORT, HOST, HOST_PORT, self.feed, self.key)
+
+        line = line + ",%u,%u" % (v_error, i_error)
+
+        if self.model == "EnerginoAbs":
+            line = line + ",%.2f,%d" % self.battery(voltage, current, power)
+
+        return line + "\n"
+
+    def emit(self, data):
+        """ Send a status line through the fault injector. """
+
+        faults = self.faults
+        self.lines = self.lines + 1
+
+        if time.time() < self.silent:
+            self.lost = self.lost + 1
+            return
+
+        if faults.happens(faults.stall):
+            self.stalls = self.stalls + 1
+            self.lost = self.lost + 1
+            self.silent = time.time() + faults.stall_time
+            return
+
+        if faults.happens(faults.corrupt):
+            self.corrupted = self.corrupted + 1
+            data = faults.mangle(data)
+
+        if self.held:
+            self.held.append(data)
+            if len(self.held) < faults.burst_size:
+                return
+            data = "".join(self.held)
+            self.held = []
+        elif faults.happens(faults.burst):
+            self.bursts = self.bursts + 1
+            self.held = [data]
+            return
+
+        self.write(data)
+
+    def write(self, data):
+        """ Write to the pty, drop data if nobody is reading it. """
+
+        if time.time() < self.silent:
+            return
+
+        _, ready, _ = select.select([], [self.master], [], 0)
+
+        if not ready:
+            self.dropped = self.dropped + 1
+            return
+
+        os.write(self.master, data)
+
+    def receive(self):
+        """ Return the next command received, if any. """
+
+        while select.select([self.master], [], [], 0)[0]:
+            self.incoming = self.incoming + os.read(self.master, 1024)
+
+        if '\n' not in self.incoming:
+            return None
+
+        line, self.incoming = self.incoming.split('\n', 1)
+
+        return line.strip()
+
+    def run(self):
+        """ Parse a command and send a status line every period. """
+
+        if self.stopped.wait(self.boot):
+            return
+
+        while not self.stopped.wait(max(self.period, 1) / 1000.0):
+
+            line = self.receive()
+
+            if line is not None:
+                replies = self.execute(line)
+                if replies and self.model in ECHO:
+                    self.write("".join(reply + "\r\n" for reply in replies))
+
+            self.emit(self.status())
+
+    def stop(self):
+        """ Stop the device and remove its link. """
+
+        self.stopped.set()
+
+        if self.is_alive():
+            self.join()
+
+        if os.path.lexists(self.link):
+            os.unlink(self.link)
+
+        os.close(self.master)
+        os.close(self.slave)
+
+    def report(self):
+        """ Log the fault counters. """
+
+        logging.info("%s (%s): %u lines, %u commands, %u corrupted, "
+                     "%u bursts, %u stalls, %u lost, %u dropped",
+                     self.link, self.model, self.lines, self.commands,
+                     self.corrupted, self.bursts, self.stalls, self.lost,
+                     self.dropped)
+
+
+def free_links(prefix, count):
+    """ Return the first count unused device names matching prefix. """
+
+    links = []
+    index = 0
+
+    while len(links) < count:
+        link = "%s%u" % (prefix, index)
+        if not os.path.lexists(link):
+            links.append(link)
+        index = index + 1
+
+    return links
+
+
+def spawn(prefix=DEFAULT_DEVICE,
+          count=1,
+          models=(DEFAULT_MODEL,),
+          period=DEFAULT_PERIOD,
+          voltage=DEFAULT_VOLTAGE,
+          current=DEFAULT_CURRENT,
+          boot=0.0,
+          **rates):
+    """ Start count devices linked as prefix<n>, cycling through models.
+
+    The remaining keyword arguments are the fault rates, every device
+    gets its own random generator seeded from seed, if given.
+    """
+
+    seed = rates.pop('seed', None)
+    devices = []
+
+    try:
+        for index, link in enumerate(free_links(prefix, count)):
+            faults = Faults(seed=None if seed is None else seed + index,
+                            **rates)
+            device = SimulatedEnergino(link, models[index % len(models)],
+                                       period, voltage, current, faults,
+                                       boot)
+            devices.append(device)
+            device.start()
+    except Exception:
+        for device in devices:
+            device.stop()
+        raise
+
+    return devices
+
+
+def main():
+    """ Launcher method. """
+
+    parser = optparse.OptionParser()
+
+    parser.add_option('--prefix', '-p', dest="prefix",
+                      default=DEFAULT_DEVICE)
+
+    parser.add_option('--devices', '-n',
+                      dest="devices",
+                      type="int",
+                      default=1)
+
+    parser.add_option('--models', '-m',
+                      dest="models",
+                      default=DEFAULT_MODEL)
+
+    parser.add_option('--period', '-i',
+                      dest="period",
+                      type="int",
+                      default=DEFAULT_PERIOD)
+
+    parser.add_option('--voltage', '-V',
+                      dest="voltage",
+                      type="float",
+                      default=DEFAULT_VOLTAGE)
+
+    parser.add_option('--current', '-I',
+                      dest="current",
+                      type="float",
+                      default=DEFAULT_CURRENT)
+
+    parser.add_option('--boot', '-b',
+                      dest="boot",
+                      type="float",
+                      default=0.0)
+
+    parser.add_option('--noise',
+                      dest="noise",
+                      type="float",
+                      default=0.0)
+
+    parser.add_option('--corrupt',
+                      dest="corrupt",
+                      type="float",
+                      default=0.0)
+
+    parser.add_option('--burst',
+                      dest="burst",
+                      type="float",
+                      default=0.0)
+
+    parser.add_option('--burst-size',
+                      dest="burst_size",
+                      type="int",
+                      default=DEFAULT_BURST)
+
+    parser.add_option('--stall',
+                      dest="stall",
+                      type="float",
+                      default=0.0)
+
+    parser.add_option('--stall-time',
+                      dest="stall_time",
+                      type="float",
+                      default=DEFAULT_STALL)
+
+    parser.add_option('--seed',
+                      dest="seed",
+                      type="int",
+                      default=None)
+
+    parser.add_option('--verbose', '-v',
+                      action="store_true",
+                      dest="verbose",
+                      default=False)
+
+    parser.add_option('--log', '-l', dest="log")
+
+    options, _ = parser.parse_args()
+
+    if options.verbose:
+        lvl = logging.DEBUG
+    else:
+        lvl = logging.INFO
+
+    logging.basicConfig(level=lvl,
+                        format=LOG_FORMAT,
+                        filename=options.log,
+                        filemode='w')
+
+    devices = spawn(options.prefix,
+                    options.devices,
+                    options.models.split(","),
+                    options.period,
+                    options.voltage,
+                    options.current,
+                    options.boot,
+                    noise=options.noise,
+                    corrupt=options.corrupt,
+                    burst=options.burst,
+                    burst_size=options.burst_size,
+                    stall=options.stall,
+                    stall_time=options.stall_time,
+                    seed=options.seed)
+
+    for device in devices:
+        logging.info("%s: %s", device.link, device.model)
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        logging.debug("Bye!")
+    finally:
+        for device in devices:
+            device.stop()
+            device.report()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,348 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013, Roberto Riggio
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the CREATE-NET nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY CREATE-NET ''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL CREATE-NET BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Durable on-disk spool for outgoing samples.
+
+Rows are appended as fixed-size binary records (timestamp in ns plus a
+double per column) to segment files named after the offset of their
+first row. The offset of the last acknowledged row is kept in a separate
+file that is replaced atomically, and segments entirely before it are
+deleted. After a crash or restart the spool resumes from the committed
+offset, so nothing but the rows being written at the time is lost and
+the process only keeps the current segment open.
+
+The spool exposes the same append/view/consume interface as RingBuffer.
+"""
+
+from __future__ import absolute_import
+
+import os
+import json
+import struct
+import logging
+
+DEFAULT_SEGMENT_ROWS = 65536
+
+SEGMENT_SUFFIX = '.seg'
+META_FILE = 'meta'
+COMMITTED_FILE = 'committed'
+
+READ_ROWS = 4096
+
+
+def segment_name(offset):
+    """ Return the file name of the segment starting at offset. """
+
+    return "%020u%s" % (offset, SEGMENT_SUFFIX)
+
+
+def spooled_names(path):
+    """ Return the columns of the spool in path, None if there is none. """
+
+    meta = os.path.join(path, META_FILE)
+
+    if not os.path.exists(meta):
+        return None
+
+    with open(meta) as meta_file:
+        return tuple(json.load(meta_file)['names'])
+
+
+class SpoolView(object):
+    """ A view over a range of spooled rows, read back lazily. """
+
+    def __init__(self, spool, first, count):
+        self.spool = spool
+        self.first = first
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def end(self):
+        """ Return the offset following the last row in the view. """
+
+        return self.first + self.count
+
+    def records(self):
+        """ Iterate over the rows as (ts, value, ...) tuples. """
+
+        return self.spool.records(self.first, self.count)
+
+    def iter_ts(self):
+        """ Iterate over the timestamps. """
+
+        for record in self.records():
+            yield record[0]
+
+    def iter_column(self, name):
+        """ Iterate over the values of a column. """
+
+        index = self.spool.index[name] + 1
+
+        for record in self.records():
+            yield record[index]
+
+    def last(self, name):
+        """ Return the value of the last row for a column. """
+
+        for record in self.spool.records(self.end - 1, 1):
+            return record[self.spool.index[name] + 1]
+
+
+class Spool(object):
+    """ Append-only, segment-rotated spool directory. """
+
+    def __init__(self, path, names, segment_rows=DEFAULT_SEGMENT_ROWS,
+                 fsync=False):
+
+        if segment_rows <= 0:
+            raise ValueError("invalid segment size: %s" % segment_rows)
+
+        self.path = path
+        self.names = tuple(names)
+        self.index = dict((name, index) for index, name in
+                          enumerate(self.names))
+        self.record = struct.Struct('<q' + 'd' * len(self.names))
+        self.segment_rows = segment_rows
+        self.fsync = fsync
+        self.dropped = 0
+        self.segments = []
+        self.fd = None
+        self.rows = 0
+        self.first = 0
+        self.size = 0
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        self.check_meta()
+        self.recover()
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def end(self):
+        """ Return the offset following the newest row. """
+
+        return self.first + self.size
+
+    def check_meta(self):
+        """ Make sure the spool was written with the same columns. """
+
+        names = spooled_names(self.path)
+
+        if names is not None:
+            if names != self.names:
+                raise ValueError("spool %s holds columns %s, not %s" %
+                                 (self.path, names, self.names))
+            return
+
+        self.replace(os.path.join(self.path, META_FILE),
+                     json.dumps({'names' : list(self.names)}))
+
+    def recover(self):
+        """ Rebuild offsets from the segments found on disk. """
+
+        committed = 0
+        path = os.path.join(self.path, COMMITTED_FILE)
+
+        if os.path.exists(path):
+            with open(path) as committed_file:
+                committed = int(committed_file.read().strip() or 0)
+
+        for name in sorted(os.listdir(self.path)):
+            if name.endswith(SEGMENT_SUFFIX):
+                self.segments.append(int(name[:-len(SEGMENT_SUFFIX)]))
+
+        if not self.segments:
+            self.segments.append(committed)
+
+        start = self.segments[-1]
+        segment = os.path.join(self.path, segment_name(start))
+        self.fd = open(segment, 'ab')
+        self.fd.seek(0, os.SEEK_END)
+
+        # drop a record torn by a crash in the middle of a write
+        rows = self.fd.tell() // self.record.size
+        if self.fd.tell() != rows * self.record.size:
+            logging.warning("truncating torn record in %s", segment)
+            self.fd.truncate(rows * self.record.size)
+            self.fd.seek(0, os.SEEK_END)
+
+        self.rows = rows
+        self.first = min(max(committed, self.segments[0]), start + rows)
+        self.size = start + rows - self.first
+
+        self.purge()
+
+        if self.size:
+            logging.info("spool %s: resuming with %u samples", self.path,
+                                                               self.size)
+
+    def replace(self, path, data):
+        """ Atomically replace the content of a file. """
+
+        tmp = path + '.tmp'
+
+        with open(tmp, 'w') as tmp_file:
+            tmp_file.write(data)
+            tmp_file.flush()
+            if self.fsync:
+                os.fsync(tmp_file.fileno())
+
+        os.rename(tmp, path)
+
+    def rotate(self):
+        """ Close the current segment and start a new one. """
+
+        if self.fsync:
+            os.fsync(self.fd.fileno())
+
+        self.fd.close()
+        self.segments.append(self.end)
+        self.fd = open(os.path.join(self.path, segment_name(self.end)), 'ab')
+        self.rows = 0
+
+    def write(self, data, rows):
+        """ Write packed records, rotating segments as needed. """
+
+        size = self.record.size
+
+        while rows:
+            # a recovered segment may be larger than segment_rows
+            if self.rows >= self.segment_rows:
+                self.rotate()
+            chunk = min(rows, self.segment_rows - self.rows)
+            self.fd.write(data[:chunk * size])
+            data = data[chunk * size:]
+            self.rows = self.rows + chunk
+            self.size = self.size + chunk
+            rows = rows - chunk
+
+        self.fd.flush()
+
+    def append(self, ts, values):
+        """ Append a row. """
+
+        self.write(self.record.pack(int(ts), *values), 1)
+
+        return True
+
+    def extend(self, ts, columns):
+        """ Append rows given as a timestamp array and one per column. """
+
+        pack = self.record.pack
+        data = b''.join(pack(int(ts[index]),
+                             *[column[index] for column in columns])
+                        for index in range(len(ts)))
+
+        self.write(data, len(ts))
+
+    def records(self, first, count):
+        """ Iterate over count rows starting at offset first. """
+
+        size = self.record.size
+        unpack = self.record.unpack_from
+
+        for start, stop in zip(self.segments,
+                               self.segments[1:] + [self.end]):
+            if stop <= first or count <= 0:
+                continue
+            begin = first - start
+            rows = min(stop - first, count)
+            path = os.path.join(self.path, segment_name(start))
+            with open(path, 'rb') as segment:
+                segment.seek(begin * size)
+                while rows:
+                    chunk = min(rows, READ_ROWS)
+                    data = segment.read(chunk * size)
+                    for offset in range(0, chunk * size, size):
+                        yield unpack(data, offset)
+                    first = first + chunk
+                    count = count - chunk
+                    rows = rows - chunk
+
+    def view(self, count=None):
+        """ Return a view over the oldest count rows (all by default). """
+
+        if count is None or count > self.size:
+            count = self.size
+
+        return SpoolView(self, self.first, count)
+
+    def consume(self, end):
+        """ Acknowledge every row before offset end. """
+
+        count = min(end - self.first, self.size)
+
+        if count <= 0:
+            return
+
+        self.first = self.first + count
+        self.size = self.size - count
+        self.replace(os.path.join(self.path, COMMITTED_FILE),
+                     "%u\n" % self.first)
+        self.purge()
+
+    def purge(self):
+        """ Delete the segments made only of acknowledged rows. """
+
+        while len(self.segments) > 1 and self.segments[1] <= self.first:
+            start = self.segments.pop(0)
+            os.remove(os.path.join(self.path, segment_name(start)))
+
+    def close(self):
+        """ Close the current segment. """
+
+        if self.fsync:
+            os.fsync(self.fd.fileno())
+
+        self.fd.close()
+
+    def remove(self):
+        """ Close the spool and delete its files, once fully consumed. """
+
+        if self.size:
+            raise ValueError("spool %s still holds %u samples" %
+                             (self.path, self.size))
+
+        self.fd.close()
+
+        for start in self.segments:
+            os.remove(os.path.join(self.path, segment_name(start)))
+
+        for name in (META_FILE, COMMITTED_FILE):
+            if os.path.exists(os.path.join(self.path, name)):
+                os.remove(os.path.join(self.path, name))
+
+        # the directory may hold the spools of other ports
+        if not os.listdir(self.path):
+            os.rmdir(self.path)
@@ -0,0 +1,469 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013, Roberto Riggio
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the CREATE-NET nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY CREATE-NET ''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL CREATE-NET BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Incremental energy accounting and rolling statistics.
+
+Energy is integrated with the trapezoidal rule over the device window
+of each sample, a gap longer than GAP_WINDOWS windows starts again from
+the next sample. Rolling statistics cover the samples of the last window
+seconds: mean and variance come from running sums, min and max from
+monotonic queues and quantiles from a log-bucketed histogram with a
+bounded relative error. Adding a sample costs O(1) amortized time and
+mean, variance, min and max are read in O(1). A quantile walks the
+sorted buckets: their number only depends on the range of the values
+and on the accuracy (a few hundred for six decades at 1%), never on the
+number of samples.
+"""
+
+from __future__ import absolute_import
+
+import math
+import logging
+
+from bisect import bisect_left
+from bisect import insort
+from collections import deque
+
+from energino.clock import NS_PER_MS
+from energino.clock import NS_PER_S
+
+NAN = float('nan')
+
+DEFAULT_WINDOW = 3600
+DEFAULT_QUANTILES = (0.5, 0.95)
+DEFAULT_ACCURACY = 0.01
+
+MS_PER_HOUR = 3600 * 1000.0
+
+# values closer to zero than this share the zero bucket
+ZERO = 1e-9
+
+# samples further apart than this many windows are not integrated, the
+# device was most likely stalled, unplugged or restarted
+GAP_WINDOWS = 1.5
+
+
+class Sketch(object):
+    """ Histogram with logarithmic buckets, supporting removals.
+
+    Quantiles are within a relative error of accuracy.
+    """
+
+    def __init__(self, accuracy=DEFAULT_ACCURACY):
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.positive = {}
+        self.negative = {}
+        # bucket indices in ascending order, for quantile()
+        self.positive_keys = []
+        self.negative_keys = []
+        self.zero = 0
+        self.count = 0
+
+    def bucket(self, value):
+        """ Return the histogram, its sorted indices and the bucket index
+        of value.
+        """
+
+        if value > ZERO:
+            return self.positive, self.positive_keys, \
+                int(math.ceil(math.log(value) / self.log_gamma))
+
+        if value < -ZERO:
+            return self.negative, self.negative_keys, \
+                int(math.ceil(math.log(-value) / self.log_gamma))
+
+        return None, None, 0
+
+    def add(self, value, count=1):
+        """ Add (or, with a negative count, remove) a value. """
+
+        buckets, keys, index = self.bucket(value)
+        self.count = self.count + count
+
+        if buckets is None:
+            self.zero = self.zero + count
+            return
+
+        total = buckets.get(index, 0) + count
+
+        if total:
+            if index not in buckets:
+                insort(keys, index)
+            buckets[index] = total
+        else:
+            del buckets[index]
+            del keys[bisect_left(keys, index)]
+
+    def remove(self, value):
+        """ Remove a value previously added. """
+
+        self.add(value, -1)
+
+    def value(self, index):
+        """ Return the representative value of a bucket. """
+
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+    def quantile(self, fraction):
+        """ Return the value at the given fraction, None if empty. """
+
+        if not self.count:
+            return None
+
+        rank = fraction * (self.count - 1)
+        seen = 0
+
+        for index in reversed(self.negative_keys):
+            seen = seen + self.negative[index]
+            if seen > rank:
+                return -self.value(index)
+
+        seen = seen + self.zero
+        if seen > rank:
+            return 0.0
+
+        for index in self.positive_keys:
+            seen = seen + self.positive[index]
+            if seen > rank:
+                return self.value(index)
+
+        return self.value(self.positive_keys[-1])
+
+
+class Rolling(object):
+    """ Statistics over the samples of the last window seconds. """
+
+    def __init__(self, window=DEFAULT_WINDOW, accuracy=DEFAULT_ACCURACY):
+        self.window = window * NS_PER_S
+        self.samples = deque()
+        self.lows = deque()
+        self.highs = deque()
+        self.sketch = Sketch(accuracy)
+        self.shift = None
+        self.total = 0.0
+        self.squares = 0.0
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self.samples)
+
+    def add(self, ts, value):
+        """ Add a sample taken at ts (in ns). """
+
+        if self.shift is None:
+            # sums are kept around the first value, for precision
+            self.shift = value
+
+        self.samples.append((ts, value))
+        self.sketch.add(value)
+        self.total = self.total + value - self.shift
+        self.squares = self.squares + (value - self.shift) ** 2
+
+        while self.lows and self.lows[-1][1] >= value:
+            self.lows.pop()
+        self.lows.append((ts, value))
+
+        while self.highs and self.highs[-1][1] <= value:
+            self.highs.pop()
+        self.highs.append((ts, value))
+
+        self.expire(ts)
+
+    def expire(self, now):
+        """ Drop the samples older than the window. """
+
+        oldest = now - self.window
+
+        while self.samples and self.samples[0][0] <= oldest:
+            _, value = self.samples.popleft()
+            self.sketch.remove(value)
+            self.total = self.total - (value - self.shift)
+            self.squares = self.squares - (value - self.shift) ** 2
+            self.evicted = self.evicted + 1
+
+        while self.lows and self.lows[0][0] <= oldest:
+            self.lows.popleft()
+
+        while self.highs and self.highs[0][0] <= oldest:
+            self.highs.popleft()
+
+        # rounding errors pile up with removals, start again once in a
+        # while (amortized O(1), every window worth of samples)
+        if self.evicted > len(self.samples):
+            self.resum()
+
+    def resum(self):
+        """ Recompute the running sums from the samples in the window. """
+
+        self.evicted = 0
+        self.shift = self.samples[0][1] if self.samples else None
+        self.total = 0.0
+        self.squares = 0.0
+
+        for _, value in self.samples:
+            self.total = self.total + value - self.shift
+            self.squares = self.squares + (value - self.shift) ** 2
+
+    @property
+    def mean(self):
+        """ Return the mean, None if there are no samples. """
+
+        if not self.samples:
+            return None
+
+        return self.shift + self.total / len(self.samples)
+
+    @property
+    def variance(self):
+        """ Return the (population) variance, None if there are no samples. """
+
+        count = len(self.samples)
+
+        if not count:
+            return None
+
+        return max(0.0, (self.squares - self.total ** 2 / count) / count)
+
+    @property
+    def stddev(self):
+        """ Return the standard deviation, None if there are no samples. """
+
+        if not self.samples:
+            return None
+
+        return math.sqrt(self.variance)
+
+    @property
+    def min(self):
+        """ Return the minimum, None if there are no samples. """
+
+        return self.lows[0][1] if self.lows else None
+
+    @property
+    def max(self):
+        """ Return the maximum, None if there are no samples. """
+
+        return self.highs[0][1] if self.highs else None
+
+    def quantile(self, fraction):
+        """ Return a quantile, None if there are no samples. """
+
+        return self.sketch.quantile(fraction)
+
+
+class EnergyMeter(object):
+    """ Energy in Wh, in total and over the last window seconds. """
+
+    def __init__(self, window=DEFAULT_WINDOW):
+        self.window = window * NS_PER_S
+        self.total = 0.0
+        self.recent = deque()
+        self.last = 0.0
+        self.power = None
+        self.ts = None
+
+    def add(self, ts, power, window):
+        """ Account for a sample averaged over window ms, return its Wh. """
+
+        if self.ts is not None and \
+                not 0 < ts - self.ts <= GAP_WINDOWS * window * NS_PER_MS:
+            # samples were lost or the device restarted, do not bridge
+            # the gap with the power measured before it
+            self.power = None
+
+        if self.power is None:
+            energy = power * window / MS_PER_HOUR
+        else:
+            energy = (self.power + power) / 2.0 * window / MS_PER_HOUR
+
+        self.power = power
+        self.ts = ts
+        self.total = self.total + energy
+        self.recent.append((ts, energy))
+        self.last = self.last + energy
+
+        oldest = ts - self.window
+
+        while self.recent and self.recent[0][0] <= oldest:
+            self.last = self.last - self.recent.popleft()[1]
+
+        if not self.recent:
+            self.last = 0.0
+
+        return energy
+
+
+def quantile_name(stream, fraction):
+    """ Return the name of a quantile stream, e.g. power_p95. """
+
+    return "%s_p%s" % (stream, ("%g" % (fraction * 100)).replace('.', '_'))
+
+
+class Aggregator(object):
+    """ Energy and rolling statistics, as extra streams.
+
+    Rolling statistics are kept for every (port, stream) pair and energy
+    for every port, so that the samples of different devices never end
+    up in the same window.
+    """
+
+    def __init__(self, streams=(), window=DEFAULT_WINDOW,
+                 quantiles=DEFAULT_QUANTILES, energy=True):
+        self.streams = tuple(streams)
+        self.window = window
+        self.quantiles = tuple(quantiles)
+        self.energy = energy
+        self.meters = {}
+        self.rolling = {}
+
+    @property
+    def enabled(self):
+        """ Return True if there is any stream to derive. """
+
+        return self.energy or bool(self.streams)
+
+    def meter(self, port):
+        """ Return the energy meter of port. """
+
+        if port not in self.meters:
+            self.meters[port] = EnergyMeter(self.window)
+
+        return self.meters[port]
+
+    def series(self, port, stream):
+        """ Return the rolling statistics of stream on port. """
+
+        key = (port, stream)
+
+        if key not in self.rolling:
+            self.rolling[key] = Rolling(self.window)
+
+        return self.rolling[key]
+
+    def names(self):
+        """ Return the (name, label, symbol) of every derived stream. """
+
+        names = []
+
+        if self.energy:
+            names.append(('energy', 'Energy', 'Wh'))
+            names.append(('energy_window',
+                          'Energy (last %us)' % self.window, 'Wh'))
+
+        for stream in self.streams:
+            names.append((stream + '_mean', stream + ' mean', ''))
+            names.append((stream + '_min', stream + ' min', ''))
+            names.append((stream + '_max', stream + ' max', ''))
+            names.append((stream + '_stddev', stream + ' stddev', ''))
+            for fraction in self.quantiles:
+                names.append((quantile_name(stream, fraction),
+                              "%s %g%%" % (stream, fraction * 100), ''))
+
+        return names
+
+    def account(self, port, ts, values, window):
+        """ Account for a sample of port, values maps streams to values. """
+
+        if self.energy and 'power' in values:
+            self.meter(port).add(ts, values['power'], window)
+
+        for stream in self.streams:
+            self.series(port, stream).add(ts, values[stream])
+
+    def values(self, port):
+        """ Return the current value of every derived stream of port. """
+
+        values = {}
+
+        if self.energy:
+            meter = self.meter(port)
+            values['energy'] = meter.total
+            values['energy_window'] = meter.last
+
+        for stream in self.streams:
+            rolling = self.series(port, stream)
+            values[stream + '_mean'] = rolling.mean
+            values[stream + '_min'] = rolling.min
+            values[stream + '_max'] = rolling.max
+            values[stream + '_stddev'] = rolling.stddev
+            for fraction in self.quantiles:
+                values[quantile_name(stream, fraction)] = \
+                    rolling.quantile(fraction)
+
+        return values
+
+    def update(self, readings):
+        """ Account for a reading and add the derived streams to it. """
+
+        port = readings['port']
+        self.account(port, readings['ts'], readings, readings['window'])
+
+        for name, value in self.values(port).items():
+            readings[name] = NAN if value is None else value
+
+        return readings
+
+    def update_batch(self, batch):
+        """ Account for a batch and add the derived streams as columns.
+
+        Derived values are only set on the last row, the others are NaN:
+        consecutive rows of a batch are a few ms apart and would repeat
+        nearly the same statistics.
+        """
+
+        wanted = set(self.streams) | set(['power'])
+        sources = dict((stream, batch.columns[stream]) for stream in wanted
+                       if stream in batch.columns)
+
+        for index in range(len(batch)):
+            values = dict((stream, column[index])
+                          for stream, column in sources.items())
+            self.account(batch.port, batch.ts[index], values,
+                         batch.window[index])
+
+        rows = len(batch)
+
+        for name, value in self.values(batch.port).items():
+            column = [NAN] * rows
+            if rows:
+                column[-1] = NAN if value is None else value
+            batch.columns[name] = column
+
+        return batch
+
+    def report(self):
+        """ Log the energy counters of every device. """
+
+        for port in sorted(self.meters):
+            meter = self.meters[port]
+            logging.info("%s: %.4f Wh total, %.4f Wh in the last %us",
+                         port,
+                         meter.total,
+                         meter.last,
+                         meter.window // NS_PER_S)
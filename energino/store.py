@@ -0,0 +1,463 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013, Roberto Riggio
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the CREATE-NET nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY CREATE-NET ''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL CREATE-NET BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Multi-resolution time-series store on top of sqlite.
+
+Every (port, stream) pair is a series. Raw samples are kept for a short
+retention, and are rolled up in 1s, 1min and 1h buckets holding count,
+min, max, sum and energy. Energy is the time integral of the value in
+unit-hours (Wh for power), using the trapezoidal rule between
+consecutive samples. Rollups are computed incrementally as samples come
+in, so they are never recomputed from raw data. Tables are keyed by
+(series, time), so a range query is an index range scan on the finest
+tier that answers it with a bounded number of points.
+
+Raw samples can go through a lossy filter per stream (see compression),
+rollups are always computed from every sample.
+
+Samples are committed at most once per second. The database is in WAL
+mode, so other threads and processes can query it while it is written.
+"""
+
+from __future__ import absolute_import
+
+import time
+import sqlite3
+import optparse
+import threading
+
+from collections import namedtuple
+
+from energino.clock import format_ns
+from energino.clock import now_ns
+from energino.clock import NS_PER_S
+from energino.compression import make_filter
+from energino.compression import DEFAULT_HEARTBEAT
+from energino.compression import NONE
+
+DEFAULT_STREAMS = ('voltage', 'current', 'power', 'switch')
+
+DEFAULT_POINTS = 1000
+
+# (resolution in seconds, retention in seconds, 0 means forever)
+RAW = 0
+TIERS = [(RAW, 24 * 3600),
+         (1, 7 * 24 * 3600),
+         (60, 366 * 24 * 3600),
+         (3600, 0)]
+
+COMMIT_INTERVAL = 1
+PURGE_INTERVAL = 3600
+
+# longer gaps are not integrated, the meter was most likely off
+MAX_GAP = 10 * NS_PER_S
+
+NS_PER_HOUR = 3600 * NS_PER_S
+
+Point = namedtuple('Point', ['ts', 'count', 'min', 'max', 'mean', 'energy'])
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS series (id INTEGER PRIMARY KEY,
+                                   port TEXT,
+                                   stream TEXT,
+                                   UNIQUE (port, stream));
+CREATE TABLE IF NOT EXISTS raw (series INTEGER,
+                                ts INTEGER,
+                                value REAL,
+                                PRIMARY KEY (series, ts));
+"""
+
+ROLLUP = """
+CREATE TABLE IF NOT EXISTS rollup_%u (series INTEGER,
+                                      bucket INTEGER,
+                                      count INTEGER,
+                                      min REAL,
+                                      max REAL,
+                                      sum REAL,
+                                      energy REAL,
+                                      PRIMARY KEY (series, bucket));
+"""
+
+
+class Series(object):
+    """ Write-side state of a series: last sample and open buckets. """
+
+    def __init__(self, ident, raw_filter=None):
+        self.ident = ident
+        self.last = None
+        self.buckets = {}
+        self.filter = raw_filter
+
+
+class Store(object):
+    """ A rollup store in a sqlite database. """
+
+    def __init__(self, path, streams=DEFAULT_STREAMS, tiers=None,
+                 compression=None, heartbeat=DEFAULT_HEARTBEAT):
+        self.path = path
+        self.streams = tuple(streams)
+        self.tiers = list(tiers or TIERS)
+        self.compression = dict(compression or {})
+        self.heartbeat = heartbeat
+        self.local = threading.local()
+        self.series = {}
+        self.raw = []
+        self.closed = []
+        self.committed = time.time()
+        self.purged = 0
+
+        conn = self.connect()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(SCHEMA)
+        for resolution, _ in self.rollups():
+            conn.executescript(ROLLUP % resolution)
+        conn.commit()
+
+    def rollups(self):
+        """ Return the rollup tiers. """
+
+        return [tier for tier in self.tiers if tier[0] != RAW]
+
+    def connect(self):
+        """ Return the connection of the calling thread. """
+
+        conn = getattr(self.local, 'conn', None)
+
+        if conn is None:
+            conn = sqlite3.connect(self.path)
+            self.local.conn = conn
+
+        return conn
+
+    def get_series(self, port, stream):
+        """ Return the write-side state of a series, creating it. """
+
+        key = (port, stream)
+
+        if key not in self.series:
+            conn = self.connect()
+            conn.execute("INSERT OR IGNORE INTO series (port, stream) "
+                         "VALUES (?, ?)", key)
+            ident = conn.execute("SELECT id FROM series WHERE port = ? AND "
+                                 "stream = ?", key).fetchone()[0]
+            method, tolerance = self.compression.get(stream, (NONE, 0))
+            self.series[key] = Series(ident, make_filter(method, tolerance,
+                                                         self.heartbeat))
+
+        return self.series[key]
+
+    def add(self, readings):
+        """ Add a reading (as returned by PyEnergino.fetch()). """
+
+        for stream in self.streams:
+            if stream in readings:
+                self.add_sample(readings['port'], stream, readings['ts'],
+                                float(readings[stream]))
+
+        self.maybe_commit()
+
+    def add_batch(self, batch):
+        """ Add a batch (as returned by PyEnergino.fetch_many()). """
+
+        for stream in self.streams:
+            if stream not in batch.columns:
+                continue
+            column = batch.columns[stream]
+            for index in range(len(batch)):
+                self.add_sample(batch.port, stream, batch.ts[index],
+                                float(column[index]))
+
+        self.maybe_commit()
+
+    def add_sample(self, port, stream, ts, value):
+        """ Add a sample to the raw table and to every rollup. """
+
+        series = self.get_series(port, stream)
+        energy = 0.0
+
+        if series.last is not None:
+            last_ts, last_value = series.last
+            elapsed = ts - last_ts
+            if elapsed <= 0:
+                return
+            if elapsed <= MAX_GAP:
+                energy = (last_value + value) / 2.0 * elapsed / NS_PER_HOUR
+
+        series.last = (ts, value)
+
+        if self.tiers[0][0] == RAW:
+            self.add_raw(series, ts, value)
+
+        for resolution, _ in self.rollups():
+            bucket = ts - ts % (resolution * NS_PER_S)
+            current = series.buckets.get(resolution)
+            if current is None or current[0] != bucket:
+                if current is not None:
+                    self.closed.append((resolution, series.ident, current))
+                current = self.open_bucket(resolution, series.ident, bucket)
+                series.buckets[resolution] = current
+            current[1] = current[1] + 1
+            current[2] = min(current[2], value)
+            current[3] = max(current[3], value)
+            current[4] = current[4] + value
+            current[5] = current[5] + energy
+
+    def open_bucket(self, resolution, ident, bucket):
+        """ Return a bucket, resuming it if it is already stored. """
+
+        row = self.connect().execute("SELECT count, min, max, sum, energy "
+                                     "FROM rollup_%u WHERE series = ? AND "
+                                     "bucket = ?" % resolution,
+                                     (ident, bucket)).fetchone()
+
+        if row is None:
+            return [bucket, 0, float('inf'), float('-inf'), 0.0, 0.0]
+
+        return [bucket] + list(row)
+
+    def maybe_commit(self):
+        """ Commit if the last commit is older than COMMIT_INTERVAL. """
+
+        if time.time() - self.committed >= COMMIT_INTERVAL:
+            self.commit()
+
+    def commit(self):
+        """ Write raw samples and buckets, open buckets included. """
+
+        conn = self.connect()
+
+        conn.executemany("INSERT OR REPLACE INTO raw VALUES (?, ?, ?)",
+                         self.raw)
+
+        rows = list(self.closed)
+        for series in self.series.values():
+            for resolution, current in series.buckets.items():
+                rows.append((resolution, series.ident, current))
+
+        for resolution, ident, current in rows:
+            conn.execute("INSERT OR REPLACE INTO rollup_%u VALUES "
+                         "(?, ?, ?, ?, ?, ?, ?)" % resolution,
+                         [ident] + current)
+
+        conn.commit()
+
+        self.raw = []
+        self.closed = []
+        self.committed = time.time()
+
+        if self.committed - self.purged >= PURGE_INTERVAL:
+            self.purge()
+
+    def purge(self, now=None):
+        """ Delete what is past the retention of each tier. """
+
+        now = now or now_ns()
+        conn = self.connect()
+        idents = [row[0] for row in conn.execute("SELECT id FROM series")]
+
+        for resolution, retention in self.tiers:
+            if not retention:
+                continue
+            cutoff = now - retention * NS_PER_S
+            if resolution == RAW:
+                query = "DELETE FROM raw WHERE series = ? AND ts < ?"
+            else:
+                query = "DELETE FROM rollup_%u WHERE series = ? AND " \
+                        "bucket < ?" % resolution
+            for ident in idents:
+                conn.execute(query, (ident, cutoff))
+
+        conn.commit()
+        self.purged = time.time()
+
+    def list_series(self):
+        """ Return the stored (port, stream) pairs. """
+
+        return self.connect().execute("SELECT port, stream FROM series "
+                                      "ORDER BY port, stream").fetchall()
+
+    def query(self, port, stream, start, end, points=DEFAULT_POINTS):
+        """ Return the resolution used and the Points between start and end.
+
+        The finest tier that covers start and has no more than points
+        rows in the range is used. Times are in ns, resolution in s.
+        """
+
+        conn = self.connect()
+        row = conn.execute("SELECT id FROM series WHERE port = ? AND "
+                           "stream = ?", (port, stream)).fetchone()
+
+        if row is None:
+            return None, []
+
+        ident = row[0]
+        now = now_ns()
+        coarsest = self.tiers[-1][0]
+
+        for resolution, retention in self.tiers:
+
+            if retention and start < now - retention * NS_PER_S and \
+               resolution != coarsest:
+                continue
+
+            if resolution == RAW:
+                rows = conn.execute("SELECT ts, value FROM raw WHERE "
+                                    "series = ? AND ts >= ? AND ts < ? "
+                                    "ORDER BY ts LIMIT ?",
+                                    (ident, start, end, points + 1))
+                rows = rows.fetchall()
+                if len(rows) <= points:
+                    return RAW, [Point(ts, 1, value, value, value, None)
+                                 for ts, value in rows]
+                continue
+
+            if (end - start) // (resolution * NS_PER_S) > points and \
+               resolution != coarsest:
+                continue
+
+            rows = conn.execute("SELECT bucket, count, min, max, sum, energy "
+                                "FROM rollup_%u WHERE series = ? AND "
+                                "bucket >= ? AND bucket < ? ORDER BY bucket"
+                                % resolution,
+                                (ident, start - start % (resolution *
+                                                         NS_PER_S), end))
+
+            return resolution, [Point(bucket, count, low, high,
+                                      total / count, energy)
+                                for bucket, count, low, high, total, energy
+                                in rows if count]
+
+        return None, []
+
+    def energy(self, port, start, end, stream='power'):
+        """ Return the energy in Wh between start and end.
+
+        The range is widened to the buckets of the tier picked by query().
+        """
+
+        _, points = self.query(port, stream, start, end)
+
+        return sum(point.energy or 0.0 for point in points)
+
+    def add_raw(self, series, ts, value):
+        """ Queue a raw sample, unless the filter of the series drops it.
+
+        Filters decide about a sample when the next one arrives.
+        """
+
+        if series.filter is None:
+            self.raw.append((series.ident, ts, value))
+            return
+
+        held = series.filter.held
+
+        if series.filter.offer(ts, value):
+            self.raw.append((series.ident, held[0], held[1]))
+
+    def close(self):
+        """ Commit and close the connection of the calling thread. """
+
+        for series in self.series.values():
+            if series.filter is None:
+                continue
+            held = series.filter.flush()
+            if held is not None and held[1] == held[1]:
+                self.raw.append((series.ident, held[0], held[1]))
+
+        self.commit()
+        self.connect().close()
+        self.local.conn = None
+
+
+def main():
+    """ Query a store. """
+
+    parser = optparse.OptionParser(usage="%prog [options] store.db")
+
+    parser.add_option('--port', '-p', dest="port")
+
+    parser.add_option('--stream', '-s',
+                      dest="stream",
+                      default="power")
+
+    parser.add_option('--start', '-f',
+                      dest="start",
+                      type="float",
+                      default=-3600,
+                      help="start, in s (negative: relative to now)")
+
+    parser.add_option('--end', '-t',
+                      dest="end",
+                      type="float",
+                      default=0,
+                      help="end, in s (zero or negative: relative to now)")
+
+    parser.add_option('--points', '-n',
+                      dest="points",
+                      type="int",
+                      default=DEFAULT_POINTS)
+
+    options, args = parser.parse_args()
+
+    if len(args) != 1:
+        parser.error("store path missing")
+
+    store = Store(args[0])
+
+    if not options.port:
+        for port, stream in store.list_series():
+            print("%s %s" % (port, stream))
+        return
+
+    now = now_ns()
+    start = int(options.start * NS_PER_S)
+    end = int(options.end * NS_PER_S)
+
+    if start < 0:
+        start = now + start
+
+    if end <= 0:
+        end = now + end
+
+    resolution, points = store.query(options.port, options.stream, start,
+                                     end, options.points)
+
+    print("# resolution %ss, %u points" % (resolution, len(points)))
+
+    for point in points:
+        print("%s,%u,%.3f,%.3f,%.3f,%s" % (format_ns(point.ts),
+                                           point.count,
+                                           point.min,
+                                           point.max,
+                                           point.mean,
+                                           "" if point.energy is None else
+                                           "%.6f" % point.energy))
+
+
+if __name__ == "__main__":
+    main()
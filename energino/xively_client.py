@@ -29,6 +29,8 @@
 A system daemon interfacing energino with Xively
 """
 
+from __future__ import absolute_import
+
 import signal
 import logging
 import sys
@@ -36,13 +38,53 @@ import optparse
 import os.path
 import time
 import httplib
+import socket
 import threading
 import ConfigParser
-import json
 
-from collections import deque
 
+from energino.clock import format_ns
+from energino.httppool import HTTPPool
+from energino.feed import chunks
+from energino.feed import encode_csv
+from energino.feed import encode_json
+from energino.feed import CONTENT_TYPES
+from energino.feed import FORMAT_CSV
+from energino.feed import FORMAT_JSON
+from energino.feed import FORMATS
+from energino.compression import Compressor
+from energino.compression import make_filter
+from energino.compression import DEFAULT_HEARTBEAT
+from energino.compression import NONE
+from energino.retry import classify
+from energino.retry import retry_after
+from energino.retry import Backoff
+from energino.retry import CircuitBreaker
+from energino.retry import DEFAULT_BACKOFF_BASE
+from energino.retry import DEFAULT_BACKOFF_MAX
+from energino.retry import DEFAULT_BREAKER_FAILURES
+from energino.retry import DEFAULT_BREAKER_COOLDOWN
+from energino.retry import SUCCESS
+from energino.retry import RETRY
+from energino.retry import REJECTED
+from energino.retry import TOO_LARGE
+from energino.retry import UNAUTHORIZED
+from energino.ringbuffer import RingBuffer
+from energino.ringbuffer import DoubleBuffer
+from energino.ringbuffer import DEFAULT_CAPACITY
+from energino.ringbuffer import DROP_OLDEST
+from energino.spool import Spool
+from energino.spool import spooled_names
+from energino.spool import DEFAULT_SEGMENT_ROWS
+from energino.stats import Aggregator
+from energino.stats import DEFAULT_WINDOW
+from energino.metrics import Registry
+from energino.metrics import MetricsServer
+from energino.metrics import parse_listen
+from energino.energino import drift
 from energino.energino import PyEnergino
+from energino.fleet import PyEnerginoFleet
+from energino.nonblocking import AsyncFleet
 from energino.energino import DEFAULT_INTERVAL
 from energino.energino import DEFAULT_DEVICE
 from energino.energino import DEFAULT_DEVICE_SPEED_BPS
@@ -52,123 +94,603 @@ DEFAULT_CONFIG = '/etc/xively.conf'
 DEFAULT_HOST = 'api.xively.com'
 DEFAULT_PORT = "80"
 DEFAULT_PERIOD = "10"
+DEFAULT_BUFFER = str(DEFAULT_CAPACITY)
+DEFAULT_SEGMENT = str(DEFAULT_SEGMENT_ROWS)
+
+# spool subdirectory of the datastreams fed by every port
+DEFAULT_SPOOL = "default"
+DEFAULT_FLUSH_SAMPLES = "600"
+DEFAULT_FLUSH_BYTES = "262144"
+DEFAULT_PUT_SAMPLES = "500"
+
+# approximate size of a JSON datapoint, used to estimate payload sizes
+DATAPOINT_BYTES = 60
 
 LOG_FORMAT = '%(asctime)-15s %(message)s'
 
+DEFAULT_BACKOFF = str(DEFAULT_BACKOFF_MAX)
+DEFAULT_FAILURES = str(DEFAULT_BREAKER_FAILURES)
+DEFAULT_COOLDOWN = str(DEFAULT_BREAKER_COOLDOWN)
+DEFAULT_DISCOVERY_TTL = "3600"
+DEFAULT_STATS_WINDOW = str(DEFAULT_WINDOW)
+DEFAULT_QUANTILES = "0.5,0.95"
+
+# upload latency in s, polling drift in ms
+UPLOAD_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+DRIFT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000)
+
 BACKOFF = 60
 
+
+def datastream_id(stream, port=None):
+    """ Return the datastream id of stream on port, e.g. power-ttyACM0. """
+
+    if port is None:
+        return stream
+
+    return "%s-%s" % (stream, os.path.basename(port))
+
+
+class PortQueue(object):
+    """ Rows of a single port on their way to Xively.
+
+    Rows only have the columns of the port: names are the datastream
+    ids, streams the reading keys feeding them. The reader thread fills
+    incoming, the dispatcher thread drains it into outgoing.
+    """
+
+    def __init__(self, port, names, streams, outgoing, leftover=False):
+        self.port = port
+        self.names = tuple(names)
+        self.streams = tuple(streams)
+        self.incoming = DoubleBuffer(self.names)
+        self.outgoing = outgoing
+        # spooled by an earlier run, uploaded and then removed
+        self.leftover = leftover
+        # nothing is dropped until the configured filters are set up
+        self.compressor = Compressor(())
+
+    def __len__(self):
+        return len(self.incoming) + len(self.outgoing)
+
+    def drain(self):
+        """ Move the queued rows to the outgoing buffer. """
+
+        try:
+            self.incoming.drain(self.outgoing)
+        except BufferError:
+            # the rows that did not fit wait for the next upload
+            logging.warning("buffer full, %u samples waiting",
+                            len(self.incoming))
+
+    def flush(self):
+        """ Queue the row held back by the compressor, if any. """
+
+        row = self.compressor.flush()
+
+        if row is not None:
+            self.incoming.append(row[0], row[1])
+
+
 class DispatcherProcedure(threading.Thread):
     """ DispatcherProcedure class. Handles communication with Xively. """
 
-    def __init__(self, dispatcher):
+    def __init__(self, dispatcher, registry=None):
         super(DispatcherProcedure, self).__init__()
         self.daemon = True
         self.dispatcher = dispatcher
         self.stop = threading.Event()
-        self.outgoing = deque()
         self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
         self.streams = {}
+        self.sources = {}
+        self.integers = set()
+        self.queues = {}
+        self.dropped = 0
+        self.backoff = Backoff()
+        self.breaker = CircuitBreaker()
+
+        registry = registry or Registry()
+        registry.collect(self.collect)
+
+        self.depth = registry.gauge("energino_queue_depth",
+                                    "Samples waiting to be uploaded.")
+        self.dropped_total = registry.counter(
+            "energino_queue_dropped_total",
+            "Samples dropped because the queue was full.")
+        self.uploaded = registry.counter(
+            "energino_upload_samples_total",
+            "Samples acknowledged by the server.")
+        self.upload_bytes = registry.counter(
+            "energino_upload_bytes_total",
+            "Bytes of feed updates sent.")
+        self.upload_seconds = registry.histogram(
+            "energino_upload_seconds",
+            "Time to send a feed update and read the response.",
+            UPLOAD_BUCKETS)
+        self.responses = registry.counter(
+            "energino_upload_responses_total",
+            "Responses to feed updates, by HTTP status.", ("status",))
+        self.upload_errors = registry.counter(
+            "energino_upload_errors_total",
+            "Feed updates failed without a response.")
+        self.rollbacks = registry.counter(
+            "energino_upload_rollbacks_total",
+            "Failed feed updates whose samples were kept for a retry.")
 
     def shutdown(self):
         """ Shutdown dispatcher. """
 
         logging.info("shutting down dispatcher")
+
+        for queue in self.queues.values():
+            queue.flush()
+
         self.stop.set()
 
+        with self.wakeup:
+            self.wakeup.notify()
+
+    def start(self):
+        self.open_queues()
+        config = self.dispatcher.config
+        self.backoff = Backoff(DEFAULT_BACKOFF_BASE, config['backoff_max'])
+        self.breaker = CircuitBreaker(config['breaker_failures'],
+                                      config['breaker_cooldown'])
+        self.open_compressors()
+        super(DispatcherProcedure, self).start()
+
+    def open_compressors(self):
+        """ Set up the compressor of every port, for the configured streams.
+
+        Filters keep state between samples, each device needs its own.
+        """
+
+        compression = self.dispatcher.config['compression']
+        heartbeat = self.dispatcher.config['heartbeat']
+
+        for queue in self.queues.values():
+            filters = []
+            for name, stream in zip(queue.names, queue.streams):
+                method, tolerance = compression.get(stream, (NONE, 0))
+                logging.info("stream %s: %s %s", name, method, tolerance)
+                filters.append(make_filter(method, tolerance, heartbeat))
+            queue.compressor = Compressor(filters)
+
+    def open_queues(self):
+        """ Set up a queue per port, one column per datastream of the port. """
+
+        columns = {}
+
+        for name in sorted(self.streams):
+            port, stream = self.sources[name]
+            columns.setdefault(port, []).append((name, stream))
+
+        self.queues = {}
+
+        for port in sorted(columns, key=str):
+            names = [name for name, _ in columns[port]]
+            streams = [stream for _, stream in columns[port]]
+            self.queues[port] = PortQueue(port, names, streams,
+                                          self.open_buffer(port, names,
+                                                           len(columns)))
+
+        if self.dispatcher.config['spool']:
+            self.open_leftovers()
+
+    def spool_path(self, port):
+        """ Return the spool directory of port. """
+
+        name = DEFAULT_SPOOL if port is None else os.path.basename(port)
+
+        return os.path.join(self.dispatcher.config['spool'], name)
+
+    def open_buffer(self, port, names, ports=1):
+        """ Return the outgoing buffer of port, on disk if spooling.
+
+        The configured buffer size is shared by the ports.
+        """
+
+        config = self.dispatcher.config
+
+        if config['spool']:
+            path = self.spool_path(port)
+            spooled = spooled_names(path)
+            if spooled is not None and spooled != tuple(names):
+                # the datastreams changed, the old rows are uploaded
+                # with their own columns by open_leftovers()
+                retired = "%s.%u" % (path, int(time.time()))
+                logging.warning("spool %s holds other datastreams, moving "
+                                "it to %s", path, retired)
+                os.rename(path, retired)
+            logging.info("spooling to %s", path)
+            return Spool(path, names, config['segment'], config['fsync'])
+
+        return RingBuffer(names, max(config['buffer'] // ports, 1),
+                          config['overflow'])
+
+    def open_leftovers(self):
+        """ Queue the spools left by runs with other ports or datastreams.
+
+        They are uploaded before the new samples and removed once empty.
+        """
+
+        config = self.dispatcher.config
+        root = config['spool']
+        used = set(self.spool_path(port) for port in self.queues)
+        paths = [root] + [os.path.join(root, name)
+                          for name in sorted(os.listdir(root))]
+
+        for path in paths:
+            names = spooled_names(path) if os.path.isdir(path) else None
+            if path in used or names is None:
+                continue
+            spool = Spool(path, names, config['segment'], config['fsync'])
+            if not len(spool):
+                spool.remove()
+                continue
+            logging.info("uploading %u samples left in %s", len(spool),
+                                                            path)
+            self.queues[path] = PortQueue(None, names, (), spool, True)
+
     def run(self):
         logging.info("starting up dispatcher")
         logging.info("dispatching every %us", self.dispatcher.config['period'])
         while True:
             if self.stop.isSet():
                 break
-            self.process()
+            deadline = time.time() + self.dispatcher.config['period']
+            delay = self.process()
             if not self.dispatcher.config['period']:
                 break
-            time.sleep(self.dispatcher.config['period'])
+            if delay is None:
+                self.wait(deadline)
+            else:
+                # do not let a full queue retry a failing upload right away
+                logging.info("retrying in %.1fs", delay)
+                self.stop.wait(delay)
+        self.close()
+
+    def close(self):
+        """ Move the queued rows to the buffers and close them. """
+
+        for queue in self.queues.values():
+            try:
+                queue.incoming.drain(queue.outgoing)
+            except BufferError:
+                logging.warning("buffer full, %u samples dropped",
+                                len(queue.incoming))
+            queue.outgoing.close()
+
+    def wait(self, deadline):
+        """ Sleep until the deadline or until enough samples are queued. """
+
+        with self.wakeup:
+            while not self.ready() and not self.stop.isSet():
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.wakeup.wait(remaining)
 
-    def add_stream(self, stream, si_type, label, symbol):
-        """ Add a new datastream. """
+    def ready(self):
+        """ Return True if the queued samples call for an early flush. """
 
-        self.streams[stream] = {"id" : stream,
-                                "datapoints" : [],
-                                "unit": {"type": si_type,
-                                         "label": label,
-                                         "symbol": symbol}}
+        config = self.dispatcher.config
+        queued = self.queued()
+
+        if config['flush_samples'] and queued >= config['flush_samples']:
+            return True
+
+        size = sum(len(queue) * len(queue.names)
+                   for queue in self.queues.values()) * DATAPOINT_BYTES
+
+        return bool(config['flush_bytes']) and size >= config['flush_bytes']
+
+    def add_stream(self, stream, si_type, label, symbol, port=None,
+                   integer=False):
+        """ Add a new datastream, fed by the stream readings of port.
+
+        With port None the datastream takes the readings of every port.
+        """
+
+        ident = datastream_id(stream, port)
+
+        self.streams[ident] = {"id" : ident,
+                               "datapoints" : [],
+                               "unit": {"type": si_type,
+                                        "label": label,
+                                        "symbol": symbol}}
+        self.sources[ident] = (port, stream)
+
+        if integer:
+            self.integers.add(ident)
+
+    def describe(self, name):
+        """ Return a datastream for a spooled column no longer registered.
+
+        The unit is taken from a datastream fed by the same stream.
+        """
+
+        stream = name.split('-', 1)[0]
+        datastream = {"id" : name, "datapoints" : []}
+
+        for ident, (_, source) in self.sources.items():
+            if source == stream:
+                datastream['unit'] = dict(self.streams[ident]['unit'])
+                break
+
+        return datastream
 
     def process(self):
-        """ Update feed. """
+        """ Update feed, splitting the backlog in bounded PUTs.
 
-        if len(self.outgoing) == 0:
-            return
+        Return None once the queue has been flushed, otherwise the delay
+        before the next attempt.
+        """
+
+        count = self.dispatcher.config['put_samples']
+
+        # leftovers first, they hold the oldest samples
+        for key, queue in sorted(self.queues.items(),
+                                 key=lambda item: not item[1].leftover):
+            delay, count = self.process_queue(queue, count)
+            if delay is not None:
+                return delay
+            if queue.leftover and not len(queue):
+                logging.info("%s uploaded", queue.outgoing.path)
+                queue.outgoing.remove()
+                del self.queues[key]
+
+        return None
+
+    def process_queue(self, queue, count):
+        """ Upload the backlog of a port, count samples per PUT at most.
+
+        Return the delay before the next attempt (None once the queue
+        has been flushed) and the PUT size to go on with.
+        """
+
+        # outgoing is only touched by this thread, no locking needed
+        while not self.stop.isSet():
+
+            queue.drain()
+
+            if not len(queue.outgoing):
+                break
+
+            if not self.breaker.allow():
+                return self.breaker.remaining(), count
+
+            try:
+                if not self.dispatcher.discover():
+                    return self.failed(), count
+                resp, pending = self.upload(queue, count)
+            except (httplib.HTTPException, socket.error) as ex:
+                logging.error("upload failed: %s", ex)
+                return self.failed(), count
+
+            outcome = classify(resp.status)
+
+            if outcome == SUCCESS:
+                queue.outgoing.consume(pending.end)
+                self.uploaded.inc(len(pending))
+                self.breaker.success()
+                self.backoff.reset()
+                continue
+
+            # samples are left in the buffer until acknowledged
+            logging.error("%s (%s), keeping %u updates", resp.reason,
+                                                         resp.status,
+                                                         len(queue.outgoing))
+
+            if outcome != REJECTED:
+                self.rollbacks.inc()
 
-        with self.lock:
+            if outcome == TOO_LARGE and len(pending) > 1:
+                count = len(pending) // 2
+                logging.info("retrying with %u samples per update", count)
+                continue
+
+            if outcome == REJECTED:
+                # retrying a malformed update would stall the queue forever
+                logging.error("update rejected, dropping %u samples",
+                              len(pending))
+                queue.outgoing.consume(pending.end)
+                continue
+
+            if outcome == UNAUTHORIZED:
+                self.dispatcher.forget()
+
+            if outcome == RETRY:
+                return max(self.backoff.next(),
+                           retry_after(resp.headers)), count
+
+            return self.failed(), count
+
+        return None, count
+
+    def failed(self):
+        """ Record a failed attempt, return the delay before the next. """
+
+        self.breaker.failure()
+
+        return self.backoff.next()
+
+    def upload(self, queue, count):
+        """ Send up to count samples of a port, return the response and
+        the view.
+        """
+
+        dropped = self.dropped_rows()
+
+        if dropped > self.dropped:
+            logging.warning("buffer full, %u samples dropped",
+                            dropped - self.dropped)
+            self.dropped = dropped
+
+        pending = queue.outgoing.view(count or None)
+        config = self.dispatcher.config
+        ats = [format_ns(ts) for ts in pending.iter_ts()]
+
+        if config['format'] == FORMAT_CSV:
+            url = "/v2/feeds/%s.csv" % config['feed']
+            body = lambda: encode_csv(queue.names, ats, pending)
+        else:
+            url = "/v2/feeds/%s" % config['feed']
             feed = self.dispatcher.get_feed()
-            feed['datastreams'] = []
-            for stream in self.streams.values():
-                stream['datapoints'] = []
-            pending = deque()
-            while self.outgoing:
-                readings = self.outgoing.popleft()
-                pending.append(readings)
-                for stream in self.streams.values():
-                    stream['current_value'] = readings[stream['id']]
-                    sample = {"at" : readings['at'],
-                              "value" :  "%.3f" % readings[stream['id']]}
-                    stream['datapoints'].append(sample)
-            for stream in self.streams.values():
-                feed['datastreams'].append(stream)
-
-        feed_id = self.dispatcher.config['feed']
-        logging.info("updating feed %s, sending %s samples", feed_id,
+            streams = [stream for name, stream in self.streams.items()
+                       if name in queue.names]
+            streams += [self.describe(name) for name in queue.names
+                        if name not in self.streams]
+            body = lambda: encode_json(feed, streams, ats, pending,
+                                       self.integers)
+
+        headers = {'X-ApiKey' : config['key'],
+                   'Content-Type' : CONTENT_TYPES[config['format']]}
+
+        if config['chunked']:
+            document = lambda: self.count_bytes(chunks(body()))
+        else:
+            document = ''.join(body())
+            self.upload_bytes.inc(len(document))
+
+        logging.info("updating feed %s, sending %s samples", config['feed'],
                                                              len(pending))
+        logging.debug("compression ratio %.1f", self.ratio)
+
+        started = time.time()
+
         try:
+            resp = self.dispatcher.pool.request('PUT', url, document, headers)
+        except (httplib.HTTPException, socket.error):
+            self.upload_errors.inc()
+            self.rollbacks.inc()
+            raise
+
+        self.upload_seconds.observe(time.time() - started)
+        self.responses.inc(status=str(resp.status))
 
-            conn = httplib.HTTPConnection(host=self.dispatcher.config['host'],
-                                          port=self.dispatcher.config['port'],
-                                          timeout=10)
+        return resp, pending
 
-            conn.request('PUT', "/v2/feeds/%s" % feed_id,
-                         json.dumps(feed),
-                         {'X-ApiKey' : self.dispatcher.config['key']})
+    def count_bytes(self, pieces):
+        """ Count the bytes of a chunked body as they are sent. """
 
-            resp = conn.getresponse()
-            conn.close()
+        for piece in pieces:
+            self.upload_bytes.inc(len(piece))
+            yield piece
 
-            if resp.status != 200:
+    def collect(self):
+        """ Update the queue metrics. """
 
-                logging.error("%s (%s), rolling back %u updates", resp.reason,
-                                                                  resp.status,
-                                                                  len(pending))
-                self.dispatcher.discover()
-                while pending:
-                    self.outgoing.appendleft(pending.pop())
+        self.depth.set(self.queued())
+        self.dropped_total.set(self.dropped_rows())
 
-        except httplib.HTTPError as ex:
+    def queued(self):
+        """ Return the number of rows waiting, over every port. """
 
-            logging.exception(ex)
-            logging.error("exception, rolling back %u updates", len(pending))
+        return sum(len(queue) for queue in self.queues.values())
 
-            while pending:
-                self.outgoing.appendleft(pending.pop())
+    def dropped_rows(self):
+        """ Return the number of rows dropped by a full buffer. """
+
+        return sum(queue.outgoing.dropped for queue in self.queues.values())
+
+    def notify(self):
+        """ Wake up the dispatcher if an early flush is due. """
+
+        if self.ready():
+            with self.wakeup:
+                self.wakeup.notify()
+
+    @property
+    def ratio(self):
+        """ Return the compression ratio so far, over every port. """
+
+        compressors = [queue.compressor for queue in self.queues.values()]
+
+        return float(sum(compressor.rows for compressor in compressors)) / \
+            max(sum(compressor.kept for compressor in compressors), 1)
+
+    def route(self, port):
+        """ Return the queue of port. """
+
+        queue = self.queues.get(port)
+
+        # a single device feeds the datastreams without a port
+        if queue is None:
+            queue = self.queues[None]
+
+        return queue
 
     def enqueue(self, readings):
         """ Enque readings to outgoing queue. """
 
-        with self.lock:
-            self.outgoing.append(readings)
+        queue = self.route(readings['port'])
+        values = [readings[stream] for stream in queue.streams]
+
+        row = queue.compressor.offer(readings['ts'], values)
+
+        if row is not None:
+            queue.incoming.append(row[0], row[1])
+            self.notify()
+
+    def enqueue_many(self, batch):
+        """ Enque a batch of readings to outgoing queue. """
+
+        queue = self.route(batch.port)
+        compressor = queue.compressor
+        columns = [batch.columns[stream] for stream in queue.streams]
+
+        if not compressor.enabled:
+            queue.incoming.extend(batch.ts, columns)
+            self.notify()
+            return
+
+        for index in range(len(batch.ts)):
+            values = [column[index] for column in columns]
+            row = compressor.offer(batch.ts[index], values)
+            if row is not None:
+                queue.incoming.append(row[0], row[1])
+
+        self.notify()
 
 class XivelyDispatcher(threading.Thread):
     """ Xively Client. """
 
-    def __init__(self, uuid, config_file, backend):
+    def __init__(self, uuid, config_file, backend, batch=False):
         super(XivelyDispatcher, self).__init__()
         logging.info("uuid %s", uuid)
         self.daemon = True
         self.stop = threading.Event()
         self.config_file = config_file
-        self.config = {'uuid' : uuid, 'backend' : backend}
+        self.config = {'uuid' : uuid, 'backend' : backend, 'batch' : batch}
         self.load_config()
-        self.dispatcher = DispatcherProcedure(self)
+        self.pool = HTTPPool(self.config['host'], self.config['port'])
+        self.discovered = None
+        self.aggregator = Aggregator(self.config['statistics'],
+                                     self.config['stats_window'],
+                                     self.config['quantiles'],
+                                     self.config['energy'])
+        self.registry = Registry()
+        self.registry.collect(self.collect)
+        self.read = self.registry.counter(
+            "energino_samples_read_total",
+            "Lines or frames received from the device.", ("port",))
+        self.parsed = self.registry.counter(
+            "energino_samples_parsed_total",
+            "Samples decoded.", ("port",))
+        self.lost = self.registry.counter(
+            "energino_samples_lost_total",
+            "Samples corrupted or missing from the sequence.", ("port",))
+        self.errors = self.registry.counter(
+            "energino_parse_errors_total",
+            "Lines or frames that could not be decoded.", ("port",))
+        self.drift = self.registry.histogram(
+            "energino_polling_drift_ms",
+            "Distance between the device window and the polling interval.",
+            DRIFT_BUCKETS, ("port",))
+        self.metrics_server = None
+        self.dispatcher = DispatcherProcedure(self, self.registry)
         self.streams = {}
 
     def add_stream(self, stream, unit_type, label, symbol):
@@ -180,42 +702,116 @@ class XivelyDispatcher(threading.Thread):
 
     def start(self):
 
+        if not self.config['feed']:
+            raise ValueError("feed id is not specified")
+
         # start dispatcher
 
-        for stream in self.streams:
-            self.dispatcher.add_stream(stream,
-                                       self.streams[stream]['unit_type'],
-                                       self.streams[stream]['label'],
-                                       self.streams[stream]['symbol'])
+        for stream, label, symbol in self.aggregator.names():
+            self.add_stream(stream, "derivedSI", label, symbol)
+
+        # devices of a fleet get a datastream each, readings of different
+        # devices must not end up in the same one
+        devices = self.devices()
+        ports = [device.ser.port for device in devices]
+
+        if len(ports) < 2:
+            ports = [None]
+
+        # the parser returns integers for some fields, e.g. the switch
+        integers = set(field for device in devices
+                       for field, kind in device.schema.types if kind is int)
+
+        for port in ports:
+            for stream in self.streams:
+                self.dispatcher.add_stream(stream,
+                                           self.streams[stream]['unit_type'],
+                                           self.streams[stream]['label'],
+                                           self.streams[stream]['symbol'],
+                                           port,
+                                           stream in integers)
         self.dispatcher.start()
 
-        # start pool loop
+        if self.config['metrics']:
+            self.metrics_server = \
+                MetricsServer(parse_listen(self.config['metrics']),
+                              self.registry)
+            self.metrics_server.start()
+
+        # start pool loop, the feed is checked by the dispatcher so that
+        # acquisition never waits on the network
+        backoff = Backoff(DEFAULT_BACKOFF_BASE, BACKOFF)
         while True:
             try:
-                # configure feed
-                self.discover()
                 # start updating
                 logging.info("begin polling")
                 while True:
                     if self.stop.isSet():
                         return
                     try:
-                        readings = self.config['backend'].fetch()
-                        self.dispatcher.enqueue(readings)
+                        if self.config['batch']:
+                            batch = self.config['backend'].fetch_many()
+                            for window in batch.window:
+                                self.observe(batch.port, window)
+                            if self.aggregator.enabled:
+                                self.aggregator.update_batch(batch)
+                            self.dispatcher.enqueue_many(batch)
+                        else:
+                            readings, _, _ = self.config['backend'].fetch()
+                            self.observe(readings['port'],
+                                         readings['window'])
+                            if self.aggregator.enabled:
+                                self.aggregator.update(readings)
+                            self.dispatcher.enqueue(readings)
+                        backoff.reset()
                     except ValueError:
                         logging.warning("sample lost")
             except RuntimeError as ex:
                 logging.exception(ex)
-                time.sleep(BACKOFF)
+                time.sleep(backoff.next())
 
         # thread stopped
         logging.info("thread %s stopped", self.__class__.__name__)
 
 
+    def observe(self, port, window):
+        """ Record the polling drift of a sample. """
+
+        self.drift.observe(drift(self.config['backend'].interval, window),
+                           port=port)
+
+    def devices(self):
+        """ Return the energinos behind the backend. """
+
+        backend = self.config['backend']
+
+        return getattr(backend, 'energinos', [backend])
+
+    def collect(self):
+        """ Update the metrics counted by the devices. """
+
+        for energino in self.devices():
+            port = energino.ser.port
+            self.read.set(energino.parsed + energino.errors, port=port)
+            self.parsed.set(energino.parsed, port=port)
+            self.lost.set(energino.lost, port=port)
+            self.errors.set(energino.errors, port=port)
+
     def shutdown(self):
         """ Shutdown Xively client. """
+        backend = self.config['backend']
+        if hasattr(backend, 'shutdown'):
+            # stop the readers first, nothing is queued after the flush
+            backend.shutdown()
         logging.info("shutting down dispatcher")
         self.dispatcher.shutdown()
+        if self.dispatcher.is_alive():
+            # let it close the buffer, an upload may be in progress
+            self.dispatcher.join(self.pool.timeout)
+        self.aggregator.report()
+        self.pool.close()
+        if self.metrics_server:
+            self.metrics_server.stop()
         self.stop.set()
 
     def get_feed(self):
@@ -244,6 +840,34 @@ class XivelyDispatcher(threading.Thread):
                                                 'feed' : '',
                                                 'key' : '-',
                                                 'period' : DEFAULT_PERIOD,
+                                                'buffer' : DEFAULT_BUFFER,
+                                                'overflow' : DROP_OLDEST,
+                                                'spool' : '',
+                                                'segment' : DEFAULT_SEGMENT,
+                                                'fsync' : 'false',
+                                                'flush_samples' :
+                                                    DEFAULT_FLUSH_SAMPLES,
+                                                'flush_bytes' :
+                                                    DEFAULT_FLUSH_BYTES,
+                                                'put_samples' :
+                                                    DEFAULT_PUT_SAMPLES,
+                                                'format' : FORMAT_JSON,
+                                                'chunked' : 'true',
+                                                'backoff_max' :
+                                                    DEFAULT_BACKOFF,
+                                                'breaker_failures' :
+                                                    DEFAULT_FAILURES,
+                                                'breaker_cooldown' :
+                                                    DEFAULT_COOLDOWN,
+                                                'discovery_ttl' :
+                                                    DEFAULT_DISCOVERY_TTL,
+                                                'accounting' : 'true',
+                                                'streams' : '',
+                                                'window' :
+                                                    DEFAULT_STATS_WINDOW,
+                                                'quantiles' :
+                                                    DEFAULT_QUANTILES,
+                                                'listen' : '',
                                                 'website' : '',
                                                 'disposition' : 'fixed',
                                                 'name':'',
@@ -263,6 +887,26 @@ class XivelyDispatcher(threading.Thread):
         self.config['port'] = config.getint("General", "port")
         self.config['feed'] = config.get("General", "feed")
         self.config['period'] = config.getint("General", "period")
+        self.config['buffer'] = config.getint("General", "buffer")
+        self.config['overflow'] = config.get("General", "overflow")
+        self.config['spool'] = config.get("General", "spool")
+        self.config['segment'] = config.getint("General", "segment")
+        self.config['fsync'] = config.getboolean("General", "fsync")
+        self.config['flush_samples'] = config.getint("General",
+                                                     "flush_samples")
+        self.config['flush_bytes'] = config.getint("General", "flush_bytes")
+        self.config['put_samples'] = config.getint("General", "put_samples")
+        self.config['format'] = config.get("General", "format")
+        if self.config['format'] not in FORMATS:
+            raise ValueError("invalid format: %s" % self.config['format'])
+        self.config['chunked'] = config.getboolean("General", "chunked")
+        self.config['backoff_max'] = config.getint("General", "backoff_max")
+        self.config['breaker_failures'] = config.getint("General",
+                                                        "breaker_failures")
+        self.config['breaker_cooldown'] = config.getint("General",
+                                                        "breaker_cooldown")
+        self.config['discovery_ttl'] = config.getint("General",
+                                                     "discovery_ttl")
 
         if not config.has_section("Location"):
             config.add_section("Location")
@@ -276,6 +920,44 @@ class XivelyDispatcher(threading.Thread):
         self.config['domain'] = config.get("Location", "domain")
         self.config['tags'] = config.get("Location", "tags").split(",")
 
+        if not config.has_section("Compression"):
+            config.add_section("Compression")
+
+        self.config['heartbeat'] = DEFAULT_HEARTBEAT
+        self.config['compression'] = {}
+
+        # options not in the defaults are "stream = method tolerance"
+        for option in config.options("Compression"):
+            if option in config.defaults():
+                continue
+            if option == "heartbeat":
+                self.config['heartbeat'] = config.getint("Compression",
+                                                         "heartbeat")
+                continue
+            spec = config.get("Compression", option).split()
+            self.config['compression'][option] = \
+                (spec[0], float(spec[1]) if len(spec) > 1 else 0.0)
+
+        if not config.has_section("Statistics"):
+            config.add_section("Statistics")
+
+        self.config['energy'] = config.getboolean("Statistics",
+                                                  "accounting")
+        self.config['statistics'] = \
+            [stream.strip() for stream
+             in config.get("Statistics", "streams").split(",")
+             if stream.strip()]
+        self.config['stats_window'] = config.getint("Statistics", "window")
+        self.config['quantiles'] = \
+            [float(fraction) for fraction
+             in config.get("Statistics", "quantiles").split(",")
+             if fraction.strip()]
+
+        if not config.has_section("Metrics"):
+            config.add_section("Metrics")
+
+        self.config['metrics'] = config.get("Metrics", "listen")
+
         logging.info("loading configuration...")
 
         logging.info("key: %s", self.config['key'])
@@ -286,6 +968,25 @@ class XivelyDispatcher(threading.Thread):
             logging.info("feed: %s", self.config['feed'])
 
         logging.info("period: %s", self.config['period'])
+        logging.info("buffer: %s", self.config['buffer'])
+        logging.info("overflow: %s", self.config['overflow'])
+        logging.info("spool: %s", self.config['spool'])
+        logging.info("segment: %s", self.config['segment'])
+        logging.info("fsync: %s", self.config['fsync'])
+        logging.info("flush_samples: %s", self.config['flush_samples'])
+        logging.info("flush_bytes: %s", self.config['flush_bytes'])
+        logging.info("put_samples: %s", self.config['put_samples'])
+        logging.info("format: %s", self.config['format'])
+        logging.info("chunked: %s", self.config['chunked'])
+        logging.info("backoff_max: %s", self.config['backoff_max'])
+        logging.info("breaker_failures: %s", self.config['breaker_failures'])
+        logging.info("breaker_cooldown: %s", self.config['breaker_cooldown'])
+        logging.info("discovery_ttl: %s", self.config['discovery_ttl'])
+        logging.info("energy: %s", self.config['energy'])
+        logging.info("statistics: %s", self.config['statistics'])
+        logging.info("stats_window: %s", self.config['stats_window'])
+        logging.info("quantiles: %s", self.config['quantiles'])
+        logging.info("metrics: %s", self.config['metrics'])
         logging.info("website: %s", self.config['website'])
 
         logging.info("disposition: %s", self.config['disposition'])
@@ -300,39 +1001,39 @@ class XivelyDispatcher(threading.Thread):
             raise Exception("invalid key")
 
     def discover(self):
-        """ Check if feed is available, otherwise exit. """
+        """ Check if feed is available, results are cached for a while. """
 
-        # check if feed is available
-        if self.config['feed']:
+        if self.discovered is not None and \
+           time.time() - self.discovered < self.config['discovery_ttl']:
+            return True
 
-            logging.info("trying to fetch http://%s:%u/v2/feeds/%s",
-                         self.config['host'],
-                         self.config['port'],
-                         self.config['feed'])
+        logging.info("trying to fetch http://%s:%u/v2/feeds/%s",
+                     self.config['host'],
+                     self.config['port'],
+                     self.config['feed'])
 
-            conn = httplib.HTTPConnection(host=self.config['host'],
-                                          port=self.config['port'],
-                                          timeout=10)
+        resp = self.pool.request('GET', "/v2/feeds/%s" %
+                                 self.config['feed'],
+                                 headers={'X-ApiKey' : self.config['key']})
 
-            conn.request('GET', "/v2/feeds/%s" %
-                         self.config['feed'],
-                         headers={'X-ApiKey' : self.config['key']})
+        if resp.status == 200:
+            # feed found
+            logging.info("feed %s found!", self.config['feed'])
+            self.discovered = time.time()
+            return True
 
-            resp = conn.getresponse()
-            conn.close()
+        # feed not found
+        logging.error("error while fetching feed %s, %s (%s)",
+                      self.config['feed'],
+                      resp.reason,
+                      resp.status)
 
-            if resp.status == 200:
-                # feed found
-                logging.info("feed %s found!", self.config['feed'])
-                return
-            else:
-                # feed not found
-                raise Exception("error while fetching feed %s, %s (%s)",
-                                self.config['feed'],
-                                resp.reason,
-                                resp.status)
+        return False
 
-        raise ValueError("feed id is not specified")
+    def forget(self):
+        """ Drop the cached discovery result. """
+
+        self.discovered = None
 
     def save_state(self):
         """ update configuration file. """
@@ -344,6 +1045,24 @@ class XivelyDispatcher(threading.Thread):
         config.set("General", "host", self.config['host'])
         config.set("General", "port", str(self.config['port']))
         config.set("General", "period", str(self.config['period']))
+        config.set("General", "buffer", str(self.config['buffer']))
+        config.set("General", "overflow", self.config['overflow'])
+        config.set("General", "spool", self.config['spool'])
+        config.set("General", "segment", str(self.config['segment']))
+        config.set("General", "fsync", str(self.config['fsync']).lower())
+        config.set("General", "flush_samples",
+                   str(self.config['flush_samples']))
+        config.set("General", "flush_bytes", str(self.config['flush_bytes']))
+        config.set("General", "put_samples", str(self.config['put_samples']))
+        config.set("General", "format", self.config['format'])
+        config.set("General", "chunked", str(self.config['chunked']).lower())
+        config.set("General", "backoff_max", str(self.config['backoff_max']))
+        config.set("General", "breaker_failures",
+                   str(self.config['breaker_failures']))
+        config.set("General", "breaker_cooldown",
+                   str(self.config['breaker_cooldown']))
+        config.set("General", "discovery_ttl",
+                   str(self.config['discovery_ttl']))
 
         if not self.config['feed']:
             config.set("General", "feed", self.config['feed'])
@@ -358,6 +1077,24 @@ class XivelyDispatcher(threading.Thread):
         config.set("Location", "domain", self.config['domain'])
         config.set("Location", "tags", ",".join(self.config['tags']))
 
+        config.add_section("Compression")
+        config.set("Compression", "heartbeat", str(self.config['heartbeat']))
+        for stream, (method, tolerance) in self.config['compression'].items():
+            config.set("Compression", stream, "%s %s" % (method, tolerance))
+
+        config.add_section("Statistics")
+        config.set("Statistics", "accounting",
+                   str(self.config['energy']).lower())
+        config.set("Statistics", "streams",
+                   ",".join(self.config['statistics']))
+        config.set("Statistics", "window", str(self.config['stats_window']))
+        config.set("Statistics", "quantiles",
+                   ",".join(str(fraction)
+                            for fraction in self.config['quantiles']))
+
+        config.add_section("Metrics")
+        config.set("Metrics", "listen", self.config['metrics'])
+
         config.write(open(self.config, "w"))
 
 def sigint_handler(*_):
@@ -404,8 +1141,26 @@ def main():
                       dest="debug",
                       default=False)
 
+    parser.add_option('--all', '-a',
+                      action="store_true",
+                      dest="all",
+                      default=False)
+
+    parser.add_option('--batch', '-B',
+                      action="store_true",
+                      dest="batch",
+                      default=False)
+
+    parser.add_option('--nonblocking', '-n',
+                      action="store_true",
+                      dest="nonblocking",
+                      default=False)
+
     options, _ = parser.parse_args()
 
+    if options.nonblocking and options.batch:
+        parser.error("--nonblocking does not support --batch")
+
     if options.debug:
         lvl = logging.DEBUG
     else:
@@ -422,18 +1177,34 @@ def main():
     signal.signal(signal.SIGINT, sigint_handler)
     signal.signal(signal.SIGTERM, sigint_handler)
 
-    backend = PyEnergino(options.device,
-                         options.device_speed_bps,
-                         options.interval)
+    if options.nonblocking:
+        backend = AsyncFleet(options.device,
+                             options.device_speed_bps,
+                             options.interval)
+    elif options.all:
+        backend = PyEnerginoFleet(options.device,
+                                  options.device_speed_bps,
+                                  options.interval,
+                                  options.batch)
+    else:
+        backend = PyEnergino(options.device,
+                             options.device_speed_bps,
+                             options.interval)
 
-    xively = XivelyDispatcher(options.uuid, options.config, backend)
+    xively = XivelyDispatcher(options.uuid,
+                              options.config,
+                              backend,
+                              options.batch)
 
     xively.add_stream("power", "derivedSI", "Watts", "W")
     xively.add_stream("voltage", "derivedSI", "Volts", "V")
     xively.add_stream("current", "derivedSI", "Amperes", "A")
     xively.add_stream("switch", "derivedSI", "Switch", "S")
 
-    xively.start()
+    try:
+        xively.start()
+    finally:
+        xively.shutdown()
 
     signal.signal(signal.SIGINT, sigint_handler)
     signal.signal(signal.SIGTERM, sigint_handler)
@@ -44,7 +44,13 @@ setup(name="energino",
       author_email="roberto.riggio@create-net.org",
       url="https://github.com/rriggio/energino",
       long_description="Energino distributed energy monitoring toolkit",
-      entry_points={"console_scripts": ["energino = energino.energino:main"]},
+      entry_points={"console_scripts": [
+          "energino = energino.energino:main",
+          "energino-query = energino.store:main",
+          "energino-server = energino.server:main",
+          "energino-dump = energino.recording:main",
+          "energino-analyze = energino.analyze:main",
+          "energino-simulator = energino.simulator:main"]},
       packages=['energino'],
       license="Python",
       platforms="any")
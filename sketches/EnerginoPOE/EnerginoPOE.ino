@@ -13,6 +13,7 @@
  * Supported commands from the serial:
  *  #P<integer>, sets the period between two updates (in ms) [default is 2000]
  *  #S<0/1>, sets the relay configuration, 0 load on, 1 load off [default is 0]
+ *  #M<0/1>, sets the serial output, 0 text lines, 1 binary frames [default is 0]
  *  #A<integer>, sets the value in ohms of the R1 resistor [default is 100000]
  *  #B<integer>, sets the value in ohms of the R2 resistor [default is 10000]
  *  #C<integer>, sets the current sensor offset in mV [default is 2500]
@@ -24,6 +24,26 @@ int P_DIGITS = 2;
 // Last update
 unsigned long lastUpdated;
 
+// Binary frames (#M1) instead of text lines
+boolean binaryMode = false;
+uint16_t frameSeq = 0;
+
+// Binary status frame, little endian, CRC-16/CCITT (0x1021, init 0xFFFF)
+// computed over every byte between sync and crc
+struct frame_t {
+  uint8_t sync[2];
+  uint16_t seq;
+  float voltage;
+  float current;
+  float power;
+  uint8_t relay;
+  uint16_t period;
+  uint16_t samples;
+  uint16_t v_error;
+  uint16_t i_error;
+  uint16_t crc;
+} __attribute__((packed));
+
 // Permanent configuration
 struct settings_t {
   char magic[12];
@@ -209,14 +229,20 @@ void serParseCommand(int aref)
     if (value >= 0) {
       settings.feedid = value;
     }
+    Serial.print("@feedid: ");
+    Serial.println(settings.feedid);
   }
   else if (cmd == 'K') {
     strncpy(settings.apikey, valueBuf,49);
     settings.apikey[48] = '\0';
+    Serial.print("@apikey: ");
+    Serial.println(settings.apikey);
   }
   else if (cmd == 'U') {
     strncpy(settings.feedurl, valueBuf,60);
     settings.feedurl[59] = '\0';
+    Serial.print("@feedurl: ");
+    Serial.println(settings.feedurl);
   }
   else if (cmd == 'P') {
     int value = atoi(valueBufPtr);
@@ -234,7 +260,7 @@ void serParseCommand(int aref)
       return;
     }
     settings.r1 = value;
-    Serial.print("R1: ");
+    Serial.print("@r1: ");
     Serial.print(settings.r1);
     Serial.println(" Kohm");
   }
@@ -244,7 +270,7 @@ void serParseCommand(int aref)
       return;
     }
     settings.r2 = value;
-    Serial.print("R2: ");
+    Serial.print("@r2: ");
     Serial.print(settings.r2);
     Serial.println(" Kohm");
   }
@@ -254,7 +280,7 @@ void serParseCommand(int aref)
       return;
     }
     settings.offset = value;
-    Serial.print("Offeset: ");
+    Serial.print("@offset: ");
     Serial.print(settings.offset);
     Serial.println(" mV");
   }
@@ -264,10 +290,25 @@ void serParseCommand(int aref)
       return;
     }
     settings.sensitivity = value;
-    Serial.print("Sensitivity: ");
+    Serial.print("@sensitivity: ");
     Serial.print(settings.sensitivity);
     Serial.println(" mV/A");
   }
+  else if (cmd == 'M') {
+    int value = atoi(valueBufPtr);
+    if (value < 0) {
+      return;
+    }
+    binaryMode = (value > 0);
+    frameSeq = 0;
+    if (binaryMode) {
+      Serial.println("@mode: binary");
+    }
+    else {
+      Serial.println("@mode: ascii");
+    }
+    return;
+  }
   else if (cmd == 'S') {
     int value = atoi(valueBufPtr);
     if (value < 0) {
@@ -289,8 +330,41 @@ void serParseCommand() {
   serParseCommand(DEFAULT_AREF);
 }
 
+uint16_t crc16(const uint8_t * data, int len) {
+  uint16_t crc = 0xFFFF;
+  for (int i = 0; i < len; i++) {
+    crc ^= (uint16_t) data[i] << 8;
+    for (int j = 0; j < 8; j++) {
+      crc = (crc & 0x8000) ? (crc << 1) ^ 0x1021 : crc << 1;
+    }
+  }
+  return crc;
+}
+
+// dump current readings to serial as a binary frame
+void dumpFrameToSerial(int aref) {
+  frame_t frame;
+  frame.sync[0] = 0xAA;
+  frame.sync[1] = 0x55;
+  frame.seq = frameSeq++;
+  frame.voltage = getAvgVoltage(VFinal, aref);
+  frame.current = getAvgCurrent(IFinal, aref);
+  frame.power = getAvgPower(VFinal, IFinal, aref);
+  frame.relay = digitalRead(settings.relaypin);
+  frame.period = settings.period;
+  frame.samples = lastSamples;
+  frame.v_error = getVError(aref);
+  frame.i_error = getIError(aref);
+  frame.crc = crc16(((uint8_t *) &frame) + 2, sizeof(frame) - 4);
+  Serial.write((uint8_t *) &frame, sizeof(frame));
+}
+
 // dump current readings to serial
 void dumpToSerial(int aref) {
+  if (binaryMode) {
+    dumpFrameToSerial(aref);
+    return;
+  }
   // Print data also on the serial
   Serial.print("#");
   Serial.print(settings.magic);
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013, Roberto Riggio
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the CREATE-NET nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY CREATE-NET ''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL CREATE-NET BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+""" Tests for energino.analyze. """
+
+from __future__ import absolute_import
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from energino import analyze
+from energino.clock import NS_PER_S
+from energino.recording import FLOAT
+from energino.recording import INT
+from energino.recording import RecordingWriter
+from energino.store import MAX_GAP
+from energino.store import NS_PER_HOUR
+
+ROWS = 1000
+STEP = NS_PER_S // 10
+
+
+class MergeTest(unittest.TestCase):
+    """ Chunked analysis gives the results of a single pass. """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "test.enr")
+        self.rows = []
+        writer = RecordingWriter(self.path, "/dev/ttyACM0", "EnerginoV1",
+                                 [('power', FLOAT), ('switch', INT)],
+                                 block_rows=64, level=0)
+        ts = 3600 * NS_PER_S - 300 * STEP
+        for index in range(ROWS):
+            # a gap longer than MAX_GAP, then the device starts again
+            ts = ts + (MAX_GAP + STEP if index == 700 else STEP)
+            power = float(index % 50)
+            switch = (index // 30) % 2
+            writer.append(ts, [power, switch])
+            self.rows.append((ts, power, switch))
+        writer.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def expected(self):
+        """ Return energy, time, on time and transitions, row by row. """
+
+        energy = 0.0
+        time = on = transitions = 0
+
+        for (ts0, power0, switch0), (ts1, power1, switch1) in \
+                zip(self.rows, self.rows[1:]):
+            if ts1 - ts0 <= MAX_GAP:
+                energy = energy + (power0 + power1) / 2.0 * (ts1 - ts0) / \
+                    NS_PER_HOUR
+                time = time + ts1 - ts0
+                if switch0:
+                    on = on + ts1 - ts0
+            if switch0 != switch1:
+                transitions = transitions + 1
+
+        return energy, time, on, transitions
+
+    @unittest.skipIf(analyze.numpy is None, "numpy is required")
+    def test_chunks(self):
+        whole = analyze.run([self.path], interval=60, jobs=1)
+        # chunks of a block, edges fall everywhere
+        chunked = analyze.run([self.path], interval=60, jobs=1,
+                              chunk_rows=1)
+        self.assertEqual(len(analyze.tasks([self.path], 1)),
+                         (ROWS + 63) // 64)
+        whole = whole["/dev/ttyACM0"]
+        chunked = chunked["/dev/ttyACM0"]
+
+        energy, time, on, transitions = self.expected()
+
+        for result in (whole, chunked):
+            self.assertEqual(result['rows'], ROWS)
+            self.assertAlmostEqual(result['energy'], energy, 9)
+            self.assertEqual(result['time'], time)
+            self.assertEqual(result['on'], on)
+            self.assertEqual(result['transitions'], transitions)
+
+        self.assertEqual(sorted(whole['buckets']), sorted(chunked['buckets']))
+        for key, bucket in whole['buckets'].items():
+            merged = chunked['buckets'][key]
+            self.assertEqual(merged[:1], bucket[:1])
+            self.assertAlmostEqual(merged[1], bucket[1], 6)
+            self.assertEqual(merged[2:4], bucket[2:4])
+            self.assertAlmostEqual(merged[4], bucket[4], 9)
+
+        stats = chunked['stats']['power']
+        self.assertEqual(stats[0], ROWS)
+        self.assertEqual(stats[3:], [0.0, 49.0])
+
+
+if __name__ == "__main__":
+    unittest.main()
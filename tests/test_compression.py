@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013, Roberto Riggio
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the CREATE-NET nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY CREATE-NET ''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL CREATE-NET BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+""" Tests for energino.compression. """
+
+from __future__ import absolute_import
+
+import math
+import random
+import unittest
+
+from energino.clock import NS_PER_S
+from energino.compression import Compressor
+from energino.compression import make_filter
+from energino.compression import DEADBAND
+from energino.compression import NONE
+from energino.compression import SWINGING_DOOR
+
+TOLERANCE = 0.5
+
+
+def signal(count, seed=1):
+    """ Return (ts, value) points of a random walk with steps and ramps. """
+
+    rand = random.Random(seed)
+    value = 0.0
+    points = []
+
+    for index in range(count):
+        if index % 200 < 50:
+            value = value + 0.05
+        elif rand.random() < 0.02:
+            value = value + rand.uniform(-5, 5)
+        else:
+            value = value + rand.gauss(0, 0.2)
+        points.append((index * NS_PER_S // 10, value))
+
+    return points
+
+
+def compress(method, points, heartbeat=0):
+    """ Return the points kept by a single column compressor. """
+
+    compressor = Compressor([make_filter(method, TOLERANCE, heartbeat)])
+    kept = []
+
+    for ts, value in points:
+        row = compressor.offer(ts, [value])
+        if row is not None:
+            kept.append((row[0], row[1][0]))
+
+    row = compressor.flush()
+    kept.append((row[0], row[1][0]))
+
+    return [(ts, value) for ts, value in kept if value == value]
+
+
+def hold(kept, ts):
+    """ Rebuild the value at ts holding the last kept point. """
+
+    value = None
+
+    for kept_ts, kept_value in kept:
+        if kept_ts > ts:
+            break
+        value = kept_value
+
+    return value
+
+
+def interpolate(kept, ts):
+    """ Rebuild the value at ts between the kept points around it. """
+
+    for (ts0, value0), (ts1, value1) in zip(kept, kept[1:]):
+        if ts0 <= ts <= ts1:
+            return value0 + (value1 - value0) * (ts - ts0) / float(ts1 - ts0)
+
+    return kept[-1][1]
+
+
+class CompressionTest(unittest.TestCase):
+    """ Kept points rebuild the signal within the tolerance. """
+
+    def test_deadband_bound(self):
+        points = signal(2000)
+        kept = compress(DEADBAND, points)
+        self.assertTrue(len(kept) < len(points) / 2)
+        for ts, value in points:
+            self.assertTrue(abs(hold(kept, ts) - value) <= TOLERANCE + 1e-9)
+
+    def test_swinging_door_bound(self):
+        points = signal(2000)
+        kept = compress(SWINGING_DOOR, points)
+        self.assertTrue(len(kept) < len(points) / 2)
+        self.assertEqual(kept[0], points[0])
+        self.assertEqual(kept[-1], points[-1])
+        for ts, value in points:
+            self.assertTrue(abs(interpolate(kept, ts) - value) <=
+                            TOLERANCE + 1e-9)
+
+    def test_heartbeat(self):
+        points = [(index * NS_PER_S, 1.0) for index in range(100)]
+        kept = compress(DEADBAND, points, heartbeat=10)
+        gaps = [ts1 - ts0 for (ts0, _), (ts1, _) in zip(kept, kept[1:])]
+        self.assertTrue(max(gaps) <= 10 * NS_PER_S)
+
+    def test_gaps(self):
+        nan = float('nan')
+        points = [(0, 1.0), (1, nan), (2, nan), (3, 1.0), (4, 9.0)]
+        kept = compress(DEADBAND, points)
+        self.assertEqual(kept, [(0, 1.0), (4, 9.0)])
+
+    def test_columns(self):
+        compressor = Compressor([None, make_filter(DEADBAND, 1.0, 0)])
+        rows = [compressor.offer(ts, [float(ts), 5.0]) for ts in range(4)]
+        # the uncompressed column keeps every row
+        self.assertEqual([row[0] for row in rows if row is not None],
+                         [0, 1, 2])
+        # rows come out one sample late, the first one keeps everything
+        self.assertEqual(rows[1], (0, [0.0, 5.0]))
+        self.assertEqual(rows[2][1][0], 1.0)
+        self.assertTrue(math.isnan(rows[2][1][1]))
+
+    def test_disabled(self):
+        compressor = Compressor([make_filter(NONE, 0)])
+        self.assertFalse(compressor.enabled)
+        self.assertEqual(compressor.offer(1, [2.0]), (1, [2.0]))
+        self.assertRaises(ValueError, make_filter, 'lossless', 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
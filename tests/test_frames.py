@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013, Roberto Riggio
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the CREATE-NET nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY CREATE-NET ''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL CREATE-NET BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+""" Tests for energino.frames. """
+
+from __future__ import absolute_import
+
+import binascii
+import unittest
+
+from energino.frames import CRC
+from energino.frames import FRAME
+from energino.frames import FRAME_SYNC
+from energino.frames import FrameSplitter
+
+
+def make_frame(seq, power=10.0):
+    """ Return a frame as sent by the sketch. """
+
+    body = FRAME.pack(seq, 5.0, power / 5.0, power, 1, 100, 200, 5, 26,
+                      0)[:-CRC.size]
+
+    return FRAME_SYNC + body + CRC.pack(binascii.crc_hqx(body, 0xFFFF))
+
+
+class FrameSplitterTest(unittest.TestCase):
+    """ Framing, CRC-16 checks and sequence gaps. """
+
+    def test_frames(self):
+        framer = FrameSplitter()
+        frames = framer.split(make_frame(1) + make_frame(2, 20.0))
+        self.assertEqual([frame[0] for frame in frames], [1, 2])
+        self.assertAlmostEqual(frames[1][3], 20.0, 4)
+        self.assertEqual((framer.crc_errors, framer.lost), (0, 0))
+
+    def test_partial_frame(self):
+        framer = FrameSplitter()
+        data = make_frame(1) + make_frame(2)
+        # a sync byte split across two reads
+        cut = len(make_frame(1)) + 1
+        self.assertEqual(len(framer.split(data[:cut])), 1)
+        self.assertEqual(len(framer.split(data[cut:])), 1)
+        self.assertEqual(framer.frames, 2)
+
+    def test_byte_at_a_time(self):
+        framer = FrameSplitter()
+        frames = []
+        for byte in make_frame(7) + make_frame(8):
+            frames.extend(framer.split(byte))
+        self.assertEqual([frame[0] for frame in frames], [7, 8])
+
+    def test_garbage(self):
+        framer = FrameSplitter()
+        data = "#Energino,1,5.0\r\n\xaa" + make_frame(1) + "\x55\xaa"
+        self.assertEqual(len(framer.split(data)), 1)
+        self.assertEqual(framer.crc_errors, 0)
+
+    def test_crc_error(self):
+        framer = FrameSplitter()
+        corrupted = bytearray(make_frame(2))
+        corrupted[5] ^= 0x01
+        data = make_frame(1) + str(corrupted) + make_frame(3)
+        frames = framer.split(data)
+        self.assertEqual([frame[0] for frame in frames], [1, 3])
+        self.assertEqual(framer.crc_errors, 1)
+        # the corrupted frame also shows up as a gap
+        self.assertEqual(framer.lost, 1)
+
+    def test_sequence_wraps(self):
+        framer = FrameSplitter()
+        frames = framer.split(make_frame(0xfffe) + make_frame(0xffff) +
+                              make_frame(0) + make_frame(3))
+        self.assertEqual(len(frames), 4)
+        self.assertEqual(framer.lost, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013, Roberto Riggio
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the CREATE-NET nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY CREATE-NET ''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL CREATE-NET BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+""" Tests for energino.ringbuffer. """
+
+from __future__ import absolute_import
+
+import unittest
+
+from energino.ringbuffer import DoubleBuffer
+from energino.ringbuffer import RingBuffer
+from energino.ringbuffer import DROP_NEWEST
+from energino.ringbuffer import DROP_OLDEST
+from energino.ringbuffer import RAISE
+
+NAMES = ('power',)
+
+
+class RingBufferTest(unittest.TestCase):
+    """ Overflow policies and views across the end of the arrays. """
+
+    def fill(self, ring, first, count):
+        for ts in range(first, first + count):
+            ring.append(ts, [float(ts)])
+
+    def test_drop_oldest(self):
+        ring = RingBuffer(NAMES, 4, DROP_OLDEST)
+        self.fill(ring, 0, 6)
+        self.assertEqual(list(ring.view().iter_ts()), [2, 3, 4, 5])
+        self.assertEqual((ring.first, ring.dropped), (2, 2))
+
+    def test_drop_newest(self):
+        ring = RingBuffer(NAMES, 4, DROP_NEWEST)
+        self.fill(ring, 0, 6)
+        self.assertEqual(list(ring.view().iter_ts()), [0, 1, 2, 3])
+        self.assertEqual(ring.dropped, 2)
+
+    def test_raise(self):
+        ring = RingBuffer(NAMES, 2, RAISE)
+        self.fill(ring, 0, 2)
+        self.assertRaises(BufferError, ring.append, 2, [2.0])
+
+    def test_view_wraps(self):
+        ring = RingBuffer(NAMES, 4)
+        self.fill(ring, 0, 3)
+        ring.consume(ring.view(2).end)
+        self.fill(ring, 3, 3)
+        view = ring.view()
+        self.assertEqual(len(view.segments()), 2)
+        self.assertEqual(list(view.iter_column('power')),
+                         [2.0, 3.0, 4.0, 5.0])
+        self.assertEqual(view.last('power'), 5.0)
+
+    def test_consume_after_drop(self):
+        ring = RingBuffer(NAMES, 4)
+        self.fill(ring, 0, 4)
+        view = ring.view()
+        # rows of the view dropped while it was uploaded
+        self.fill(ring, 4, 2)
+        ring.consume(view.end)
+        self.assertEqual(list(ring.view().iter_ts()), [4, 5])
+
+
+class DoubleBufferTest(unittest.TestCase):
+    """ Draining into a full buffer puts the rest back, in order. """
+
+    def test_drain(self):
+        queue = DoubleBuffer(NAMES)
+        ring = RingBuffer(NAMES, 10)
+        queue.append(0, [0.0])
+        queue.extend([1, 2], [[1.0, 2.0]])
+        self.assertEqual(len(queue), 3)
+        self.assertEqual(queue.drain(ring), 3)
+        self.assertEqual(len(queue), 0)
+        self.assertEqual(list(ring.view().iter_ts()), [0, 1, 2])
+
+    def test_overflow_restore(self):
+        queue = DoubleBuffer(NAMES)
+        ring = RingBuffer(NAMES, 4, RAISE)
+        queue.append(0, [0.0])
+        queue.extend([1, 2, 3, 4, 5], [[1.0, 2.0, 3.0, 4.0, 5.0]])
+        queue.append(6, [6.0])
+        self.assertRaises(BufferError, queue.drain, ring)
+        # the batch was split, its tail is back at the head of the queue
+        self.assertEqual(list(ring.view().iter_ts()), [0, 1, 2, 3])
+        self.assertEqual(len(queue), 3)
+        # rows queued in the meantime go after the restored ones
+        queue.append(7, [7.0])
+        ring.consume(ring.end)
+        self.assertEqual(queue.drain(ring), 4)
+        self.assertEqual(list(ring.view().iter_ts()), [4, 5, 6, 7])
+        self.assertEqual(list(ring.view().iter_column('power')),
+                         [4.0, 5.0, 6.0, 7.0])
+
+    def test_overflow_on_row(self):
+        queue = DoubleBuffer(NAMES)
+        ring = RingBuffer(NAMES, 1, RAISE)
+        queue.append(0, [0.0])
+        queue.append(1, [1.0])
+        self.assertRaises(BufferError, queue.drain, ring)
+        self.assertEqual(len(queue), 1)
+        ring.consume(ring.end)
+        queue.drain(ring)
+        self.assertEqual(list(ring.view().iter_ts()), [1])
+
+
+if __name__ == "__main__":
+    unittest.main()
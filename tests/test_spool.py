@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013, Roberto Riggio
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the CREATE-NET nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY CREATE-NET ''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL CREATE-NET BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+""" Tests for energino.spool. """
+
+from __future__ import absolute_import
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from energino.spool import Spool
+from energino.spool import SEGMENT_SUFFIX
+from energino.spool import segment_name
+
+NAMES = ('power', 'voltage')
+
+
+class SpoolTest(unittest.TestCase):
+    """ Offsets, segment rotation and crash recovery. """
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def spool(self, segment_rows=4):
+        return Spool(self.path, NAMES, segment_rows)
+
+    def fill(self, spool, first, count):
+        for ts in range(first, first + count):
+            spool.append(ts, [float(ts), 5.0])
+
+    def segments(self):
+        return sorted(name for name in os.listdir(self.path)
+                      if name.endswith(SEGMENT_SUFFIX))
+
+    def test_offsets(self):
+        spool = self.spool()
+        self.fill(spool, 0, 10)
+        self.assertEqual(len(self.segments()), 3)
+        view = spool.view(6)
+        self.assertEqual(list(view.iter_ts()), list(range(6)))
+        # rows appended after the view do not move it
+        self.fill(spool, 10, 2)
+        spool.consume(view.end)
+        self.assertEqual((spool.first, len(spool)), (6, 6))
+        self.assertEqual(list(spool.view().iter_column('power')),
+                         [float(ts) for ts in range(6, 12)])
+        self.assertEqual(spool.view().last('power'), 11.0)
+        # the first segment only held acknowledged rows
+        self.assertEqual(self.segments()[0], segment_name(4))
+        spool.close()
+
+    def test_resume(self):
+        spool = self.spool()
+        self.fill(spool, 0, 10)
+        spool.consume(spool.view(7).end)
+        spool.close()
+        spool = self.spool()
+        self.assertEqual((spool.first, len(spool)), (7, 3))
+        self.assertEqual(list(spool.view().iter_ts()), [7, 8, 9])
+        self.fill(spool, 10, 3)
+        self.assertEqual(spool.end, 13)
+        spool.close()
+
+    def test_torn_record(self):
+        spool = self.spool(segment_rows=100)
+        self.fill(spool, 0, 5)
+        spool.close()
+        # a crash in the middle of a write
+        with open(os.path.join(self.path, segment_name(0)), 'ab') as segment:
+            segment.write(b'\x01\x02\x03')
+        spool = self.spool(segment_rows=100)
+        self.assertEqual(len(spool), 5)
+        self.fill(spool, 5, 1)
+        self.assertEqual(list(spool.view().iter_ts()), list(range(6)))
+        spool.close()
+
+    def test_columns_changed(self):
+        self.spool().close()
+        self.assertRaises(ValueError, Spool, self.path, ('power',))
+
+    def test_remove(self):
+        spool = self.spool()
+        self.fill(spool, 0, 6)
+        self.assertRaises(ValueError, spool.remove)
+        spool.consume(spool.end)
+        spool.remove()
+        self.assertFalse(os.path.exists(self.path))
+        os.makedirs(self.path)
+
+    def test_extend(self):
+        spool = self.spool(segment_rows=3)
+        spool.extend([1, 2, 3, 4], [[1.0, 2.0, 3.0, 4.0], [5.0] * 4])
+        self.assertEqual(list(spool.view().iter_column('power')),
+                         [1.0, 2.0, 3.0, 4.0])
+        self.assertEqual(len(self.segments()), 2)
+        spool.close()
+
+
+if __name__ == "__main__":
+    unittest.main()